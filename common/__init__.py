@@ -0,0 +1 @@
+# 各サンプルで共有する処理をまとめたモジュール
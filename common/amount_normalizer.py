@@ -0,0 +1,231 @@
+"""
+金額表記を列単位でまとめて正規化するモジュール
+
+このモジュールは、レシートから抽出した金額（「¥1,234」「１２３４円」「820」など）を
+pandasの列としてまとめて正規化します。
+
+特徴：
+- 列全体を1つのバイト列にまとめ、変換テーブルで全角数字・カンマなどを一括処理
+- 数値の取り出しはNumPyの配列演算で実行（1件ずつのPythonループを使わない）
+- 通貨記号（¥、￥、\）や「円」、全角数字（１２３）の表記に対応
+- 出力形式を明示的に指定できる
+  - "int": 整数（pandasの Int64 型。数値にできない値は欠損値）
+  - "yen": 「数字 + 円」形式の文字列（数値にできない値は元の値のまま）
+
+使用方法（ベンチマーク）：
+python -m common.amount_normalizer [件数]
+"""
+
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# 出力形式
+INT = "int"
+YEN = "yen"
+
+# 金額を表す列
+AMOUNT_COLUMNS = ["総支払額", "消費税額"]
+
+# 削除する半角文字の変換テーブル（カンマ、円記号としてのバックスラッシュ、空白）
+DELETE_TABLE = np.zeros(256, dtype=bool)
+DELETE_TABLE[list(b",\\ \t")] = True
+
+# 全角文字（UTF-8で EF BC xx）の3バイト目と、置き換える半角文字（None は削除）
+ZENKAKU_TABLE = {0x90 + i: ord("0") + i for i in range(10)}
+ZENKAKU_TABLE[0x8D] = ord("-")  # －
+ZENKAKU_TABLE[0x8C] = None  # ，
+
+# int64 に収まる最大桁数
+MAX_DIGITS = 18
+
+
+def clean_bytes(buffer):
+    """UTF-8のバイト配列から、全角数字を半角に変換し、記号やカンマを取り除く関数"""
+    buffer = buffer.copy()
+    keep = ~DELETE_TABLE[buffer]
+
+    # 全角文字（EF BC xx）を探し、3バイト目を半角文字に置き換えて先頭の2バイトを削除する
+    lead = np.flatnonzero((buffer[:-2] == 0xEF) & (buffer[1:-1] == 0xBC))
+    for third, replacement in ZENKAKU_TABLE.items():
+        positions = lead[buffer[lead + 2] == third]
+        keep[positions] = False
+        keep[positions + 1] = False
+        if replacement is None:
+            keep[positions + 2] = False
+        else:
+            buffer[positions + 2] = replacement
+
+    # 通貨記号（¥ は C2 A5、￥ は EF BF A5）を削除する
+    yen = np.flatnonzero((buffer[:-1] == 0xC2) & (buffer[1:] == 0xA5))
+    keep[yen] = False
+    keep[yen + 1] = False
+    fullwidth_yen = np.flatnonzero((buffer[:-2] == 0xEF) & (buffer[1:-1] == 0xBF) & (buffer[2:] == 0xA5))
+    for offset in range(3):
+        keep[fullwidth_yen + offset] = False
+
+    return buffer[keep]
+
+
+def parse_first_integers(strings):
+    """文字列のリストから、それぞれ最初に現れる整数をまとめて取り出す関数
+
+    すべての文字列を改行でつないだ1つのバイト列にし、NumPy配列として
+    変換テーブルの適用と数字の並びの解析を一括で行います（1件ずつのPythonループを使いません）。
+
+    :param list strings: 文字列のリスト
+    :returns: 整数の配列（pandasの Int64 型。数字がない場合は欠損値）
+    :rtype: pandas.arrays.IntegerArray
+    """
+    count = len(strings)
+    if count == 0:
+        return pd.array([], dtype="Int64")
+
+    joined = "\n".join(strings)
+    if joined.count("\n") != count - 1:
+        # 値の中に改行が含まれている場合は、行の対応が崩れないように置き換える
+        joined = "\n".join(text.replace("\n", " ") for text in strings)
+
+    buffer = np.frombuffer(joined.encode("utf-8"), dtype=np.uint8)
+    buffer = clean_bytes(buffer)
+    line_ids = np.cumsum(buffer == ord("\n"))
+    is_digit = (buffer >= ord("0")) & (buffer <= ord("9"))
+
+    # 数字が連続する区間（開始位置と終了位置）を求め、各行の最初の区間だけを残す
+    previous = np.concatenate(([False], is_digit[:-1]))
+    following = np.concatenate((is_digit[1:], [False]))
+    starts = np.flatnonzero(is_digit & ~previous)
+    ends = np.flatnonzero(is_digit & ~following) + 1
+    run_lines = line_ids[starts]
+    first = np.diff(run_lines, prepend=-1) != 0
+    starts, ends, run_lines = starts[first], ends[first], run_lines[first]
+
+    lengths = ends - starts
+    usable = lengths <= MAX_DIGITS
+    starts, lengths, run_lines = starts[usable], lengths[usable], run_lines[usable]
+
+    # 各桁に 10 のべき乗を掛けて区間ごとに合計する
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+    digits = buffer[np.repeat(starts, lengths) + positions].astype(np.int64) - ord("0")
+    powers = np.power(10, np.repeat(lengths, lengths) - positions - 1, dtype=np.int64)
+    if len(offsets):
+        values = np.add.reduceat(digits * powers, offsets)
+    else:
+        values = np.zeros(0, dtype=np.int64)
+
+    # 直前がマイナス記号なら負の数にする（値引きなど）
+    negative = (starts > 0) & (buffer[np.maximum(starts - 1, 0)] == ord("-"))
+    values = np.where(negative, -values, values)
+
+    result = np.zeros(count, dtype=np.int64)
+    missing = np.ones(count, dtype=bool)
+    result[run_lines] = values
+    missing[run_lines] = False
+    return pd.arrays.IntegerArray(result, missing)
+
+
+def normalize_amounts(values, mode=INT, fill_value=None):
+    """金額の列をまとめて正規化する関数
+
+    :param values: 金額の列（pandas.Series、NumPy配列、リストなど）
+    :param str mode: 出力形式（"int" または "yen"）
+    :param fill_value: "int" 形式で数値にできなかった値の代わりに入れる値（省略時は欠損値）
+    :returns: 正規化した列
+    :rtype: pandas.Series
+    """
+    if mode not in (INT, YEN):
+        raise ValueError(f"サポートされていない出力形式: {mode}")
+
+    series = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    amounts = pd.Series(parse_first_integers(series.astype(str).tolist()), index=series.index)
+
+    if mode == YEN:
+        return (amounts.astype(str) + "円").where(amounts.notna(), series)
+
+    if fill_value is not None:
+        return amounts.fillna(fill_value).astype("int64")
+    return amounts
+
+
+def normalize_dataframe(df, mode=INT, columns=AMOUNT_COLUMNS, fill_value=None):
+    """DataFrameの金額の列を正規化した新しいDataFrameを返す関数"""
+    df = df.copy()
+    for column in columns:
+        if column in df.columns:
+            df[column] = normalize_amounts(df[column], mode, fill_value)
+    return df
+
+
+def normalize_results(results, mode=INT, columns=AMOUNT_COLUMNS, fill_value=None):
+    """結果（辞書のリスト）の金額を正規化し、辞書のリストで返す関数
+
+    金額の項目だけを列ごとにまとめて正規化し、結果をコピーした辞書に書き戻します。
+    金額以外の項目は変換しません（DataFrameを経由すると、一部の結果にしかない整数の項目が小数になるため）。
+    """
+    results = [dict(result) for result in results]
+    for column in columns:
+        targets = [result for result in results if column in result]
+        if not targets:
+            continue
+        amounts = normalize_amounts([result[column] for result in targets], mode, fill_value)
+        # 欠損値は None に戻す
+        for result, amount in zip(targets, amounts.astype(object).where(amounts.notna(), None)):
+            result[column] = amount
+    return results
+
+
+def legacy_normalize_amount(amount_str):
+    """比較用：1件ずつ処理する従来の正規化（*_26 モジュールと同じ処理）"""
+    if not amount_str or not isinstance(amount_str, str):
+        return amount_str
+    amount_str = amount_str.replace('¥', '').replace('￥', '').replace(',', '').replace('円', '')
+    amount = ''.join(filter(str.isdigit, amount_str))
+    if not amount:
+        return amount_str
+    return int(amount)
+
+
+def make_synthetic_amounts(count, seed=0):
+    """ベンチマーク用に、さまざまな表記の金額を作成する関数"""
+    rng = random.Random(seed)
+    zenkaku = str.maketrans("0123456789", "０１２３４５６７８９")
+    formats = [
+        lambda n: str(n),
+        lambda n: f"¥{n:,}",
+        lambda n: f"￥{n:,}",
+        lambda n: f"{n:,}円",
+        lambda n: f"{n}".translate(zenkaku) + "円",
+        lambda n: f"\\{n}",
+        lambda n: "不明",
+    ]
+    return [rng.choice(formats)(rng.randint(1, 500000)) for _ in range(count)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"{count:,}件の金額を作成しています...")
+    amounts = pd.Series(make_synthetic_amounts(count), dtype=object)
+
+    start_time = time.perf_counter()
+    [legacy_normalize_amount(amount) for amount in amounts]
+    legacy_elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    normalize_amounts(amounts, INT)
+    int_elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    normalize_amounts(amounts, YEN)
+    yen_elapsed = time.perf_counter() - start_time
+
+    print(f"従来の1件ずつの処理: {legacy_elapsed:.2f}秒")
+    print(f"列単位の処理（int）: {int_elapsed:.2f}秒")
+    print(f"列単位の処理（yen）: {yen_elapsed:.2f}秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+プロバイダーごとのサーキットブレーカーのモジュール
+
+このモジュールは、プロバイダーの障害中に、残りのレシートのたびにタイムアウトまで待つことを防ぎます。
+プロバイダーごとに呼び出しの結果を記録し、次の3つの状態を切り替えます。
+
+- closed（通常）：呼び出しをそのまま送る。一時的なエラー（再試行しても失敗したもの）が
+  FAILURE_THRESHOLD 回続いたら open にする
+- open（遮断）：呼び出しを送らずに、すぐに CircuitOpenError を発生させる（別のプロバイダーに振り替える）
+- half-open（試行）：open にしてから OPEN_SECONDS が過ぎたら、試しに1件だけ送る。
+  成功したら closed に戻し、失敗したら再び open にする
+
+特徴：
+- 再試行の方針（common.retry）と組み合わせて使う（再試行しても失敗した呼び出しを1回の失敗として数える）
+- 試しに送る呼び出しは再試行しない（障害が続いている場合に長く待たないため）
+- 応答の解析の失敗や 400 などのエラーは、プロバイダーが応答しているため失敗として数えない
+- 遮断中のレシートは、APIキーが設定されている別のプロバイダーで抽出できる（receipt_extractors.divert_receipt）
+- プロバイダーごとに遮断した回数、送らずに失敗させた件数、振り替えた件数を表示
+"""
+
+import time
+
+from common.retry import call_with_retry, call_with_retry_async, is_retryable
+
+# 一時的なエラーがこの回数続いたら遮断する
+FAILURE_THRESHOLD = 5
+
+# 遮断してから、試しに1件送るまでの時間（秒）
+OPEN_SECONDS = 60.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """プロバイダーへの呼び出しを遮断している場合の例外"""
+
+    def __init__(self, provider, retry_in):
+        super().__init__(f"{provider}は障害のため遮断中です（{retry_in:.0f}秒後に試行します）")
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """1つのプロバイダーのサーキットブレーカー"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+        self.probes = 0
+        self.diverted = 0
+
+    def acquire(self):
+        """呼び出しを送れるかどうかを確認し、試しに送る呼び出しの場合は True を返す
+
+        :raises CircuitOpenError: 遮断中の場合（試しに送る呼び出しが送信中の場合を含む）
+        """
+        if self.state == OPEN:
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < OPEN_SECONDS:
+                self.rejected += 1
+                raise CircuitOpenError(self.provider, OPEN_SECONDS - elapsed)
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probing:
+                self.rejected += 1
+                raise CircuitOpenError(self.provider, 0)
+            self.probing = True
+            self.probes += 1
+            return True
+        return False
+
+    def record(self, error=None, probing=False):
+        """呼び出しの結果を記録し、状態を切り替える（probing は試しに送った呼び出しかどうか）"""
+        if probing:
+            self.probing = False
+        if error is None or not is_retryable(error):
+            # 応答があれば、エラーの応答でもプロバイダーは動いている
+            if self.state != CLOSED:
+                print(f"（{self.provider}の応答が戻ったため、遮断を解除します）")
+            self.state = CLOSED
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= FAILURE_THRESHOLD:
+            if self.state == CLOSED:
+                self.opened += 1
+                print(f"（{self.provider}でエラーが{self.failures}回続いたため、{OPEN_SECONDS:.0f}秒間遮断します）")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def cancel(self, probing=False):
+        """結果の出ないまま中断した呼び出し（キャンセルしたタスク）を記録する"""
+        if probing:
+            self.probing = False
+
+
+# プロバイダー名 → サーキットブレーカー
+breakers = {}
+
+
+def get_breaker(provider):
+    """プロバイダーのサーキットブレーカーを返す関数（最初の呼び出しで作成する）"""
+    if provider not in breakers:
+        breakers[provider] = CircuitBreaker(provider)
+    return breakers[provider]
+
+
+def call_provider(provider, function, *args, **kwargs):
+    """プロバイダーの呼び出しを、サーキットブレーカーと再試行の方針にそって実行する関数
+
+    :param str provider: プロバイダー名（openai / anthropic / gemini / vision など）
+    :param function: APIを呼び出す関数
+    :returns: 関数の戻り値
+    :raises CircuitOpenError: 遮断中の場合（呼び出しは送らない）
+    """
+    breaker = get_breaker(provider)
+    probing = breaker.acquire()
+    try:
+        if probing:
+            result = function(*args, **kwargs)
+        else:
+            result = call_with_retry(function, *args, **kwargs)
+    except Exception as e:
+        breaker.record(e, probing)
+        raise
+    except BaseException:
+        breaker.cancel(probing)
+        raise
+    breaker.record(probing=probing)
+    return result
+
+
+async def call_provider_async(provider, function, *args, **kwargs):
+    """call_provider の非同期版（function はコルーチン関数）"""
+    breaker = get_breaker(provider)
+    probing = breaker.acquire()
+    try:
+        if probing:
+            result = await function(*args, **kwargs)
+        else:
+            result = await call_with_retry_async(function, *args, **kwargs)
+    except Exception as e:
+        breaker.record(e, probing)
+        raise
+    except BaseException:
+        breaker.cancel(probing)
+        raise
+    breaker.record(probing=probing)
+    return result
+
+
+def print_breaker_stats():
+    """プロバイダーごとの状態と、遮断した回数・送らずに失敗させた件数・振り替えた件数を表示する関数"""
+    active = [breaker for breaker in breakers.values() if breaker.opened or breaker.rejected]
+    if not active:
+        return
+    print("\n[サーキットブレーカー]")
+    for breaker in active:
+        print(f"{breaker.provider}: 状態 {breaker.state}、遮断 {breaker.opened}回、"
+              f"送らずに失敗させた呼び出し {breaker.rejected}件、試行 {breaker.probes}件、"
+              f"別のプロバイダーに振り替え {breaker.diverted}件")
+
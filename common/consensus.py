@@ -0,0 +1,249 @@
+"""
+複数のプロバイダーの結果の一致でレシートの抽出結果を確定するモジュール（合意モード）
+
+このモジュールは、同じレシートを OpenAI・Claude・Gemini に同時に送り、
+2つのモデルの結果が項目ごとに一致した時点で結果を確定します。
+まだ応答のない残りのリクエストはその場でキャンセルし、待ち時間と料金を抑えます。
+どの2つの結果も一致しなかったレシートは、確認待ちの一覧（review_queue.jsonl）に追加します。
+
+一致の判定：
+- 登録番号：全角・半角、空白、ハイフンの違いを無視して比較
+- 購入店：全角・半角と空白の違いを無視して比較
+- 総支払額・消費税額：整数として比較
+
+特徴：
+- 非同期のクライアント（asyncio）で3つのプロバイダーに同時に問い合わせる
+- APIキーが設定されているプロバイダーが2つ以上あれば使用できる
+- 確定したレシートの割合、キャンセルしたリクエストの数、確定までの処理時間を表示
+
+使用方法：
+python -m common.consensus <画像のディレクトリ> [--output 結果のディレクトリ]
+"""
+
+import argparse
+import asyncio
+import re
+import time
+import unicodedata
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from common.circuit_breaker import print_breaker_stats
+from common.excel_export import print_export_stats, write_excel
+from common.receipt_extractors import close_async_clients, extract_receipt_async, is_configured
+from common.result_journal import append_journal
+from common.retry import print_retry_stats
+from common.structured_output import RECEIPT_FIELDS
+
+# 同時に問い合わせるモデル（プロバイダー, モデル名）
+CONSENSUS_MODELS = [
+    ("openai", "gpt-4o"),
+    ("anthropic", "claude-3-opus-20240229"),
+    ("gemini", "gemini-1.5-flash"),
+]
+
+# 結果を確定するために一致が必要なモデルの数
+REQUIRED_AGREEMENT = 2
+
+REVIEW_QUEUE_FILE_NAME = "review_queue.jsonl"
+CONSENSUS_COLUMN = "合意したモデル"
+
+# 合意モードの集計
+consensus_stats = {
+    "receipts": 0,
+    "accepted": 0,
+    "review": 0,
+    "cancelled": 0,
+    "errors": 0,
+    "elapsed": [],
+}
+
+
+def normalize_field(name, value):
+    """一致の判定のために項目の値を正規化する関数"""
+    if value is None or isinstance(value, int):
+        return value
+    text = re.sub(r"\s", "", unicodedata.normalize("NFKC", str(value)))
+    if name == "登録番号":
+        return text.replace("-", "").upper()
+    return text
+
+
+def different_fields(result, other):
+    """2つの結果で値が異なる項目名のリストを返す関数（一致していれば空のリスト）"""
+    return [
+        name for name, _, _ in RECEIPT_FIELDS
+        if normalize_field(name, result.get(name)) != normalize_field(name, other.get(name))
+    ]
+
+
+def select_models():
+    """APIキーが設定されているプロバイダーのモデルを返す関数"""
+    return [(provider, model) for provider, model in CONSENSUS_MODELS if is_configured(provider)]
+
+
+async def extract_consensus(image_path, models):
+    """すべてのモデルに同時に問い合わせ、2つの結果が一致した時点で確定する関数
+
+    :param image_path: 画像ファイルのパス
+    :param list models: (プロバイダー, モデル名) のリスト
+    :returns: accepted（確定したかどうか）, result（確定した結果）, models（一致したモデル名）,
+              extractions（受け取った結果）, errors（モデル名 → エラー）, cancelled（キャンセルした数）を持つ辞書
+    :rtype: dict
+    """
+    tasks = {
+        asyncio.create_task(extract_receipt_async(provider, model, image_path)): model
+        for provider, model in models
+    }
+    extractions = {}
+    errors = {}
+    agreed = None
+    pending = set(tasks)
+    try:
+        while pending and agreed is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                model = tasks[task]
+                try:
+                    extraction = task.result()
+                except Exception as e:
+                    errors[model] = str(e)
+                    continue
+                matches = [other for other, previous in extractions.items()
+                           if not different_fields(extraction["result"], previous["result"])]
+                extractions[model] = extraction
+                if agreed is None and len(matches) + 1 >= REQUIRED_AGREEMENT:
+                    agreed = matches[:REQUIRED_AGREEMENT - 1] + [model]
+    finally:
+        # 結果が確定した時点で、応答のないリクエストをキャンセルする
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    return {
+        "accepted": agreed is not None,
+        "result": extractions[agreed[0]]["result"] if agreed else None,
+        "models": agreed or [],
+        "extractions": extractions,
+        "errors": errors,
+        "cancelled": len(pending),
+    }
+
+
+def add_to_review_queue(queue_path, image_path, consensus):
+    """一致しなかったレシートの各モデルの結果と異なる項目を、確認待ちの一覧に追加する関数"""
+    extractions = consensus["extractions"]
+    models = list(extractions)
+    differences = {
+        f"{model} / {other}": different_fields(extractions[model]["result"], extractions[other]["result"])
+        for i, model in enumerate(models) for other in models[i + 1:]
+    }
+    append_journal(queue_path, {
+        "ファイル名": Path(image_path).name,
+        "追加日時": datetime.now().isoformat(timespec="seconds"),
+        "結果": {model: extraction["result"] for model, extraction in extractions.items()},
+        "異なる項目": differences,
+        "エラー": consensus["errors"],
+    })
+
+
+def record_consensus(consensus, elapsed):
+    """合意モードの結果を記録する関数"""
+    consensus_stats["receipts"] += 1
+    consensus_stats["accepted" if consensus["accepted"] else "review"] += 1
+    consensus_stats["cancelled"] += consensus["cancelled"]
+    consensus_stats["errors"] += len(consensus["errors"])
+    consensus_stats["elapsed"].append(elapsed)
+
+
+def print_consensus_stats():
+    """確定したレシートの割合と、キャンセルしたリクエストの数、処理時間を表示する関数"""
+    stats = consensus_stats
+    if not stats["receipts"]:
+        return
+    print("\n[合意モード]")
+    print(f"確定: {stats['accepted']}件（{stats['accepted'] / stats['receipts']:.1%}）、"
+          f"確認待ち: {stats['review']}件")
+    print(f"キャンセルしたリクエスト: {stats['cancelled']}件、エラー: {stats['errors']}件")
+    elapsed = stats["elapsed"]
+    print(f"1件あたりの処理時間: 平均 {sum(elapsed) / len(elapsed):.2f}秒、最大 {max(elapsed):.2f}秒")
+
+
+async def process_directory(image_files, models, queue_path):
+    """ディレクトリ内の画像を1枚ずつ合意モードで処理し、結果のリストを返す関数"""
+    results = []
+    for i, image_path in enumerate(image_files, 1):
+        print(f"\n処理中: {image_path.name} ({i}/{len(image_files)})")
+        start_time = time.perf_counter()
+        consensus = await extract_consensus(image_path, models)
+        elapsed = time.perf_counter() - start_time
+        record_consensus(consensus, elapsed)
+
+        for model, error in consensus["errors"].items():
+            print(f"  {model}: エラーが発生しました: {error}")
+        if consensus["accepted"]:
+            print(f"  {' と '.join(consensus['models'])}の結果が一致しました（{elapsed:.2f}秒）")
+            row = dict(consensus["result"])
+            row[CONSENSUS_COLUMN] = ", ".join(consensus["models"])
+        else:
+            print("  結果が一致しなかったため、確認待ちの一覧に追加します")
+            add_to_review_queue(queue_path, image_path, consensus)
+            row = {"error": "モデルの結果が一致しませんでした（確認待ち）"}
+        row["ファイル名"] = image_path.name
+        results.append(row)
+    return results
+
+
+def save_results(results, output_dir):
+    """結果をCSVとExcelファイルに保存する関数"""
+    csv_path = output_dir / "receipt_results_consensus.csv"
+    pd.DataFrame(results).to_csv(csv_path, index=False, encoding="utf-8-sig")
+    excel_path = output_dir / "receipt_results_consensus.xlsx"
+    stats = write_excel(results, excel_path)
+    print(f"\nCSVファイル: {csv_path}")
+    print(f"Excelファイル: {excel_path}")
+    print_export_stats(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="複数のプロバイダーの結果の一致でレシートの抽出結果を確定します")
+    parser.add_argument("directory", help="レシート画像（JPG）のディレクトリ")
+    parser.add_argument("--output", help="結果のディレクトリ（省略時は画像のディレクトリの results）")
+    args = parser.parse_args()
+
+    models = select_models()
+    if len(models) < REQUIRED_AGREEMENT:
+        print(f"エラー: {REQUIRED_AGREEMENT}つ以上のプロバイダーのAPIキーを設定してください")
+        return
+    print(f"合意モード: {', '.join(model for _, model in models)}（{REQUIRED_AGREEMENT}つの一致で確定）")
+
+    image_files = sorted(Path(args.directory).glob("*.jpg"))
+    if not image_files:
+        print(f"警告: {args.directory} 内にJPGファイルが見つかりません")
+        return
+
+    output_dir = Path(args.output) if args.output else Path(args.directory) / "results"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    queue_path = output_dir / REVIEW_QUEUE_FILE_NAME
+
+    async def run():
+        try:
+            return await process_directory(image_files, models, queue_path)
+        finally:
+            await close_async_clients()
+
+    results = asyncio.run(run())
+
+    save_results(results, output_dir)
+    if consensus_stats["review"]:
+        print(f"確認待ちの一覧: {queue_path}")
+    print_consensus_stats()
+    print_retry_stats()
+    print_breaker_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+大量の結果をメモリ使用量を抑えてExcelファイルに書き出すモジュール
+
+このモジュールは、xlsxwriter の constant_memory モードを使って、結果を1行ずつExcelファイルに
+書き出します。df.to_excel のようにブック全体をメモリ上に組み立てないため、
+10万件を超える結果でもメモリ使用量はほぼ一定です。
+
+特徴：
+- 結果のリストだけでなく、結果ジャーナル（JSON Lines）からも1行ずつ書き出せる
+- Excelの行数の上限（1,048,576行）を超える場合は自動的に次のシートに切り替える
+- 金額の正規化は一定件数ごとにまとめて実行（金額の正規化エンジンを使用）
+- 辞書やリストの値（品目の一覧など）はJSONの文字列として書き出す
+- 書き出した件数と1秒あたりの行数を表示
+
+使用方法：
+python -m common.excel_export <ジャーナルファイル> [Excelファイル]
+python -m common.excel_export --benchmark [件数]
+"""
+
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+import xlsxwriter
+
+from common.amount_normalizer import INT, normalize_results
+from common.result_journal import (
+    append_journal,
+    collect_columns,
+    iter_chunks,
+    iter_journal,
+    start_journal,
+)
+
+# Excelの1シートあたりの最大行数（見出し行を含む）
+EXCEL_MAX_ROWS = 1_048_576
+
+SHEET_NAME = "結果"
+
+# 金額を正規化するときにまとめて読み込む件数
+CHUNK_SIZE = 10_000
+
+
+def sheet_title(index):
+    """シート名を返す関数（2枚目以降は「結果_2」のように番号を付ける）"""
+    return SHEET_NAME if index == 1 else f"{SHEET_NAME}_{index}"
+
+
+def cell_value(value):
+    """Excelのセルに書き込めない値（辞書・リスト）をJSONの文字列に変換する関数"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def write_excel(rows, excel_path, columns=None, max_rows=EXCEL_MAX_ROWS):
+    """結果を1行ずつExcelファイルに書き出す関数
+
+    :param rows: 結果（辞書）のリストまたはイテレーター
+    :param excel_path: 保存先のExcelファイルのパス
+    :param list columns: 列名のリスト（省略時は rows に現れる項目名。rows はリストであること）
+    :param int max_rows: 1シートあたりの最大行数（見出し行を含む）
+    :returns: rows（件数）, sheets（シート数）, elapsed（秒）, rows_per_second を持つ辞書
+    :rtype: dict
+    """
+    if columns is None:
+        columns = collect_columns(rows)
+
+    start_time = time.perf_counter()
+    # constant_memory では書き終えた行をすぐに一時ファイルへ書き出す（行は上から順に書くこと）
+    workbook = xlsxwriter.Workbook(str(excel_path), {"constant_memory": True, "nan_inf_to_errors": True})
+    sheet = None
+    sheet_count = 0
+    sheet_rows = max_rows
+    row_count = 0
+
+    for row in rows:
+        if sheet_rows >= max_rows:
+            # 上限に達したら新しいシートを作成し、見出し行から書き始める
+            sheet_count += 1
+            sheet = workbook.add_worksheet(sheet_title(sheet_count))
+            sheet.write_row(0, 0, columns)
+            sheet_rows = 1
+        sheet.write_row(sheet_rows, 0, [cell_value(row.get(column)) for column in columns])
+        sheet_rows += 1
+        row_count += 1
+
+    if sheet is None:
+        # 結果が0件の場合も見出し行だけのシートを作成する
+        sheet_count = 1
+        workbook.add_worksheet(sheet_title(1)).write_row(0, 0, columns)
+
+    workbook.close()
+    elapsed = time.perf_counter() - start_time
+    return {
+        "rows": row_count,
+        "sheets": sheet_count,
+        "elapsed": elapsed,
+        "rows_per_second": row_count / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def iter_normalized(rows, mode=None, fill_value=None, chunk_size=CHUNK_SIZE):
+    """結果を chunk_size 件ずつ金額の正規化を行いながら1件ずつ返すジェネレーター"""
+    for chunk in iter_chunks(rows, chunk_size):
+        if mode is not None:
+            chunk = normalize_results(chunk, mode, fill_value=fill_value)
+        yield from chunk
+
+
+def export_journal(journal_path, excel_path, mode=None, fill_value=None, max_rows=EXCEL_MAX_ROWS):
+    """結果ジャーナルを読みながらExcelファイルに書き出す関数
+
+    列名を調べるためにジャーナルを一度読み、書き出すときにもう一度読みます。
+    どちらも1行ずつ読むため、結果全体をメモリに読み込みません。
+
+    :param journal_path: 結果ジャーナルのパス
+    :param excel_path: 保存先のExcelファイルのパス
+    :param str mode: 金額の出力形式（"int" または "yen"。省略時は正規化しない）
+    :param fill_value: "int" 形式で数値にできなかった値の代わりに入れる値
+    :param int max_rows: 1シートあたりの最大行数（見出し行を含む）
+    :returns: write_excel と同じ形式の辞書
+    :rtype: dict
+    """
+    columns = collect_columns(iter_journal(journal_path))
+    rows = iter_normalized(iter_journal(journal_path), mode, fill_value)
+    return write_excel(rows, excel_path, columns, max_rows)
+
+
+def print_export_stats(stats):
+    """書き出しの結果を表示する関数"""
+    print(f"Excelに書き出した件数: {stats['rows']:,}件（{stats['sheets']}シート）")
+    print(f"処理時間: {stats['elapsed']:.2f}秒（{stats['rows_per_second']:,.0f}行/秒）")
+
+
+def make_synthetic_results(count):
+    """ベンチマーク用の結果を作成する関数"""
+    for i in range(count):
+        amount = 100 + i % 20000
+        yield {
+            "登録番号": f"T{1000000000000 + i % 5000}",
+            "購入店": f"テスト商店 {i % 200}号店",
+            "総支払額": f"{amount:,}円",
+            "消費税額": f"¥{amount // 11}",
+            "ファイル名": f"receipt_{i:07d}.jpg",
+        }
+
+
+def benchmark(count):
+    """df.to_excel と、ジャーナルからの書き出しの処理時間を比較する関数"""
+    print(f"{count:,}件の結果で書き出し時間を比較します...")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results_dir = Path(temp_dir)
+        journal_path = start_journal(results_dir)
+        for result in make_synthetic_results(count):
+            append_journal(journal_path, result)
+
+        print("\n[ジャーナルから1行ずつ書き出し]")
+        print_export_stats(export_journal(journal_path, results_dir / "streamed.xlsx", INT))
+
+        print("\n[df.to_excel]")
+        start_time = time.perf_counter()
+        rows = normalize_results(list(iter_journal(journal_path)), INT)
+        pd.DataFrame(rows).to_excel(results_dir / "dataframe.xlsx", index=False)
+        elapsed = time.perf_counter() - start_time
+        print(f"処理時間: {elapsed:.2f}秒（{count / elapsed:,.0f}行/秒）")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("使用方法: python -m common.excel_export <ジャーナルファイル> [Excelファイル]")
+        print("          python -m common.excel_export --benchmark [件数]")
+        return
+
+    if sys.argv[1] == "--benchmark":
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100_000)
+        return
+
+    journal_path = Path(sys.argv[1])
+    excel_path = Path(sys.argv[2]) if len(sys.argv) > 2 else journal_path.with_suffix(".xlsx")
+    print_export_stats(export_journal(journal_path, excel_path))
+    print(f"Excelファイル: {excel_path}")
+
+
+if __name__ == "__main__":
+    main()
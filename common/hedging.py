@@ -0,0 +1,308 @@
+"""
+応答の遅いリクエストを別のプロバイダーにも送る（ヘッジする）ためのモジュール
+
+このモジュールは、対話形式の画像分析で1つのプロバイダーの応答が極端に遅い場合に備えて、
+最初のプロバイダー（プライマリ）の応答が、これまでの応答時間の95パーセンタイル（p95）を
+過ぎても返ってこなければ、同じリクエストを別のプロバイダー（セカンダリ）にも送ります。
+先に返ってきた応答を使い、もう一方のリクエストはキャンセルします。
+
+特徴：
+- プロバイダーごとの応答時間をヒストグラム（秒単位の区間ごとの件数）で記録し、ファイルに保存
+- p95 は保存したヒストグラムから計算（件数が少ないうちは既定の待ち時間を使用）
+- プライマリがエラーになった場合は、待たずにセカンダリに送る
+- ヘッジした回数と、セカンダリの応答を使った回数を表示
+
+使用方法（保存したヒストグラムと p95 の表示）：
+python -m common.hedging
+"""
+
+import asyncio
+import bisect
+import json
+import mimetypes
+import time
+from pathlib import Path
+
+import google.generativeai as genai
+import PIL.Image
+
+from common.receipt_extractors import close_async_clients, encode_image, get_async_client, get_client, is_configured
+
+# ヒストグラムの保存先
+HISTOGRAM_PATH = Path(__file__).resolve().parent.parent / "stats" / "latency_histograms.json"
+
+# ヒストグラムの区間の上限（秒）。最後の区間より遅い応答は最後の次の区間に数える
+BUCKET_BOUNDS = [0.5, 1, 1.5, 2, 3, 4, 5, 7, 10, 15, 20, 30, 45, 60, 90, 120]
+
+# p95 を使うために必要な件数と、それまでの既定の待ち時間（秒）
+MIN_SAMPLES = 20
+DEFAULT_HEDGE_DELAY = 10.0
+HEDGE_PERCENTILE = 0.95
+
+# プロバイダーごとのモデル（セカンダリとして使う場合）と、セカンダリに選ぶ順番（速い順）
+DEFAULT_MODELS = {
+    "openai": "gpt-4o",
+    "anthropic": "claude-3-opus-20240229",
+    "gemini": "gemini-1.5-flash",
+}
+SECONDARY_ORDER = ["gemini", "openai", "anthropic"]
+
+MAX_TOKENS = 1000
+
+# ヘッジの集計
+hedge_stats = {"requests": 0, "hedged": 0, "secondary_wins": 0, "failovers": 0}
+
+
+class LatencyHistogram:
+    """応答時間のヒストグラム"""
+
+    def __init__(self, counts=None):
+        self.counts = list(counts) if counts else [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def record(self, seconds):
+        """応答時間を記録する"""
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def record_cancelled(self, seconds):
+        """キャンセルした応答の時間（少なくともこの時間はかかる）を記録する
+
+        実際の応答時間は分からないため、すでに p95 を超えている場合だけ記録します
+        （p95 より短い時間を記録すると、p95 を実際より小さくしてしまうため）。
+        """
+        p95 = self.percentile(HEDGE_PERCENTILE)
+        if p95 is not None and seconds > p95:
+            self.record(seconds)
+
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, ratio):
+        """指定した割合の応答が収まる区間の上限（秒）を返す（件数が0の場合は None）"""
+        total = self.total()
+        if not total:
+            return None
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= total * ratio:
+                return BUCKET_BOUNDS[min(index, len(BUCKET_BOUNDS) - 1)]
+        return BUCKET_BOUNDS[-1]
+
+
+def load_histograms(path=HISTOGRAM_PATH):
+    """保存したヒストグラムを読み込み、プロバイダー名 → LatencyHistogram の辞書を返す関数"""
+    if not path.exists():
+        return {}
+    data = json.loads(path.read_text(encoding="utf-8"))
+    if data.get("bounds") != BUCKET_BOUNDS:
+        # 区間の設定が変わった場合は記録し直す
+        return {}
+    return {provider: LatencyHistogram(counts) for provider, counts in data["histograms"].items()}
+
+
+def save_histograms(histograms, path=HISTOGRAM_PATH):
+    """ヒストグラムを保存する関数（一時ファイルに書いてから置き換える）"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {
+        "bounds": BUCKET_BOUNDS,
+        "histograms": {provider: histogram.counts for provider, histogram in histograms.items()},
+    }
+    temp_path = path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(data), encoding="utf-8")
+    temp_path.replace(path)
+
+
+def hedge_delay(histogram):
+    """セカンダリに送るまでの待ち時間（プライマリの p95）を返す関数"""
+    if histogram is None or histogram.total() < MIN_SAMPLES:
+        return DEFAULT_HEDGE_DELAY
+    return histogram.percentile(HEDGE_PERCENTILE)
+
+
+def select_secondary(primary):
+    """APIキーが設定されている、プライマリ以外のプロバイダーを返す関数（ない場合は None）"""
+    for provider in SECONDARY_ORDER:
+        if provider != primary and is_configured(provider):
+            return provider
+    return None
+
+
+def mime_type(image_path):
+    """ファイル名からMIMEタイプを返す関数"""
+    return mimetypes.guess_type(str(image_path))[0] or "image/jpeg"
+
+
+async def ask_openai(model, image_path, prompt):
+    """OpenAIのモデルに画像とプロンプトを送り、応答のテキストを返す関数"""
+    response = await get_async_client("openai").chat.completions.create(
+        model=model,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:{mime_type(image_path)};base64,{encode_image(image_path)}"},
+                    },
+                ],
+            }
+        ],
+        max_tokens=MAX_TOKENS,
+    )
+    return response.choices[0].message.content
+
+
+async def ask_anthropic(model, image_path, prompt):
+    """Claudeのモデルに画像とプロンプトを送り、応答のテキストを返す関数"""
+    message = await get_async_client("anthropic").messages.create(
+        model=model,
+        max_tokens=MAX_TOKENS,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image",
+                        "source": {"type": "base64", "media_type": mime_type(image_path), "data": encode_image(image_path)},
+                    },
+                    {"type": "text", "text": prompt},
+                ],
+            }
+        ],
+    )
+    return message.content[0].text
+
+
+async def ask_gemini(model, image_path, prompt):
+    """Geminiのモデルに画像とプロンプトを送り、応答のテキストを返す関数"""
+    get_client("gemini")
+    with PIL.Image.open(image_path) as image:
+        response = await genai.GenerativeModel(model).generate_content_async([prompt, image])
+    return response.text
+
+
+ASKERS = {
+    "openai": ask_openai,
+    "anthropic": ask_anthropic,
+    "gemini": ask_gemini,
+}
+
+
+async def hedged_ask(primary, model, image_path, prompt, histograms):
+    """プライマリに送り、p95 を過ぎても応答がなければセカンダリにも送る関数
+
+    :returns: (応答したプロバイダー, 応答のテキスト)
+    :rtype: tuple
+    :raises Exception: すべてのプロバイダーでエラーになった場合は、プライマリのエラー
+    """
+    hedge_stats["requests"] += 1
+    start_times = {}
+    tasks = {}
+
+    def start(provider, provider_model):
+        start_times[provider] = time.perf_counter()
+        task = asyncio.create_task(ASKERS[provider](provider_model, image_path, prompt))
+        tasks[task] = provider
+
+    start(primary, model)
+    delay = hedge_delay(histograms.get(primary))
+    done, pending = await asyncio.wait(set(tasks), timeout=delay)
+
+    secondary = select_secondary(primary)
+    primary_failed = bool(done) and next(iter(done)).exception() is not None
+    if secondary and (not done or primary_failed):
+        if primary_failed:
+            hedge_stats["failovers"] += 1
+        else:
+            hedge_stats["hedged"] += 1
+            print(f"（{primary}の応答が{delay:.1f}秒を過ぎたため、{secondary}にも送信します）")
+        start(secondary, DEFAULT_MODELS[secondary])
+        pending = {task for task in tasks if not task.done()}
+
+    errors = {}
+    winner = None
+    try:
+        while winner is None:
+            for task in done:
+                provider = tasks[task]
+                elapsed = time.perf_counter() - start_times[provider]
+                if task.exception() is not None:
+                    errors[provider] = task.exception()
+                    continue
+                histograms.setdefault(provider, LatencyHistogram()).record(elapsed)
+                winner = (provider, task.result())
+                break
+            if winner is not None or not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            # キャンセルした応答は、p95 を超えて待った場合だけ記録する
+            provider = tasks[task]
+            histograms.setdefault(provider, LatencyHistogram()).record_cancelled(
+                time.perf_counter() - start_times[provider])
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if winner is None:
+        raise errors.get(primary) or next(iter(errors.values()))
+    if winner[0] != primary:
+        hedge_stats["secondary_wins"] += 1
+        print(f"（{winner[0]}の応答を使用します）")
+    return winner
+
+
+def ask_image(primary, image_path, prompt, model=None):
+    """画像とプロンプトをヘッジ付きで送り、応答のテキストを返す関数
+
+    :param str primary: 最初に送るプロバイダー（openai / anthropic / gemini）
+    :param image_path: 画像ファイルのパス
+    :param str prompt: プロンプト
+    :param str model: プライマリのモデル名（省略時は DEFAULT_MODELS のモデル）
+    :returns: 応答のテキスト
+    :rtype: str
+    """
+    histograms = load_histograms()
+
+    async def run():
+        # asyncio.run のたびにイベントループが変わるため、このループで作成したクライアントは閉じる
+        try:
+            return await hedged_ask(primary, model or DEFAULT_MODELS[primary], image_path, prompt, histograms)
+        finally:
+            await close_async_clients()
+
+    try:
+        _, text = asyncio.run(run())
+    finally:
+        save_histograms(histograms)
+    return text
+
+
+def print_hedge_stats():
+    """ヘッジした回数と、プロバイダーごとの p95 を表示する関数"""
+    stats = hedge_stats
+    if stats["requests"]:
+        print(f"\nヘッジ: {stats['requests']}件中 {stats['hedged']}件で別のプロバイダーにも送信、"
+              f"{stats['secondary_wins']}件で別のプロバイダーの応答を使用（エラーによる切り替え {stats['failovers']}件）")
+    for provider, histogram in load_histograms().items():
+        print(f"{provider}: {histogram.total()}件、p95 {histogram.percentile(HEDGE_PERCENTILE)}秒、"
+              f"待ち時間 {hedge_delay(histogram)}秒")
+
+
+def main():
+    histograms = load_histograms()
+    if not histograms:
+        print(f"ヒストグラムがありません: {HISTOGRAM_PATH}")
+        return
+    labels = [f"〜{bound}秒" for bound in BUCKET_BOUNDS] + [f"{BUCKET_BOUNDS[-1]}秒〜"]
+    for provider, histogram in histograms.items():
+        print(f"\n[{provider}]（{histogram.total()}件、p95 {histogram.percentile(HEDGE_PERCENTILE)}秒）")
+        for label, count in zip(labels, histogram.counts):
+            if count:
+                print(f"  {label}: {count}件")
+
+
+if __name__ == "__main__":
+    main()
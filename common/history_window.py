@@ -0,0 +1,126 @@
+"""
+複数ターンの会話で、トークン数の予算に収まる直近の履歴だけを送るモジュール（スライディングウィンドウ）
+
+会話履歴をすべて送ると、ターンを重ねるごとにプロンプトが長くなり、料金と待ち時間が増え続けます。
+このモジュールは、履歴のトークン数をローカルで見積もり（common.token_counter）、
+新しいメッセージから順に予算（HISTORY_TOKEN_BUDGET）に収まるところまでを送ります。
+
+特徴：
+- システムプロンプトは常に送る（固定）。予算からシステムプロンプトの分を先に差し引く
+- 新しい入力は、予算を超える場合でも必ず送る
+- 古いメッセージは、予算に収まらなくなったところから先をまとめて除く（途中のメッセージだけを抜かない）
+- 送る履歴がアシスタントの応答から始まらないようにする（Claude はユーザーのメッセージから始める必要がある）
+- OpenAI・Claude のメッセージ（history_messages）と、LangChain のメモリ（TokenWindowMemory）の両方で使える
+- 除いたメッセージの件数と、送ったトークン数（履歴をすべて送った場合との比較）を表示
+"""
+
+from langchain.memory import ConversationBufferMemory
+from langchain_core.messages import HumanMessage, get_buffer_string
+
+from common.token_counter import count_tokens
+
+# 1回の送信で使うトークン数の予算（システムプロンプト・履歴・新しい入力の合計）
+HISTORY_TOKEN_BUDGET = 2000
+
+# 1件のメッセージごとに加わるトークン数の見積もり（役割などの書式の分）
+MESSAGE_OVERHEAD = 4
+
+# APIに送る履歴の役割（エラーを保存した "system" などは送らない）
+CHAT_ROLES = ("user", "assistant")
+
+# 履歴のウィンドウの集計
+history_window_stats = {"calls": 0, "trimmed": 0, "dropped_messages": 0, "sent_tokens": 0, "full_tokens": 0}
+
+
+def message_tokens(content):
+    """1件のメッセージのおおよそのトークン数を返す関数"""
+    return count_tokens(str(content)) + MESSAGE_OVERHEAD
+
+
+def window_messages(messages, system_prompt="", budget=HISTORY_TOKEN_BUDGET):
+    """メッセージのうち、予算に収まる直近のものを返す関数
+
+    :param list messages: {"role": ..., "content": ...} のリスト（古い順。最後は新しい入力）
+    :param str system_prompt: 常に送るシステムプロンプト（トークン数を予算から差し引く）
+    :param int budget: トークン数の予算
+    :returns: 送るメッセージのリスト（messages の末尾の部分）
+    :rtype: list
+    """
+    used = count_tokens(system_prompt)
+    full = used + sum(message_tokens(message["content"]) for message in messages)
+    kept = []
+    for message in reversed(messages):
+        tokens = message_tokens(message["content"])
+        # 新しい入力（最後のメッセージ）は、予算を超えても送る
+        if kept and used + tokens > budget:
+            break
+        kept.append(message)
+        used += tokens
+    kept.reverse()
+
+    while len(kept) > 1 and kept[0]["role"] != "user":
+        used -= message_tokens(kept.pop(0)["content"])
+
+    stats = history_window_stats
+    stats["calls"] += 1
+    stats["sent_tokens"] += used
+    stats["full_tokens"] += full
+    if len(kept) < len(messages):
+        stats["trimmed"] += 1
+        stats["dropped_messages"] += len(messages) - len(kept)
+    return kept
+
+
+def history_messages(history, new_input, system_prompt="", budget=HISTORY_TOKEN_BUDGET):
+    """会話履歴と新しい入力から、APIに送るメッセージのリストを作る関数
+
+    :param list history: 会話履歴（"role" と "content" を持つ辞書のリスト。新しい入力は含めない）
+    :param str new_input: 新しい入力
+    :param str system_prompt: 常に送るシステムプロンプト（メッセージのリストには含めない）
+    :param int budget: トークン数の予算
+    :returns: {"role": ..., "content": ...} のリスト（最後は新しい入力）
+    :rtype: list
+    """
+    messages = [
+        {"role": entry["role"], "content": entry["content"]}
+        for entry in history
+        if entry["role"] in CHAT_ROLES
+    ]
+    messages.append({"role": "user", "content": new_input})
+    return window_messages(messages, system_prompt, budget)
+
+
+class TokenWindowMemory(ConversationBufferMemory):
+    """LangChain の会話のメモリのうち、予算に収まる直近の会話だけをプロンプトに渡すクラス
+
+    会話はすべて保存し（buffer で参照できる）、プロンプトに渡すときだけ履歴を絞ります。
+    pinned_prompt には、履歴と一緒に常に送るプロンプトのテンプレートを指定します。
+    """
+
+    pinned_prompt: str = ""
+    max_token_limit: int = HISTORY_TOKEN_BUDGET
+
+    def load_memory_variables(self, inputs):
+        history = self.chat_memory.messages
+        new_input = inputs.get(self.input_key or "input", "")
+        messages = [
+            {"role": "user" if isinstance(message, HumanMessage) else "assistant", "content": message.content}
+            for message in history
+        ]
+        messages.append({"role": "user", "content": new_input})
+        # 送るメッセージは履歴の末尾の部分のため、件数から履歴のメッセージを取り出す（最後は新しい入力）
+        count = len(window_messages(messages, self.pinned_prompt, self.max_token_limit)) - 1
+        recent = history[len(history) - count:] if count else []
+        if self.return_messages:
+            return {self.memory_key: recent}
+        return {self.memory_key: get_buffer_string(recent, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)}
+
+
+def print_history_window_stats():
+    """除いた履歴のメッセージの件数と、送ったトークン数を表示する関数"""
+    stats = history_window_stats
+    if not stats["calls"]:
+        return
+    print(f"\n履歴のウィンドウ: {stats['calls']}回の送信のうち {stats['trimmed']}回で"
+          f"古いメッセージを合計 {stats['dropped_messages']}件除きました（予算 {HISTORY_TOKEN_BUDGET}トークン）")
+    print(f"送ったトークン数: 約{stats['sent_tokens']}（履歴をすべて送った場合: 約{stats['full_tokens']}）")
@@ -0,0 +1,158 @@
+"""
+OpenAIの画像入力の詳細度（detail）を、必要なときだけ上げるためのモジュール
+
+OpenAIの画像入力は、detail を指定しないと高い詳細度（high）で処理され、
+画像を512ピクセルのタイルに分けた枚数に応じて入力トークン数が増えます。
+このモジュールは、まず低い詳細度（low、画像1枚につき85トークン）で抽出し、
+結果の検証に失敗したレシートだけを高い詳細度で抽出し直します。
+
+検証の内容：
+- 総支払額と消費税額が0以上の整数であること（非課税のレシートのため、消費税額は空でもよい）
+- 消費税額が総支払額に対して多すぎないこと（税率10%の内税額以下）
+- 消費税額が0でない場合は、少なすぎないこと（軽減税率8%の内税額以上。小さな桁の読み違いを見つける）
+- 登録番号がある場合は、形式とチェックディジットが正しいこと
+
+特徴：
+- 画像のサイズから高い詳細度の場合の画像のトークン数を計算し、削減できたトークン数を集計
+- 抽出し直した割合と、抽出し直した理由を表示
+"""
+
+import math
+
+import PIL.Image
+
+from common.registration_validator import INVALID_CHECK_DIGIT, INVALID_FORMAT, validate_numbers
+from common.structured_output import ParseError
+
+LOW = "low"
+HIGH = "high"
+
+# 画像1枚あたりの基本のトークン数と、高い詳細度での512ピクセルのタイル1枚あたりのトークン数
+BASE_IMAGE_TOKENS = 85
+TILE_TOKENS = 170
+TILE_SIZE = 512
+
+# 高い詳細度で処理するときの画像の縮小（長辺を2048以内、短辺を768以内）
+MAX_IMAGE_SIZE = 2048
+SHORT_SIDE_SIZE = 768
+
+# 消費税額の上限の目安（税率10%の内税額）と下限の目安（軽減税率8%の内税額）、端数処理の誤差
+MAX_TAX_RATE = 0.10
+MIN_TAX_RATE = 0.08
+TAX_TOLERANCE = 1
+
+# 詳細度の集計
+detail_stats = {
+    "requests": 0,
+    "escalated": 0,
+    "reasons": {},
+    "input_tokens": 0,
+    "high_detail_tokens": 0,
+}
+
+
+def image_part(url, detail=None):
+    """messages の content に入れる画像の要素を返す関数（detail が None の場合は指定しない）"""
+    image_url = {"url": url}
+    if detail is not None:
+        image_url["detail"] = detail
+    return {"type": "image_url", "image_url": image_url}
+
+
+def image_tokens(width, height, detail=HIGH):
+    """画像の入力トークン数を計算する関数（OpenAIの計算方法に基づく）"""
+    if detail == LOW:
+        return BASE_IMAGE_TOKENS
+    scale = min(1.0, MAX_IMAGE_SIZE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, SHORT_SIDE_SIZE / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return BASE_IMAGE_TOKENS + TILE_TOKENS * tiles
+
+
+def check_receipt(result):
+    """抽出結果を検証し、問題点のリストを返す関数（問題がなければ空のリスト）"""
+    problems = []
+    total = result.get("総支払額")
+    tax = result.get("消費税額")
+    for name, value in (("総支払額", total), ("消費税額", tax)):
+        if value is None and name == "消費税額":
+            # 非課税のレシートには消費税額がない
+            continue
+        if not isinstance(value, int) or isinstance(value, bool):
+            problems.append(f"{name}が数値ではありません")
+        elif value < 0:
+            problems.append(f"{name}が負の値です")
+    if not problems:
+        if total == 0:
+            problems.append("総支払額が0です")
+        elif tax is not None and tax > math.ceil(total * MAX_TAX_RATE / (1 + MAX_TAX_RATE)) + TAX_TOLERANCE:
+            problems.append("消費税額が総支払額に対して多すぎます")
+        elif tax and tax < math.floor(total * MIN_TAX_RATE / (1 + MIN_TAX_RATE)) - TAX_TOLERANCE:
+            # 0 は非課税のレシートとして認める
+            problems.append("消費税額が総支払額に対して少なすぎます")
+
+    number = result.get("登録番号")
+    if number is not None:
+        status = validate_numbers([number])[0]
+        if status in (INVALID_FORMAT, INVALID_CHECK_DIGIT):
+            problems.append(f"登録番号が正しくありません（{status}）")
+    return problems
+
+
+def extract_with_escalation(extract, image_path, adaptive=True):
+    """低い詳細度で抽出し、検証に失敗した場合だけ高い詳細度で抽出し直す関数
+
+    :param extract: 詳細度を受け取り、(結果, 入力トークン数) を返す関数（入力トークン数は不明なら None）
+    :param image_path: 画像ファイルのパス（高い詳細度の場合のトークン数の計算に使用）
+    :param bool adaptive: False の場合は詳細度を指定せずに1回だけ抽出する
+    :returns: 抽出結果
+    :rtype: dict
+    :raises structured_output.ParseError: 高い詳細度でも応答を解析できない場合
+    """
+    if not adaptive:
+        return extract(None)[0]
+
+    with PIL.Image.open(image_path) as image:
+        width, height = image.size
+    high_image_tokens = image_tokens(width, height, HIGH)
+
+    try:
+        result, input_tokens = extract(LOW)
+        problems = check_receipt(result)
+    except ParseError:
+        result, input_tokens, problems = None, None, ["応答を解析できませんでした"]
+
+    # 入力トークン数が分からない場合は、画像の部分だけで見積もる
+    spent = input_tokens if input_tokens is not None else BASE_IMAGE_TOKENS
+    # 最初から高い詳細度で送った場合の見積もり（画像の部分だけを置き換える）
+    baseline = spent - BASE_IMAGE_TOKENS + high_image_tokens
+    if problems:
+        print(f"  低い詳細度の結果を検証できませんでした（{'、'.join(problems)}）。高い詳細度で抽出し直します")
+        detail_stats["escalated"] += 1
+        for problem in problems:
+            detail_stats["reasons"][problem] = detail_stats["reasons"].get(problem, 0) + 1
+        result, high_tokens = extract(HIGH)
+        if high_tokens is not None:
+            baseline = high_tokens
+        spent += baseline
+
+    detail_stats["requests"] += 1
+    detail_stats["input_tokens"] += spent
+    detail_stats["high_detail_tokens"] += baseline
+    return result
+
+
+def print_detail_stats():
+    """詳細度を上げて抽出し直した割合と、削減できた入力トークン数を表示する関数"""
+    stats = detail_stats
+    if not stats["requests"]:
+        return
+    rate = stats["escalated"] / stats["requests"]
+    print(f"画像の詳細度: {stats['requests']}件中 {stats['escalated']}件を高い詳細度で抽出し直しました（{rate:.1%}）")
+    for reason, count in stats["reasons"].items():
+        print(f"  {reason}: {count}件")
+    saved = stats["high_detail_tokens"] - stats["input_tokens"]
+    print(f"入力トークン数: {stats['input_tokens']}（すべて高い詳細度の場合の見積もり {stats['high_detail_tokens']}、"
+          f"削減 {saved}）")
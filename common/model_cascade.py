@@ -0,0 +1,198 @@
+"""
+安価なモデルから順にレシートを抽出するモデルのカスケードのモジュール
+
+このモジュールは、まず速くて安価なモデル（Gemini Flash、Claude Haiku、GPT-4o mini のうち
+APIキーが設定されている最初のモデル）でレシートを抽出し、結果を検証します。
+検証に失敗したレシートだけを高性能なモデル（GPT-4o、Claude Opus、Gemini Pro のうち
+APIキーが設定されている最初のモデル）で抽出し直します。
+
+検証の内容（common.image_detail.check_receipt と同じ）：
+- 総支払額と消費税額が0以上の整数であること（非課税のレシートのため、消費税額は空でもよい）
+- 消費税額が総支払額に対して多すぎないこと（0でない場合は少なすぎないこと）
+- 登録番号がある場合は、形式とチェックディジットが正しいこと
+
+特徴：
+- 段階（安価なモデル / 高性能なモデル）ごとに、確定したレシートの割合を表示
+- 全体の処理時間と料金の見積もり、すべて高性能なモデルで処理した場合の料金の見積もりを表示
+- 結果には確定したモデル名と検証結果を追加して、CSVとExcelファイルに保存
+
+使用方法：
+python -m common.model_cascade <画像のディレクトリ> [--output 結果のディレクトリ]
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from common.circuit_breaker import print_breaker_stats
+from common.excel_export import print_export_stats, write_excel
+from common.image_detail import check_receipt
+from common.receipt_extractors import PRICES, estimate_cost, extract_receipt, is_configured
+from common.retry import print_retry_stats
+
+# 安価なモデル（速くて安い順）と高性能なモデル（プロバイダー, モデル名）
+CHEAP_MODELS = [
+    ("gemini", "gemini-1.5-flash"),
+    ("anthropic", "claude-3-haiku-20240307"),
+    ("openai", "gpt-4o-mini"),
+]
+HEAVY_MODELS = [
+    ("openai", "gpt-4o"),
+    ("anthropic", "claude-3-opus-20240229"),
+    ("gemini", "gemini-1.5-pro"),
+]
+
+MODEL_COLUMN = "抽出モデル"
+CHECK_COLUMN = "検証結果"
+CHECK_OK = "OK"
+
+# 段階ごとの集計（モデル名 → 件数・処理時間・料金）
+cascade_stats = {}
+
+
+def select_tiers():
+    """APIキーが設定されているモデルから、安価なモデルと高性能なモデルを1つずつ選ぶ関数"""
+    tiers = []
+    for models in (CHEAP_MODELS, HEAVY_MODELS):
+        for provider, model in models:
+            if is_configured(provider):
+                tiers.append((provider, model))
+                break
+    return tiers
+
+
+def record_attempt(model, extraction, resolved):
+    """段階ごとの抽出の結果を記録する関数"""
+    stats = cascade_stats.setdefault(
+        model, {"attempts": 0, "resolved": 0, "extracted": 0, "elapsed": 0.0, "cost": 0.0,
+                "input_tokens": 0, "output_tokens": 0})
+    stats["attempts"] += 1
+    if resolved:
+        stats["resolved"] += 1
+    if extraction is not None:
+        stats["extracted"] += 1
+        stats["elapsed"] += extraction["elapsed"]
+        stats["cost"] += extraction["cost"] or 0.0
+        stats["input_tokens"] += extraction["input_tokens"] or 0
+        stats["output_tokens"] += extraction["output_tokens"] or 0
+
+
+def extract_cascade(image_path, tiers):
+    """安価なモデルから順に抽出し、検証に成功した最初の結果を返す関数
+
+    :param image_path: 画像ファイルのパス
+    :param list tiers: (プロバイダー, モデル名) のリスト（select_tiers の戻り値）
+    :returns: 抽出結果（確定したモデル名と検証結果を含む。すべての段階で失敗した場合は最後の結果か error）
+    :rtype: dict
+    """
+    row = None
+    for provider, model in tiers:
+        try:
+            extraction = extract_receipt(provider, model, image_path)
+        except Exception as e:
+            # 解析の失敗やAPIのエラーは、次の段階で抽出し直す
+            print(f"  {model}: エラーが発生しました: {e}")
+            record_attempt(model, None, False)
+            row = {"error": f"エラーが発生しました: {str(e)}", MODEL_COLUMN: model}
+            continue
+
+        problems = check_receipt(extraction["result"])
+        record_attempt(model, extraction, not problems)
+        row = dict(extraction["result"])
+        row[MODEL_COLUMN] = model
+        row[CHECK_COLUMN] = "、".join(problems) or CHECK_OK
+        if not problems:
+            print(f"  {model}で確定しました（{extraction['elapsed']:.2f}秒）")
+            return row
+        print(f"  {model}の結果を検証できませんでした（{row[CHECK_COLUMN]}）")
+    return row
+
+
+def print_cascade_stats(tiers, total, elapsed):
+    """段階ごとに確定した割合と、全体の処理時間・料金の見積もりを表示する関数"""
+    if not total:
+        return
+    print("\n[モデルのカスケード]")
+    cost = 0.0
+    for _, model in tiers:
+        stats = cascade_stats.get(model)
+        if stats is None:
+            continue
+        cost += stats["cost"]
+        print(f"{model}: {stats['attempts']}件を抽出、{stats['resolved']}件で確定"
+              f"（全体の {stats['resolved'] / total:.1%}）、処理時間 {stats['elapsed']:.2f}秒、"
+              f"料金 ${stats['cost']:.4f}")
+    unresolved = total - sum(stats["resolved"] for stats in cascade_stats.values())
+    print(f"確定できなかったレシート: {unresolved}件（全体の {unresolved / total:.1%}）")
+    print(f"全体の処理時間: {elapsed:.2f}秒（1件あたり {elapsed / total:.2f}秒）、料金の見積もり: ${cost:.4f}")
+
+    if len(tiers) < 2:
+        return
+    heavy_model = tiers[-1][1]
+    heavy = cascade_stats.get(heavy_model)
+    if heavy and heavy["extracted"]:
+        # 高性能なモデルで実際に抽出したレシートの1件あたりの料金から見積もる
+        heavy_cost = heavy["cost"] / heavy["extracted"] * total
+        print(f"すべて{heavy_model}で処理した場合の料金の見積もり: ${heavy_cost:.4f}"
+              f"（{heavy_model}で抽出した{heavy['extracted']}件の1件あたりの料金から計算）")
+        return
+
+    # 高性能なモデルで抽出していない場合は、最初の段階のトークン数を高性能なモデルの料金で計算し直す
+    # （画像のトークン数はモデルによって数え方が違うため、おおよその目安）
+    first = cascade_stats.get(tiers[0][1])
+    if heavy_model in PRICES and first and first["extracted"]:
+        heavy_cost = estimate_cost(heavy_model, first["input_tokens"], first["output_tokens"]) * total / first["extracted"]
+        print(f"すべて{heavy_model}で処理した場合の料金の見積もり: 約${heavy_cost:.4f}"
+              f"（{tiers[0][1]}のトークン数から計算したおおよその目安）")
+
+
+def save_results(results, output_dir):
+    """結果をCSVとExcelファイルに保存する関数"""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    csv_path = output_dir / "receipt_results_cascade.csv"
+    pd.DataFrame(results).to_csv(csv_path, index=False, encoding="utf-8-sig")
+    excel_path = output_dir / "receipt_results_cascade.xlsx"
+    stats = write_excel(results, excel_path)
+    print(f"\nCSVファイル: {csv_path}")
+    print(f"Excelファイル: {excel_path}")
+    print_export_stats(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="安価なモデルから順にレシートを抽出します")
+    parser.add_argument("directory", help="レシート画像（JPG）のディレクトリ")
+    parser.add_argument("--output", help="結果のディレクトリ（省略時は画像のディレクトリの results）")
+    args = parser.parse_args()
+
+    tiers = select_tiers()
+    if not tiers:
+        print("エラー: APIキーが設定されていません")
+        return
+    print(f"モデルのカスケード: {' → '.join(model for _, model in tiers)}")
+    if len(tiers) < 2:
+        print("警告: 高性能なモデルのAPIキーが設定されていないため、検証に失敗したレシートは抽出し直しません")
+
+    image_files = sorted(Path(args.directory).glob("*.jpg"))
+    if not image_files:
+        print(f"警告: {args.directory} 内にJPGファイルが見つかりません")
+        return
+
+    results = []
+    start_time = time.perf_counter()
+    for i, image_path in enumerate(image_files, 1):
+        print(f"\n処理中: {image_path.name} ({i}/{len(image_files)})")
+        row = extract_cascade(image_path, tiers)
+        row["ファイル名"] = image_path.name
+        results.append(row)
+    elapsed = time.perf_counter() - start_time
+
+    save_results(results, Path(args.output) if args.output else Path(args.directory) / "results")
+    print_cascade_stats(tiers, len(image_files), elapsed)
+    print_retry_stats()
+    print_breaker_stats()
+
+
+if __name__ == "__main__":
+    main()
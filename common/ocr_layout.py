@@ -0,0 +1,197 @@
+"""
+OCR結果のレイアウトを考慮してテキストを再構成するモジュール
+
+このモジュールは、Google Cloud Vision API の結果（text_blocks）から、
+読み順に並んだコンパクトなテキストを組み立てます。
+
+特徴：
+- 各ブロックのバウンディングボックスをNumPy配列でまとめて処理
+- 文字の向き（回転した画像）を自動で補正
+- 縦方向の中心座標でブロックを行ごとにまとめる
+- 座標情報を含まない、LLMのプロンプト向けのテキストを出力
+
+使用方法：
+python -m common.ocr_layout <OCR結果のJSONファイル>
+"""
+
+import json
+import sys
+import time
+
+import numpy as np
+
+from common.token_counter import count_tokens
+
+# 同じ行とみなす縦方向のずれ（文字の高さに対する割合）
+LINE_TOLERANCE = 0.5
+
+# 単語の間にスペースを入れる横方向の間隔（文字の高さに対する割合）
+SPACE_GAP = 0.8
+
+# 英数字どうしの間にスペースを入れる横方向の間隔（文字の高さに対する割合）
+ASCII_SPACE_GAP = 0.4
+
+
+def get_vertices(block):
+    """ブロックの頂点座標を (4, 2) の配列で返す関数"""
+    vertices = block.get("bounding_box", {}).get("vertices", [])
+    points = [[v.get("x", 0), v.get("y", 0)] for v in vertices[:4]]
+    while len(points) < 4:
+        points.append(points[-1] if points else [0, 0])
+    return points
+
+
+def block_geometry(text_blocks):
+    """ブロックの位置を、文字の向きに合わせた座標系で返す関数
+
+    Vision API の頂点は文字の左上から時計回りに並んでいるため、
+    頂点0から頂点1への向きを読み方向として、画像の回転を打ち消します。
+
+    :param list text_blocks: OCR結果の text_blocks
+    :returns: x0, y0, x1, y1 をそれぞれ1次元配列にした辞書
+    :rtype: dict
+    """
+    points = np.asarray([get_vertices(b) for b in text_blocks], dtype=np.float64)
+    if points.size == 0:
+        empty = np.zeros(0)
+        return {"x0": empty, "y0": empty, "x1": empty, "y1": empty}
+
+    # 読み方向（頂点0→頂点1）の中央値を全体の向きとして使う
+    directions = points[:, 1, :] - points[:, 0, :]
+    direction = np.median(directions, axis=0)
+    norm = np.hypot(direction[0], direction[1])
+    if norm == 0:
+        direction = np.array([1.0, 0.0])
+    else:
+        direction = direction / norm
+
+    # 行の進む方向は読み方向を90度回転させた向き
+    normal = np.array([-direction[1], direction[0]])
+
+    xs = points @ direction
+    ys = points @ normal
+    return {
+        "x0": xs.min(axis=1),
+        "x1": xs.max(axis=1),
+        "y0": ys.min(axis=1),
+        "y1": ys.max(axis=1),
+    }
+
+
+def group_lines(text_blocks, line_tolerance=LINE_TOLERANCE):
+    """ブロックを行ごとにまとめ、読み順に並べたインデックスを返す関数
+
+    :param list text_blocks: OCR結果の text_blocks
+    :param float line_tolerance: 同じ行とみなす縦方向のずれ（文字の高さに対する割合）
+    :returns: 行ごとのブロックのインデックスのリスト
+    :rtype: list
+    """
+    if not text_blocks:
+        return []
+
+    geometry = block_geometry(text_blocks)
+    centers = (geometry["y0"] + geometry["y1"]) / 2
+    heights = geometry["y1"] - geometry["y0"]
+    threshold = max(float(np.median(heights)), 1.0) * line_tolerance
+
+    # 縦の中心でソートし、前のブロックとの差が閾値を超えたところで行を切り替える
+    order = np.argsort(centers, kind="stable")
+    gaps = np.diff(centers[order])
+    line_ids = np.empty(len(order), dtype=np.int64)
+    line_ids[order] = np.concatenate(([0], np.cumsum(gaps > threshold)))
+
+    # 行番号、横位置の順で並べ替える
+    reading_order = np.lexsort((geometry["x0"], line_ids))
+    boundaries = np.flatnonzero(np.diff(line_ids[reading_order])) + 1
+    return [line.tolist() for line in np.split(reading_order, boundaries)]
+
+
+def needs_space(left_text, right_text, gap, height):
+    """隣り合う単語の間にスペースを入れるかどうかを判定する関数"""
+    if gap > height * SPACE_GAP:
+        return True
+    if not left_text or not right_text:
+        return False
+    # 英数字の単語どうしは、日本語よりも狭い間隔で区切る
+    both_ascii = left_text[-1].isascii() and left_text[-1].isalnum() and \
+        right_text[0].isascii() and right_text[0].isalnum()
+    return both_ascii and gap > height * ASCII_SPACE_GAP
+
+
+def reconstruct_lines(text_blocks, line_tolerance=LINE_TOLERANCE):
+    """text_blocks から読み順に並んだ行のリストを作成する関数"""
+    if not text_blocks:
+        return []
+
+    geometry = block_geometry(text_blocks)
+    heights = geometry["y1"] - geometry["y0"]
+    height = max(float(np.median(heights)), 1.0)
+
+    lines = []
+    for indices in group_lines(text_blocks, line_tolerance):
+        words = [text_blocks[indices[0]].get("text", "")]
+        for prev, current in zip(indices, indices[1:]):
+            text = text_blocks[current].get("text", "")
+            gap = geometry["x0"][current] - geometry["x1"][prev]
+            # 離れている単語の間にだけスペースを入れる
+            if needs_space(words[-1], text, gap, height):
+                words.append(" ")
+            words.append(text)
+        lines.append("".join(words))
+    return lines
+
+
+def reconstruct_text(ocr_data, line_tolerance=LINE_TOLERANCE):
+    """OCR結果の辞書からプロンプト用のテキストを作成する関数
+
+    読み順の行（lines）が既にあればそれを使い、text_blocks があればレイアウトから再構成し、
+    なければ text / full_text をそのまま使います。どれもない場合はJSON文字列を返します。
+    """
+    if ocr_data.get("lines"):
+        return "\n".join(ocr_data["lines"])
+    text_blocks = ocr_data.get("text_blocks")
+    if text_blocks:
+        return "\n".join(reconstruct_lines(text_blocks, line_tolerance))
+    if "text" in ocr_data:
+        return ocr_data["text"]
+    if "full_text" in ocr_data:
+        return ocr_data["full_text"]
+    return json.dumps(ocr_data)
+
+
+def compare_prompt_size(ocr_data):
+    """JSONをそのまま送る場合と再構成した場合のプロンプトサイズを比較する関数"""
+    raw_text = json.dumps(ocr_data)
+
+    start_time = time.perf_counter()
+    layout_text = reconstruct_text(ocr_data)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "raw_chars": len(raw_text),
+        "raw_tokens": count_tokens(raw_text),
+        "layout_chars": len(layout_text),
+        "layout_tokens": count_tokens(layout_text),
+        "reconstruct_seconds": elapsed,
+    }
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("使用方法: python -m common.ocr_layout <OCR結果のJSONファイル>")
+        return
+
+    with open(sys.argv[1], "r", encoding="utf-8") as file:
+        ocr_data = json.load(file)
+
+    print(reconstruct_text(ocr_data))
+
+    stats = compare_prompt_size(ocr_data)
+    print("\nプロンプトサイズ:")
+    print(f"  変換前: {stats['raw_chars']}文字（約{stats['raw_tokens']}トークン）")
+    print(f"  変換後: {stats['layout_chars']}文字（約{stats['layout_tokens']}トークン）")
+    print(f"  再構成にかかった時間: {stats['reconstruct_seconds'] * 1000:.2f}ミリ秒")
+
+
+if __name__ == "__main__":
+    main()
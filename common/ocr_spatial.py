@@ -0,0 +1,275 @@
+"""
+OCRの単語ボックスに対する空間インデックスのモジュール
+
+このモジュールは、Google Cloud Vision API の text_blocks の位置情報を使って、
+「合計」や「内消費税」などのラベルと、その右側または下側に印字された金額を対応付けます。
+
+特徴：
+- レシートごとに一度だけインデックスを構築（行・列のグリッド）
+- 右隣・下隣の最近傍検索をNumPyでまとめて（ベクトル化して）実行
+- テキストだけでは失われる位置関係を使うため、プロンプトに頼らずに項目を抽出できる
+
+使用方法：
+python -m common.ocr_spatial <OCR結果のJSONファイル> [繰り返し回数]
+"""
+
+import json
+import re
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from common.ocr_layout import block_geometry, group_lines, reconstruct_text
+from common.receipt_rules import (
+    TAX_LABEL_PATTERN,
+    TOTAL_LABEL_PATTERNS,
+    extract_fields,
+    normalize_text,
+    pick_candidate,
+)
+
+# グリッドの1マスの大きさ（文字の高さに対する倍率）
+CELL_SCALE = 2.0
+
+# 通貨記号
+CURRENCY_PATTERN = re.compile(r"^[¥\\]$")
+
+# 金額として扱う単語（通貨記号付き・円付き・数字のみ）
+AMOUNT_TEXT_PATTERN = re.compile(r"^[¥\\]?(\d{1,3}(?:,\d{3})+|\d+)円?$")
+
+
+class BoxIndex:
+    """text_blocks のバウンディングボックスに対する空間インデックス"""
+
+    def __init__(self, text_blocks):
+        self.texts = [normalize_text(b.get("text", "")) for b in text_blocks]
+        geometry = block_geometry(text_blocks)
+        self.x0 = geometry["x0"]
+        self.x1 = geometry["x1"]
+        self.y0 = geometry["y0"]
+        self.y1 = geometry["y1"]
+
+        heights = self.y1 - self.y0
+        self.height = max(float(np.median(heights)), 1.0) if len(heights) else 1.0
+        self.cell_size = self.height * CELL_SCALE
+
+        # 行・列ごとのグリッド（各マスに含まれるボックスのインデックス）
+        self.rows = self._build_bands(self.y0, self.y1)
+        self.columns = self._build_bands(self.x0, self.x1)
+        self.lines = group_lines(text_blocks)
+        self.amount_mask = self._build_amount_mask()
+
+    def __len__(self):
+        return len(self.texts)
+
+    def _build_bands(self, starts, ends):
+        """ボックスが重なるマスごとにインデックスをまとめる"""
+        bands = defaultdict(list)
+        first = np.floor(starts / self.cell_size).astype(np.int64)
+        last = np.floor(ends / self.cell_size).astype(np.int64)
+        for i, (a, b) in enumerate(zip(first, last)):
+            for band in range(a, b + 1):
+                bands[band].append(i)
+        return {band: np.asarray(ids, dtype=np.int64) for band, ids in bands.items()}
+
+    def _build_amount_mask(self):
+        """金額らしいボックスを示す真偽値の配列を作る"""
+        mask = np.zeros(len(self.texts), dtype=bool)
+        for line in self.lines:
+            for position, i in enumerate(line):
+                if not AMOUNT_TEXT_PATTERN.match(self.texts[i]):
+                    continue
+                has_unit = not self.texts[i].isdigit()
+                after_currency = position > 0 and CURRENCY_PATTERN.match(self.texts[line[position - 1]])
+                is_line_end = position == len(line) - 1
+                # 「(1点)」の「1」などを除くため、通貨記号付きか行末の数字だけを金額とする
+                mask[i] = bool(has_unit or after_currency or is_line_end)
+        return mask
+
+    def _candidates(self, bands, starts, ends, forward=False):
+        """クエリが重なるマス（forward の場合はそれ以降のマスも）の候補を集める"""
+        first = int(np.floor(starts.min() / self.cell_size))
+        last = int(np.floor(ends.max() / self.cell_size))
+        if forward:
+            last = max(bands) if bands else last
+        ids = [bands[band] for band in range(first, last + 1) if band in bands]
+        if not ids:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(ids))
+
+    def nearest_right(self, query_ids, candidate_mask=None, min_overlap=0.5):
+        """各クエリの右側にある最も近いボックスを返す
+
+        :param query_ids: クエリとなるボックスのインデックス（配列）
+        :param candidate_mask: 候補を絞り込む真偽値の配列（省略時はすべて）
+        :param float min_overlap: 同じ行とみなす縦方向の重なりの割合
+        :returns: (見つかったボックスのインデックス, 距離) の配列。見つからない場合は -1
+        :rtype: tuple
+        """
+        q = np.asarray(query_ids, dtype=np.int64)
+        if len(q) == 0 or len(self) == 0:
+            return np.full(len(q), -1), np.full(len(q), np.inf)
+
+        c = self._candidates(self.rows, self.y0[q], self.y1[q])
+        if candidate_mask is not None:
+            c = c[candidate_mask[c]]
+
+        # (クエリ数, 候補数) の行列でまとめて計算する
+        overlap = np.minimum(self.y1[q, None], self.y1[None, c]) - \
+            np.maximum(self.y0[q, None], self.y0[None, c])
+        min_height = np.minimum(self.y1[q, None] - self.y0[q, None], self.y1[None, c] - self.y0[None, c])
+        gap = self.x0[None, c] - self.x1[q, None]
+        valid = (overlap >= min_height * min_overlap) & (gap > -self.height * 0.5) & \
+            (q[:, None] != c[None, :])
+        distance = np.where(valid, gap, np.inf)
+        return self._pick(c, distance)
+
+    def nearest_below(self, query_ids, candidate_mask=None):
+        """各クエリの下側（右下を含む）にある最も近いボックスを返す
+
+        :param query_ids: クエリとなるボックスのインデックス（配列）
+        :param candidate_mask: 候補を絞り込む真偽値の配列（省略時はすべて）
+        :returns: (見つかったボックスのインデックス, 距離) の配列。見つからない場合は -1
+        :rtype: tuple
+        """
+        q = np.asarray(query_ids, dtype=np.int64)
+        if len(q) == 0 or len(self) == 0:
+            return np.full(len(q), -1), np.full(len(q), np.inf)
+
+        c = self._candidates(self.columns, self.x0[q], self.x1[q], forward=True)
+        if candidate_mask is not None:
+            c = c[candidate_mask[c]]
+
+        gap_y = self.y0[None, c] - self.y1[q, None]
+        gap_x = np.maximum(self.x0[None, c] - self.x1[q, None], 0)
+        valid = (gap_y > -self.height * 0.25) & (self.x1[None, c] > self.x0[q, None]) & \
+            (q[:, None] != c[None, :])
+        # 縦方向の距離を優先し、横方向の距離は小さな重みで加える
+        distance = np.where(valid, gap_y + gap_x * 0.1, np.inf)
+        return self._pick(c, distance)
+
+    def _pick(self, candidates, distance):
+        """距離行列から各クエリの最近傍を選ぶ"""
+        if distance.shape[1] == 0:
+            return np.full(distance.shape[0], -1), np.full(distance.shape[0], np.inf)
+        best = np.argmin(distance, axis=1)
+        best_distance = distance[np.arange(len(best)), best]
+        found = np.where(np.isfinite(best_distance), candidates[best], -1)
+        return found, best_distance
+
+    def find_labels(self, pattern):
+        """ラベルに一致するボックスを探し、各一致の最後のボックスのインデックスを返す
+
+        「内」「消費」「税」のように複数のボックスに分かれたラベルにも対応するため、
+        行ごとにテキストをつなげてから検索します。
+        """
+        found = []
+        for line in self.lines:
+            text = ""
+            owners = []
+            for i in line:
+                text += self.texts[i]
+                owners.extend([i] * len(self.texts[i]))
+            for match in pattern.finditer(text):
+                if match.end() > match.start():
+                    found.append(owners[match.end() - 1])
+        return np.asarray(found, dtype=np.int64)
+
+    def amount_of(self, box_id):
+        """金額のボックスから数字だけの文字列を取り出す"""
+        match = AMOUNT_TEXT_PATTERN.match(self.texts[box_id])
+        return match.group(1).replace(",", "") if match else None
+
+
+def pair_label_values(index, label_pattern):
+    """ラベルと、その右側または下側の金額を対応付ける関数
+
+    :returns: (金額, 確信度) のリスト
+    :rtype: list
+    """
+    labels = index.find_labels(label_pattern)
+    if len(labels) == 0:
+        return []
+
+    right, _ = index.nearest_right(labels, index.amount_mask)
+    below, _ = index.nearest_below(labels, index.amount_mask)
+
+    pairs = []
+    for right_id, below_id in zip(right, below):
+        if right_id >= 0:
+            pairs.append((index.amount_of(right_id), 0.9))
+        elif below_id >= 0:
+            pairs.append((index.amount_of(below_id), 0.7))
+    return pairs
+
+
+def extract_amount_fields(index):
+    """空間インデックスから総支払額と消費税額を抽出する関数
+
+    :returns: receipt_rules.extract_fields と同じ形式の辞書
+    :rtype: dict
+    """
+    fields = {}
+    total, total_confidence = None, 0.0
+    for label_pattern in TOTAL_LABEL_PATTERNS:
+        pairs = pair_label_values(index, label_pattern)
+        if pairs:
+            total, total_confidence = pick_candidate(pairs)
+            break
+    fields["総支払額"] = {"value": total, "confidence": total_confidence}
+
+    tax, tax_confidence = pick_candidate(pair_label_values(index, TAX_LABEL_PATTERN))
+    fields["消費税額"] = {"value": tax, "confidence": tax_confidence}
+    return fields
+
+
+def merge_fields(base, extra):
+    """2つの抽出結果を、項目ごとに確信度の高い方を採用してまとめる関数"""
+    merged = {name: dict(field) for name, field in base.items()}
+    for name, field in extra.items():
+        current = merged.get(name)
+        if current is None or current["value"] is None:
+            merged[name] = dict(field)
+        elif field["value"] == current["value"]:
+            # 別の方法でも同じ値になった場合は確信度を上げる
+            merged[name]["confidence"] = round(min(max(current["confidence"], field["confidence"]) + 0.05, 0.99), 2)
+        elif field["confidence"] > current["confidence"]:
+            merged[name] = dict(field)
+    return merged
+
+
+def extract_ocr_fields(ocr_data):
+    """OCR結果から、テキストのルールと位置関係の両方を使って項目を抽出する関数"""
+    fields = extract_fields(reconstruct_text(ocr_data))
+    text_blocks = ocr_data.get("text_blocks")
+    if text_blocks:
+        fields = merge_fields(fields, extract_amount_fields(BoxIndex(text_blocks)))
+    return fields
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("使用方法: python -m common.ocr_spatial <OCR結果のJSONファイル> [繰り返し回数]")
+        return
+
+    with open(sys.argv[1], "r", encoding="utf-8") as file:
+        ocr_data = json.load(file)
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    text_blocks = ocr_data.get("text_blocks", [])
+    fields = extract_amount_fields(BoxIndex(text_blocks))
+    for name, field in fields.items():
+        print(f"{name}: {field['value']}（確信度 {field['confidence']:.2f}）")
+
+    # インデックスの構築と抽出を繰り返して、1件あたりの処理時間を計測する
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        extract_amount_fields(BoxIndex(text_blocks))
+    elapsed = time.perf_counter() - start_time
+    print(f"\n{repeat}回の処理時間: {elapsed:.2f}秒（1件あたり {elapsed / repeat * 1000:.2f}ミリ秒）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+レシートの抽出結果をParquet形式で保存するモジュール
+
+このモジュールは、各サンプルの save_results で作成している CSV / Excel に加えて、
+型付きのParquetファイルを作成します。
+
+特徴：
+- 金額（総支払額・消費税額）は int64 型で保存（金額の正規化エンジンを使用）
+- 購入店は辞書エンコード（同じ店名を何度も保存しない）
+- 処理日時（タイムスタンプ）の列を追加
+- エラーになった画像の結果は error の列に理由を保存（他の項目は空）
+- 月ごとのパーティション分割に対応（月=YYYY-MM のディレクトリ。同じファイルハッシュの結果は置き換える）
+- CSV / Excel との書き込み・読み込み時間を比較するベンチマーク付き
+
+保存する列は RESULT_SCHEMA の列だけです（登録番号・購入店・総支払額・消費税額・ファイル名・
+ファイルハッシュ・登録番号の検証・error・処理日時）。それ以外の項目（モデルが追加で返した項目など）は
+Parquetファイルには保存しません（CSV / Excel には残ります）。
+
+使用方法（ベンチマーク）：
+python -m common.parquet_output [件数]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from common.amount_normalizer import INT, normalize_amounts
+
+# 月ごとにパーティション分割するかどうか
+PARTITION_BY_MONTH = False
+
+# 保存するファイル名（パーティション分割する場合はディレクトリ名）
+PARQUET_FILE_NAME = "receipt_results.parquet"
+
+TIMESTAMP_COLUMN = "処理日時"
+MONTH_COLUMN = "月"
+
+# 保存する列と型
+RESULT_SCHEMA = pa.schema([
+    ("登録番号", pa.string()),
+    ("購入店", pa.dictionary(pa.int32(), pa.string())),
+    ("総支払額", pa.int64()),
+    ("消費税額", pa.int64()),
+    ("ファイル名", pa.string()),
+    ("ファイルハッシュ", pa.string()),
+    ("登録番号の検証", pa.dictionary(pa.int8(), pa.string())),
+    # エラーになった画像の理由（エラーでない結果は空）
+    ("error", pa.string()),
+    (TIMESTAMP_COLUMN, pa.timestamp("ms")),
+])
+
+
+def results_to_table(results, timestamp=None):
+    """結果（辞書のリスト）を型付きのArrowテーブルに変換する関数"""
+    df = pd.DataFrame(results)
+    for field in RESULT_SCHEMA:
+        if field.name not in df.columns:
+            df[field.name] = None
+
+    # 処理日時のない結果（この実行の結果）には現在時刻を入れる
+    df[TIMESTAMP_COLUMN] = pd.to_datetime(df[TIMESTAMP_COLUMN]).fillna(timestamp or datetime.now()).dt.floor("ms")
+
+    for column in ("総支払額", "消費税額"):
+        df[column] = normalize_amounts(df[column], INT)
+    for column in ("登録番号", "購入店", "ファイル名", "ファイルハッシュ", "登録番号の検証", "error"):
+        df[column] = df[column].astype("string")
+
+    return pa.Table.from_pandas(df[RESULT_SCHEMA.names], schema=RESULT_SCHEMA, preserve_index=False)
+
+
+def save_parquet(results, results_dir, partition_by_month=PARTITION_BY_MONTH):
+    """結果をParquet形式で保存し、保存先のパスを返す関数
+
+    :param list results: 結果（辞書のリスト）
+    :param results_dir: 保存先のディレクトリ
+    :param bool partition_by_month: 月ごとのディレクトリに分けて保存するかどうか（同じファイルハッシュの結果は置き換える）
+    :returns: 保存したファイル（またはディレクトリ）のパス
+    :rtype: pathlib.Path
+    """
+    table = results_to_table(results)
+    output_path = Path(results_dir) / PARQUET_FILE_NAME
+
+    if not partition_by_month:
+        pq.write_table(table, output_path)
+        return output_path
+
+    # 保存済みの結果のうち、同じファイルハッシュの結果は置き換える（同じ画像を何度も追記しない）
+    existing_months = set()
+    if output_path.exists():
+        existing = conform_table(pq.read_table(output_path))
+        existing_months = set(pc.unique(pc.strftime(existing[TIMESTAMP_COLUMN], format="%Y-%m")).to_pylist())
+        hashes = pc.drop_null(table["ファイルハッシュ"]).combine_chunks()
+        keep = pc.invert(pc.fill_null(pc.is_in(existing["ファイルハッシュ"], value_set=hashes), False))
+        table = pa.concat_tables([existing.filter(keep), table])
+
+    # 処理日時から月の列を作り、書き込む月のディレクトリを作り直す
+    months = pc.strftime(table[TIMESTAMP_COLUMN], format="%Y-%m")
+    table = table.append_column(MONTH_COLUMN, months)
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    pq.write_to_dataset(
+        table,
+        root_path=output_path,
+        partition_cols=[MONTH_COLUMN],
+        basename_template=f"part-{run_id}-{{i}}.parquet",
+        existing_data_behavior="delete_matching",
+    )
+    # 置き換えによって結果がなくなった月のディレクトリを削除する
+    for month in existing_months - set(pc.unique(months).to_pylist()):
+        shutil.rmtree(output_path / f"{MONTH_COLUMN}={month}", ignore_errors=True)
+    return output_path
+
+
+def conform_table(table):
+    """保存済みのテーブルを RESULT_SCHEMA の列と型にそろえる関数（ない列は空の値）"""
+    columns = []
+    for field in RESULT_SCHEMA:
+        if field.name in table.column_names:
+            columns.append(table[field.name].cast(field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(columns, schema=RESULT_SCHEMA)
+
+def read_parquet(path):
+    """保存したParquetファイル（またはディレクトリ）をDataFrameとして読み込む関数"""
+    return pq.read_table(path).to_pandas()
+
+
+def make_synthetic_results(count):
+    """ベンチマーク用の結果を作成する関数"""
+    stores = [f"テスト商店 {i}号店" for i in range(200)]
+    return [
+        {
+            "登録番号": f"T{1000000000000 + i % 5000}",
+            "購入店": stores[i % len(stores)],
+            "総支払額": 100 + i % 20000,
+            "消費税額": (100 + i % 20000) // 11,
+            "ファイル名": f"receipt_{i:07d}.jpg",
+        }
+        for i in range(count)
+    ]
+
+
+def measure(func):
+    """関数の実行時間を計測する関数"""
+    start_time = time.perf_counter()
+    func()
+    return time.perf_counter() - start_time
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"{count:,}件の結果で書き込み・読み込み時間を比較します...")
+    results = make_synthetic_results(count)
+    df = pd.DataFrame(results)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results_dir = Path(temp_dir)
+        csv_path = results_dir / "receipt_results.csv"
+        excel_path = results_dir / "receipt_results.xlsx"
+
+        timings = [
+            ("CSV", measure(lambda: df.to_csv(csv_path, index=False, encoding="utf-8-sig")),
+             measure(lambda: pd.read_csv(csv_path, encoding="utf-8-sig"))),
+            ("Excel", measure(lambda: df.to_excel(excel_path, index=False)),
+             measure(lambda: pd.read_excel(excel_path))),
+            ("Parquet", measure(lambda: save_parquet(results, results_dir)),
+             measure(lambda: read_parquet(results_dir / PARQUET_FILE_NAME))),
+        ]
+        sizes = {
+            "CSV": csv_path.stat().st_size,
+            "Excel": excel_path.stat().st_size,
+            "Parquet": (results_dir / PARQUET_FILE_NAME).stat().st_size,
+        }
+
+    print(f"\n{'形式':<8}{'書き込み':>10}{'読み込み':>10}{'サイズ':>12}")
+    for name, write_time, read_time in timings:
+        print(f"{name:<8}{write_time:>9.2f}秒{read_time:>9.2f}秒{sizes[name] / 1024:>10.0f}KB")
+
+
+if __name__ == "__main__":
+    main()
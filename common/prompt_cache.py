@@ -0,0 +1,288 @@
+"""
+プロンプトキャッシュを効かせやすいレシート抽出のリクエストを組み立てるモジュール
+
+OpenAI・Gemini はリクエストの先頭が前回と同じ（バイト単位で一致する）部分を、
+Anthropic は cache_control を付けた部分までをキャッシュし、入力トークンの料金と処理時間を削減します。
+このモジュールは、レシートごとに変わらない部分（抽出ルール・出力形式・入力例）を
+1つの静的なプレフィックスにまとめ、画像などの変わる部分は必ずその後ろに置きます。
+
+特徴：
+- 静的なプレフィックスは定数だけから組み立て、実行中は常に同じ文字列を返す
+- Anthropic ではシステムプロンプトに cache_control（ephemeral）を付ける
+- 応答の usage からキャッシュから読み込まれた入力トークン数を集計して表示
+- キャッシュの対象になる最小のトークン数（1024）に満たない場合は警告を表示
+
+使用方法（静的なプレフィックスとトークン数の概算の表示）：
+python -m common.prompt_cache [--compact]
+"""
+
+import json
+import sys
+from functools import lru_cache
+
+from common.image_detail import image_part
+from common.structured_output import COMPACT_KEYS, RECEIPT_FIELDS, format_instructions
+from common.token_counter import count_tokens
+
+# キャッシュの対象になるプレフィックスの最小のトークン数（OpenAI・Anthropic）
+MIN_CACHEABLE_TOKENS = 1024
+
+# 抽出のルール（システムプロンプト）
+EXTRACTION_RULES = """あなたはレシートの情報を正確に抽出するAIアシスタントです。
+レシートの画像から、次の4つの項目を抽出してください：
+1. 登録番号（登録番号もしくは事業者登録番号。「T」に続く13桁の数字）
+2. 購入店名（レシートの上部に印字された店名。支店名があれば含める）
+3. 総支払額（「合計」「お支払金額」などのラベルの金額。「小計」や「お預り」「お釣り」ではない）
+4. 消費税額（「消費税」「内税」「税額」などのラベルの金額。8%と10%の両方があれば合計する）
+
+金額は数字のみで表記してください（単位や記号なし）。
+例：820、495、460、950
+
+禁止事項：
+- 通貨記号（¥や￥）の使用
+- カンマ区切りの使用
+- 小数点以下の使用
+- 「円」などの単位の使用
+- レシートに印字されていない値の推測（見つからない項目は null）
+
+注意事項：
+- 登録番号の「T」は必ず含め、ハイフンや空白は取り除く
+- 全角の数字は半角に直す
+- 値引きやポイント利用がある場合は、値引き後の実際の支払額を総支払額とする
+- 複数の税率の消費税額が別々に印字されている場合は、その合計を消費税額とする
+- 外税の場合も内税の場合も、印字された消費税額をそのまま使う"""
+
+# 入力例（レシートのテキスト, 抽出結果）
+# 登録番号はチェックディジットの正しい番号にする（common.registration_validator の検証で不一致にならないように）
+FEW_SHOT_EXAMPLES = [
+    (
+        """コーヒーショップ 渋谷駅前店
+登録番号 T9234567890123
+2025年01月15日 08:12
+ブレンドコーヒー(M)      ¥450
+クロワッサン             ¥320
+小計                     ¥770
+(内消費税等 8%           ¥57)
+合計                     ¥770
+お預り                  ¥1,000
+お釣り                   ¥230""",
+        {"登録番号": "T9234567890123", "購入店": "コーヒーショップ 渋谷駅前店", "総支払額": 770, "消費税額": 57},
+    ),
+    (
+        """株式会社サンプル商店
+事業者登録番号：Ｔ２８７６５４３２１０９８７
+2025/02/03 19:45
+ノート                      198
+ボールペン×2                 264
+乾電池                      528
+小計                        990
+外税10%対象                 990
+消費税                       99
+お支払金額                 1,089
+クレジット               1,089""",
+        {"登録番号": "T2876543210987", "購入店": "株式会社サンプル商店", "総支払額": 1089, "消費税額": 99},
+    ),
+    (
+        """スーパーマーケット 中央店
+2025年03月01日(土) 17:30
+牛乳                     ￥238※
+食パン                   ￥178※
+台所用洗剤               ￥298
+小計                     ￥714
+値引                     -￥50
+合計                     ￥664
+(8%対象 ￥366 内税 ￥27)
+(10%対象 ￥298 内税 ￥27)
+※は軽減税率対象商品""",
+        {"登録番号": None, "購入店": "スーパーマーケット 中央店", "総支払額": 664, "消費税額": 54},
+    ),
+    (
+        """ドラッグストア 駅南口店
+T-4567-8901-2345-6
+2025-03-20 12:05
+目薬                         880
+マスク                       548
+合計                       1,428円
+うち消費税                   129円
+電子マネー                 1,428円""",
+        {"登録番号": "T4567890123456", "購入店": "ドラッグストア 駅南口店", "総支払額": 1428, "消費税額": 129},
+    ),
+    (
+        """レストラン サンプル亭
+登録番号:T2210987654321
+2025年04月10日 20:15  テーブル 5  2名
+日替わり定食 ×2          ¥2,400
+生ビール ×2              ¥1,200
+小計                     ¥3,600
+消費税(10%)                ¥360
+ポイント利用              -¥100
+ご請求額                 ¥3,860
+現金                     ¥4,000
+お釣り                     ¥140""",
+        {"登録番号": "T2210987654321", "購入店": "レストラン サンプル亭", "総支払額": 3860, "消費税額": 360},
+    ),
+]
+
+# 画像の前に置く指示（すべてのレシートで同じ文字列）
+USER_INSTRUCTION = "このレシートの画像から情報を抽出してください。"
+
+# プロバイダーごとのキャッシュの集計
+cache_stats = {}
+
+
+def format_example(result, compact=False):
+    """入力例の抽出結果を、出力形式に合わせたJSONの文字列に変換する関数"""
+    if compact:
+        data = {COMPACT_KEYS[name]: result[name] for name, _, _ in RECEIPT_FIELDS}
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    data = {name: result[name] for name, _, _ in RECEIPT_FIELDS}
+    return json.dumps(data, ensure_ascii=False, indent=4)
+
+
+@lru_cache(maxsize=None)
+def static_prefix(compact=False):
+    """すべてのレシートで共通の静的なプレフィックス（ルール・出力形式・入力例）を返す関数
+
+    定数だけから組み立てるため、同じ compact の値に対しては常に同じ文字列を返します。
+    """
+    examples = "\n\n".join(
+        f"入力例{number}：\n{text}\n出力例{number}：\n{format_example(result, compact)}"
+        for number, (text, result) in enumerate(FEW_SHOT_EXAMPLES, 1)
+    )
+    return f"{EXTRACTION_RULES}\n\n{format_instructions(compact)}\n\n{examples}"
+
+
+def check_prefix(compact=False):
+    """静的なプレフィックスのトークン数の概算を返し、キャッシュの対象になるかを確認する関数"""
+    tokens = count_tokens(static_prefix(compact))
+    if tokens < MIN_CACHEABLE_TOKENS:
+        print(f"警告: 静的なプレフィックスが約{tokens}トークンのため、"
+              f"プロンプトキャッシュの対象（{MIN_CACHEABLE_TOKENS}トークン以上）にならない可能性があります")
+    return tokens
+
+
+def openai_messages(image_url, compact=False, detail=None):
+    """OpenAIの messages を返す関数（静的なプレフィックスをシステムメッセージとして先頭に置く）
+
+    detail には画像の詳細度（"low" / "high"）を指定します（None の場合は指定しない）。
+    """
+    return [
+        {"role": "system", "content": static_prefix(compact)},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": USER_INSTRUCTION},
+                image_part(image_url, detail),
+            ],
+        },
+    ]
+
+
+def anthropic_system(compact=False):
+    """Anthropicの system を返す関数（静的なプレフィックスに cache_control を付ける）"""
+    return [
+        {
+            "type": "text",
+            "text": static_prefix(compact),
+            "cache_control": {"type": "ephemeral"},
+        }
+    ]
+
+
+def anthropic_messages(base64_image, media_type="image/jpeg"):
+    """Anthropicの messages を返す関数（変わる部分の画像はプレフィックスの後ろに置く）"""
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": USER_INSTRUCTION},
+                {
+                    "type": "image",
+                    "source": {"type": "base64", "media_type": media_type, "data": base64_image},
+                },
+            ],
+        }
+    ]
+
+
+def gemini_contents(image):
+    """Geminiの contents を返す関数（静的なプレフィックスはモデルの system_instruction に指定する）"""
+    return [USER_INSTRUCTION, image]
+
+
+def cache_tokens(usage):
+    """usage から入力トークン数とキャッシュのトークン数を取り出す関数
+
+    :param usage: OpenAIの usage、Anthropicの usage、Geminiの usage_metadata のいずれか
+    :returns: input_tokens（入力トークン数の合計）、cached_tokens（キャッシュから読み込まれた数）、
+              cache_write_tokens（キャッシュに書き込まれた数。Anthropicのみ）を持つ辞書
+    :rtype: dict
+    """
+    if usage is None:
+        return {}
+    if hasattr(usage, "prompt_tokens"):
+        # OpenAI（キャッシュされた数は prompt_tokens に含まれる）
+        details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "input_tokens": usage.prompt_tokens,
+            "cached_tokens": getattr(details, "cached_tokens", None) or 0,
+            "cache_write_tokens": 0,
+        }
+    if hasattr(usage, "prompt_token_count"):
+        # Gemini（キャッシュされた数は prompt_token_count に含まれる）
+        return {
+            "input_tokens": usage.prompt_token_count,
+            "cached_tokens": getattr(usage, "cached_content_token_count", None) or 0,
+            "cache_write_tokens": 0,
+        }
+    if hasattr(usage, "input_tokens"):
+        # Anthropic（input_tokens はキャッシュの読み書きを除いた数）
+        cached = getattr(usage, "cache_read_input_tokens", None) or 0
+        written = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return {
+            "input_tokens": usage.input_tokens + cached + written,
+            "cached_tokens": cached,
+            "cache_write_tokens": written,
+        }
+    return {}
+
+
+def response_cache_tokens(response):
+    """応答の usage（Geminiは usage_metadata）からキャッシュのトークン数を取り出す関数"""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        usage = getattr(response, "usage_metadata", None)
+    return cache_tokens(usage)
+
+
+def record_cache(provider, tokens):
+    """cache_tokens の結果をプロバイダーごとに記録する関数"""
+    if not tokens or tokens.get("input_tokens") is None:
+        return
+    stats = cache_stats.setdefault(
+        provider, {"requests": 0, "hits": 0, "input_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0})
+    stats["requests"] += 1
+    if tokens["cached_tokens"]:
+        stats["hits"] += 1
+    for key in ("input_tokens", "cached_tokens", "cache_write_tokens"):
+        stats[key] += tokens[key]
+
+
+def print_cache_stats():
+    """プロバイダーごとのプロンプトキャッシュのヒット数とトークン数を表示する関数"""
+    for provider, stats in cache_stats.items():
+        rate = stats["cached_tokens"] / stats["input_tokens"] if stats["input_tokens"] else 0.0
+        print(f"{provider}: プロンプトキャッシュ {stats['requests']}件中 {stats['hits']}件ヒット、"
+              f"入力トークン数 {stats['input_tokens']}のうちキャッシュから {stats['cached_tokens']}（{rate:.1%}）")
+        if stats["cache_write_tokens"]:
+            print(f"{provider}: キャッシュへの書き込み {stats['cache_write_tokens']}トークン")
+
+
+def main():
+    compact = "--compact" in sys.argv[1:]
+    print(static_prefix(compact))
+    print(f"\n文字数: {len(static_prefix(compact))}、トークン数の概算: {check_prefix(compact)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+レシートを応答の速いプロバイダーに振り分けて一括処理するモジュール（ルーター）
+
+このモジュールは、OpenAI・Claude・Gemini のモデルごとに、
+- 応答時間の指数移動平均（EWMA）
+- エラー率（EWMA）
+- 1分間に送れるリクエストの残り（設定した上限と直近1分間の送信数から見積もる）
+を記録し、レシートを1枚ずつ「いま送ると最も早く終わりそうな」モデルに振り分けます。
+各モデルに同時に送れる数の上限まで並行して処理するため、全体の処理量は
+1つのプロバイダーの処理量ではなく、すべてのアカウントの処理量の合計になります。
+
+予想完了時間の計算：
+- 同時に送っている数が上限に達している場合は、空くまでの待ち時間を加える
+- 1分間の上限に達している場合や、レート制限（429）の直後は、解除までの待ち時間を加える
+- エラー率が高いモデルは、送り直しを見込んで予想完了時間を長くする
+
+特徴：
+- エラーになったレシートは、別のモデルに振り分けて送り直す
+- すべてのモデルでエラーになった場合は、共通の再試行の方針（common.retry）にそって待ってから送り直す
+  （モデルが1つだけの場合も、一時的なエラーでレシートをあきらめない）
+- 内容が同じ画像が同じモデルに同時に振り分けられた場合は、1回の呼び出しにまとめる（common.singleflight）
+- モデルごとの件数・平均応答時間・エラー率と、全体の処理量（件/分）を表示
+- 結果には抽出したモデル名を追加して、CSVとExcelファイルに保存
+
+使用方法：
+python -m common.provider_router <画像のディレクトリ> [--output 結果のディレクトリ]
+"""
+
+import argparse
+import asyncio
+import time
+from collections import deque
+from pathlib import Path
+
+import pandas as pd
+
+from common.excel_export import print_export_stats, write_excel
+from common.receipt_extractors import close_async_clients, extract_receipt_async, is_configured
+from common.retry import is_rate_limit_error, next_delay, print_retry_stats, retry_after_seconds, retry_stats
+from common.singleflight import print_singleflight_stats
+
+# 振り分け先（プロバイダー, モデル名, 1分間のリクエスト数の上限, 同時に送る数の上限）
+# 上限は各アカウントの利用枠に合わせて変更してください
+ROUTES = [
+    ("openai", "gpt-4o", 500, 4),
+    ("anthropic", "claude-3-opus-20240229", 50, 2),
+    ("gemini", "gemini-1.5-flash", 15, 2),
+]
+
+# 指数移動平均の重み（新しい値の割合）
+EWMA_ALPHA = 0.3
+
+# 応答時間の記録がない場合に使う値（秒）
+DEFAULT_LATENCY = 10.0
+
+# レート制限（429）の応答に待ち時間の指定がない場合に待つ時間（秒）
+DEFAULT_RATE_LIMIT_WAIT = 60.0
+
+# エラー率がこれを超えても、予想完了時間は成功率 MIN_SUCCESS_RATE として計算する
+MIN_SUCCESS_RATE = 0.05
+
+RATE_WINDOW = 60.0
+MODEL_COLUMN = "抽出モデル"
+
+
+class Route:
+    """振り分け先のモデルと、その応答時間・エラー率・レート制限の見積もり"""
+
+    def __init__(self, provider, model, requests_per_minute, concurrency):
+        self.provider = provider
+        self.model = model
+        self.requests_per_minute = requests_per_minute
+        self.concurrency = concurrency
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.sent = deque()
+        self.blocked_until = 0.0
+        self.completed = 0
+        self.errors = 0
+
+    def remaining(self, now):
+        """直近1分間の送信数から、1分間の上限までに送れる残りの数を見積もる"""
+        while self.sent and now - self.sent[0] >= RATE_WINDOW:
+            self.sent.popleft()
+        return self.requests_per_minute - len(self.sent)
+
+    def wait_time(self, now):
+        """いま送れない場合に、送れるようになるまでの待ち時間（秒）を返す"""
+        wait = max(0.0, self.blocked_until - now)
+        if self.remaining(now) <= 0:
+            wait = max(wait, self.sent[0] + RATE_WINDOW - now)
+        return wait
+
+    def can_send(self, now):
+        return self.in_flight < self.concurrency and self.wait_time(now) == 0
+
+    def expected_completion(self, now):
+        """いま振り分けた場合に、結果が得られるまでの予想時間（秒）を返す"""
+        latency = self.latency if self.latency is not None else DEFAULT_LATENCY
+        # 同時に送れる数が埋まっている場合は、空くまで待つ（このモデルを待っているレシートも含める）
+        queued = (self.in_flight + self.waiting) // self.concurrency
+        expected = self.wait_time(now) + latency * (1 + queued)
+        return expected / max(1.0 - self.error_rate, MIN_SUCCESS_RATE)
+
+    def start(self, now):
+        self.in_flight += 1
+        self.sent.append(now)
+
+    def finish(self, elapsed, error=None):
+        """応答時間とエラーを記録し、指数移動平均を更新する"""
+        self.in_flight -= 1
+        self.error_rate += EWMA_ALPHA * ((1.0 if error else 0.0) - self.error_rate)
+        if error is None:
+            self.completed += 1
+            self.latency = elapsed if self.latency is None else self.latency + EWMA_ALPHA * (elapsed - self.latency)
+            return
+        self.errors += 1
+        if is_rate_limit_error(error):
+            wait = retry_after_seconds(error) or DEFAULT_RATE_LIMIT_WAIT
+            self.blocked_until = max(self.blocked_until, time.monotonic() + wait)
+
+
+class ProviderRouter:
+    """レシートを予想完了時間の最も短いモデルに振り分けるルーター"""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.changed = asyncio.Condition()
+
+    def choose(self, exclude=()):
+        """予想完了時間の最も短いモデルを返す（いま送れないモデルでも、待つ方が早ければ選ぶ）"""
+        now = time.monotonic()
+        candidates = [route for route in self.routes if route.model not in exclude]
+        return min(candidates, key=lambda route: route.expected_completion(now))
+
+    async def acquire(self, exclude=()):
+        """選んだモデルに送れるようになるまで待ち、送信を開始する"""
+        async with self.changed:
+            while True:
+                route = self.choose(exclude)
+                now = time.monotonic()
+                if route.can_send(now):
+                    route.start(now)
+                    return route
+                # 他のレシートの完了を待って選び直す（レート制限の場合は解除の時刻まで）
+                route.waiting += 1
+                try:
+                    await asyncio.wait_for(self.changed.wait(), route.wait_time(now) or None)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    route.waiting -= 1
+
+    async def release(self, route, elapsed, error=None):
+        async with self.changed:
+            route.finish(elapsed, error)
+            self.changed.notify_all()
+
+    async def extract(self, image_path):
+        """レシートを振り分けて抽出する。エラーの場合は別のモデルで送り直す
+
+        :returns: 抽出結果（抽出したモデル名を含む）。すべてのモデルでエラーになった場合は error
+        :rtype: dict
+        """
+        retry_stats["calls"] += 1
+        tried = []
+        attempt = 0
+        while True:
+            route = await self.acquire(exclude=tried)
+            start_time = time.monotonic()
+            try:
+                # 再試行は同じモデルで待たずに、まだ送っていない別のモデルへの振り分けで行う
+                extraction = await extract_receipt_async(route.provider, route.model, image_path, retry=False)
+            except Exception as e:
+                await self.release(route, time.monotonic() - start_time, e)
+                print(f"  {Path(image_path).name}: {route.model}でエラーが発生しました: {e}")
+                tried.append(route.model)
+                if len(tried) < len(self.routes):
+                    continue
+                # すべてのモデルでエラーになった場合は、待ってからすべてのモデルを対象に送り直す
+                # （レート制限のモデルは、acquire で解除の時刻まで待つ）
+                delay = next_delay(attempt, e)
+                if delay is None:
+                    return {"error": f"エラーが発生しました: {str(e)}"}
+                await asyncio.sleep(delay)
+                attempt += 1
+                tried = []
+                continue
+            await self.release(route, extraction["elapsed"])
+            if attempt:
+                retry_stats["recovered"] += 1
+            row = dict(extraction["result"])
+            row[MODEL_COLUMN] = route.model
+            return row
+
+    async def run(self, image_files):
+        """すべてのレシートを並行して処理し、画像の順番の結果のリストを返す"""
+        total = len(image_files)
+        finished = 0
+
+        async def process(image_path):
+            nonlocal finished
+            row = await self.extract(image_path)
+            row["ファイル名"] = image_path.name
+            finished += 1
+            print(f"処理完了: {image_path.name} → {row.get(MODEL_COLUMN, 'エラー')} ({finished}/{total})")
+            return row
+
+        return await asyncio.gather(*(process(image_path) for image_path in image_files))
+
+
+def select_routes():
+    """APIキーが設定されているプロバイダーの振り分け先を返す関数"""
+    return [Route(*route) for route in ROUTES if is_configured(route[0])]
+
+
+def print_router_stats(routes, total, elapsed):
+    """モデルごとの件数・平均応答時間・エラー率と、全体の処理量を表示する関数"""
+    print("\n[ルーター]")
+    for route in routes:
+        latency = f"{route.latency:.2f}秒" if route.latency is not None else "記録なし"
+        share = route.completed / total if total else 0.0
+        print(f"{route.model}: {route.completed}件（{share:.1%}）、応答時間（EWMA） {latency}、"
+              f"エラー {route.errors}件（エラー率（EWMA） {route.error_rate:.1%}）")
+    if elapsed > 0:
+        print(f"全体: {total}件を {elapsed:.2f}秒で処理（{total / elapsed * 60:.1f}件/分）")
+
+
+def save_results(results, output_dir):
+    """結果をCSVとExcelファイルに保存する関数"""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    csv_path = output_dir / "receipt_results_router.csv"
+    pd.DataFrame(results).to_csv(csv_path, index=False, encoding="utf-8-sig")
+    excel_path = output_dir / "receipt_results_router.xlsx"
+    stats = write_excel(results, excel_path)
+    print(f"\nCSVファイル: {csv_path}")
+    print(f"Excelファイル: {excel_path}")
+    print_export_stats(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="レシートを応答の速いプロバイダーに振り分けて一括処理します")
+    parser.add_argument("directory", help="レシート画像（JPG）のディレクトリ")
+    parser.add_argument("--output", help="結果のディレクトリ（省略時は画像のディレクトリの results）")
+    args = parser.parse_args()
+
+    routes = select_routes()
+    if not routes:
+        print("エラー: APIキーが設定されていません")
+        return
+    print(f"振り分け先: {', '.join(route.model for route in routes)}")
+
+    image_files = sorted(Path(args.directory).glob("*.jpg"))
+    if not image_files:
+        print(f"警告: {args.directory} 内にJPGファイルが見つかりません")
+        return
+
+    async def run():
+        try:
+            return await ProviderRouter(routes).run(image_files)
+        finally:
+            await close_async_clients()
+
+    start_time = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - start_time
+
+    save_results(list(results), Path(args.output) if args.output else Path(args.directory) / "results")
+    print_router_stats(routes, len(image_files), elapsed)
+    print_retry_stats()
+    print_singleflight_stats()
+
+
+if __name__ == "__main__":
+    main()
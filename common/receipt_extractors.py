@@ -0,0 +1,310 @@
+"""
+各プロバイダーのモデルでレシート画像から情報を抽出する関数をまとめたモジュール
+
+このモジュールは、プロバイダー（openai / anthropic / gemini）とモデル名を指定して
+1枚のレシートを抽出し、結果と一緒に入出力のトークン数・処理時間・料金の見積もりを返します。
+複数のモデルを組み合わせて使う処理（モデルのカスケードなど）から共通で使用します。
+
+特徴：
+- 構造化出力（common.structured_output）で結果の形式をそろえる
+- プロンプトキャッシュを効かせるリクエストの形（common.prompt_cache）を使用
+- APIキーが設定されているプロバイダーだけを使用できる
+- クライアントとモデルは最初に使用するときに一度だけ作成
+- 複数のプロバイダーに同時に問い合わせるための非同期版（extract_receipt_async）も用意
+  （同じ画像を同じモデルで同時に抽出する場合は、1回の呼び出しにまとめる）
+- 一時的なエラーは共通の再試行の方針（common.retry）で再試行（SDK側の自動再試行は無効）
+- プロバイダーの障害中は、サーキットブレーカー（common.circuit_breaker）で呼び出しを遮断し、
+  別のプロバイダーに振り替えられる（divert_receipt）
+"""
+
+import asyncio
+import base64
+import os
+import time
+
+import anthropic
+import google.generativeai as genai
+import google.generativeai.client as genai_client
+import openai
+import PIL.Image
+from dotenv import load_dotenv
+
+from common.circuit_breaker import call_provider, call_provider_async, get_breaker
+from common.prompt_cache import (
+    anthropic_messages,
+    anthropic_system,
+    gemini_contents,
+    openai_messages,
+    response_cache_tokens,
+    static_prefix,
+)
+from common.results_store import file_hash
+from common.singleflight import coalesce_async, request_key
+from common.structured_output import (
+    anthropic_tool,
+    anthropic_tool_choice,
+    gemini_generation_config,
+    max_output_tokens,
+    openai_response_format,
+    parse_anthropic_response,
+    parse_gemini_response,
+    parse_openai_response,
+    response_output_tokens,
+)
+
+# 環境変数を読み込む
+load_dotenv()
+
+# プロバイダーごとのAPIキーの環境変数名
+API_KEY_NAMES = {
+    "openai": "OPENAI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+}
+
+# 100万トークンあたりの料金（米ドル。入力, 出力）
+PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "claude-3-opus-20240229": (15.00, 75.00),
+    "claude-3-haiku-20240307": (0.25, 1.25),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-pro": (1.25, 5.00),
+}
+
+# 遮断中のプロバイダーの振り替え先のモデルと、振り替え先に選ぶ順番
+FALLBACK_MODELS = {
+    "openai": "gpt-4o",
+    "anthropic": "claude-3-opus-20240229",
+    "gemini": "gemini-1.5-flash",
+}
+FALLBACK_ORDER = ["gemini", "openai", "anthropic"]
+
+# 作成済みのクライアント（プロバイダー名 → クライアント）と Gemini のモデル（モデル名 → モデル）
+clients = {}
+# 非同期クライアント（(プロバイダー名, イベントループ) → クライアント）
+async_clients = {}
+gemini_models = {}
+
+
+def is_configured(provider):
+    """プロバイダーのAPIキーが設定されているかどうかを返す関数"""
+    return bool(os.getenv(API_KEY_NAMES[provider]))
+
+
+def get_client(provider):
+    """プロバイダーのクライアントを返す関数（最初の呼び出しで作成する）"""
+    if provider not in clients:
+        api_key = os.getenv(API_KEY_NAMES[provider])
+        if provider == "openai":
+            clients[provider] = openai.OpenAI(api_key=api_key, max_retries=0)
+        elif provider == "anthropic":
+            clients[provider] = anthropic.Anthropic(api_key=api_key, max_retries=0)
+        else:
+            genai.configure(api_key=api_key)
+            clients[provider] = genai
+    return clients[provider]
+
+
+def get_async_client(provider):
+    """プロバイダーの非同期クライアントを返す関数（Gemini はモデルの非同期メソッドを使うため genai を返す）
+
+    非同期クライアントの接続は作成したイベントループでしか使えないため、実行中のイベントループごとに作成する。
+    asyncio.run を呼び出すたびにイベントループが変わるため、終了する前に close_async_clients で閉じる。
+    """
+    key = (provider, asyncio.get_running_loop())
+    if key not in async_clients:
+        api_key = os.getenv(API_KEY_NAMES[provider])
+        if provider == "openai":
+            async_clients[key] = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+        elif provider == "anthropic":
+            async_clients[key] = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0)
+        else:
+            async_clients[key] = get_client("gemini")
+    return async_clients[key]
+
+
+async def close_async_clients():
+    """実行中のイベントループで作成した非同期クライアントを閉じる関数（asyncio.run の処理の最後に呼び出す）"""
+    loop = asyncio.get_running_loop()
+    for key in [key for key in async_clients if key[1] is loop]:
+        client = async_clients.pop(key)
+        if key[0] != "gemini":
+            await client.close()
+    # Gemini の SDK は非同期クライアントを1つだけ保存して使い回すため、次のイベントループでは作り直させる
+    genai_client._client_manager.clients.pop("generative_async", None)
+
+
+def get_gemini_model(model):
+    """Geminiのモデルを返す関数（静的なプレフィックスをシステム指示に指定する）"""
+    get_client("gemini")
+    if model not in gemini_models:
+        gemini_models[model] = genai.GenerativeModel(model, system_instruction=static_prefix())
+    return gemini_models[model]
+
+
+def encode_image(image_path):
+    """画像をbase64エンコードする関数"""
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+
+def openai_request(model, image_path):
+    """OpenAIのリクエストの引数を返す関数"""
+    return dict(
+        model=model,
+        messages=openai_messages(f"data:image/jpeg;base64,{encode_image(image_path)}"),
+        max_tokens=max_output_tokens(),
+        response_format=openai_response_format(),
+    )
+
+
+def anthropic_request(model, image_path):
+    """Claudeのリクエストの引数を返す関数"""
+    return dict(
+        model=model,
+        max_tokens=max_output_tokens(),
+        system=anthropic_system(),
+        messages=anthropic_messages(encode_image(image_path)),
+        tools=[anthropic_tool()],
+        tool_choice=anthropic_tool_choice(),
+    )
+
+
+def extract_openai(model, image_path):
+    """OpenAIのモデルでレシートを抽出し、(結果, 応答) を返す関数"""
+    response = get_client("openai").chat.completions.create(**openai_request(model, image_path))
+    return parse_openai_response(response), response
+
+
+def extract_anthropic(model, image_path):
+    """Claudeのモデルでレシートを抽出し、(結果, 応答) を返す関数"""
+    message = get_client("anthropic").messages.create(**anthropic_request(model, image_path))
+    return parse_anthropic_response(message), message
+
+
+def extract_gemini(model, image_path):
+    """Geminiのモデルでレシートを抽出し、(結果, 応答) を返す関数"""
+    with PIL.Image.open(image_path) as image:
+        response = get_gemini_model(model).generate_content(
+            gemini_contents(image), generation_config=gemini_generation_config())
+    return parse_gemini_response(response), response
+
+
+async def extract_openai_async(model, image_path):
+    """extract_openai の非同期版"""
+    response = await get_async_client("openai").chat.completions.create(**openai_request(model, image_path))
+    return parse_openai_response(response), response
+
+
+async def extract_anthropic_async(model, image_path):
+    """extract_anthropic の非同期版"""
+    message = await get_async_client("anthropic").messages.create(**anthropic_request(model, image_path))
+    return parse_anthropic_response(message), message
+
+
+async def extract_gemini_async(model, image_path):
+    """extract_gemini の非同期版"""
+    with PIL.Image.open(image_path) as image:
+        response = await get_gemini_model(model).generate_content_async(
+            gemini_contents(image), generation_config=gemini_generation_config())
+    return parse_gemini_response(response), response
+
+
+EXTRACTORS = {
+    "openai": extract_openai,
+    "anthropic": extract_anthropic,
+    "gemini": extract_gemini,
+}
+
+ASYNC_EXTRACTORS = {
+    "openai": extract_openai_async,
+    "anthropic": extract_anthropic_async,
+    "gemini": extract_gemini_async,
+}
+
+
+def estimate_cost(model, input_tokens, output_tokens):
+    """トークン数から料金（米ドル）を見積もる関数（料金表にないモデルやトークン数が不明な場合は None）"""
+    if model not in PRICES or input_tokens is None or output_tokens is None:
+        return None
+    input_price, output_price = PRICES[model]
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def extract_receipt(provider, model, image_path, retry=True):
+    """指定したモデルでレシートを抽出する関数
+
+    :param str provider: プロバイダー名（openai / anthropic / gemini）
+    :param str model: モデル名
+    :param image_path: 画像ファイルのパス
+    :param bool retry: 一時的なエラーの場合に、同じモデルで再試行するかどうか（サーキットブレーカーも使用する）
+    :returns: provider, model, result（抽出結果）, input_tokens, output_tokens, elapsed（秒）, cost（米ドル）を持つ辞書
+    :rtype: dict
+    :raises structured_output.ParseError: 応答を結果の形式に変換できない場合
+    :raises circuit_breaker.CircuitOpenError: プロバイダーへの呼び出しを遮断している場合
+    """
+    start_time = time.perf_counter()
+    if retry:
+        result, response = call_provider(provider, EXTRACTORS[provider], model, str(image_path))
+    else:
+        result, response = EXTRACTORS[provider](model, str(image_path))
+    return make_extraction(provider, model, result, response, time.perf_counter() - start_time)
+
+
+async def extract_receipt_async(provider, model, image_path, retry=True):
+    """extract_receipt の非同期版
+
+    同じ画像（内容が同じファイル）を同じモデルで同時に抽出する場合は、1回の呼び出しにまとめ、同じ結果を返す。
+    タスクをキャンセルすると、送信中のリクエストも中断される（同じ画像の結果を待っている他のタスクがない場合）
+    """
+    key = request_key("receipt", provider, model, retry, file_hash(image_path))
+    return await coalesce_async(key, send_receipt_async, provider, model, image_path, retry)
+
+
+async def send_receipt_async(provider, model, image_path, retry):
+    """extract_receipt_async のリクエストを送る関数（シングルフライトで1回にまとめる単位）"""
+    start_time = time.perf_counter()
+    if retry:
+        result, response = await call_provider_async(provider, ASYNC_EXTRACTORS[provider], model, str(image_path))
+    else:
+        result, response = await ASYNC_EXTRACTORS[provider](model, str(image_path))
+    return make_extraction(provider, model, result, response, time.perf_counter() - start_time)
+
+
+def make_extraction(provider, model, result, response, elapsed):
+    """抽出結果と応答の usage から、extract_receipt の戻り値の辞書を作る関数"""
+    input_tokens = response_cache_tokens(response).get("input_tokens")
+    output_tokens = response_output_tokens(response)
+    return {
+        "provider": provider,
+        "model": model,
+        "result": result,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "elapsed": elapsed,
+        "cost": estimate_cost(model, input_tokens, output_tokens),
+    }
+
+
+def divert_receipt(provider, image_path):
+    """遮断中のプロバイダーの代わりに、別のプロバイダーでレシートを抽出する関数
+
+    :param str provider: 遮断中のプロバイダー名
+    :param image_path: 画像ファイルのパス
+    :returns: 抽出結果（振り替え先がない場合や、振り替え先でもエラーになった場合は None）
+    :rtype: dict
+    """
+    for fallback in FALLBACK_ORDER:
+        if fallback == provider or not is_configured(fallback):
+            continue
+        try:
+            extraction = extract_receipt(fallback, FALLBACK_MODELS[fallback], image_path)
+        except Exception as e:
+            print(f"（{fallback}に振り替えましたが、エラーが発生しました: {e}）")
+            continue
+        get_breaker(provider).diverted += 1
+        print(f"（{provider}は障害のため遮断中です。{fallback}で抽出しました）")
+        return extraction["result"]
+    print(f"エラー: {provider}は障害のため遮断中で、振り替え先のプロバイダーもありません")
+    return None
@@ -0,0 +1,240 @@
+"""
+ルールベースでレシートの項目を抽出するモジュール
+
+このモジュールは、OCRのテキストから以下の情報を正規表現とキーワードで抽出し、
+それぞれに確信度（0.0〜1.0）を付けて返します：
+- 登録番号（T + 13桁の数字）
+- 購入店名
+- 総支払額（「合計」などのラベルに続く金額）
+- 消費税額（「消費税」などのラベルに続く金額）
+
+特徴：
+- 正規表現はモジュール読み込み時に一度だけコンパイル
+- 全角数字や全角記号にも対応
+- 購入店名は「加盟店名」などのラベルの値や、電話番号・登録番号のすぐ上の行を確信度の高い候補にする
+- 確信度の高い項目はLLMに問い合わせずに済ませられる
+"""
+
+import re
+
+# 抽出対象の項目とプロンプトでの説明
+FIELD_DESCRIPTIONS = {
+    "登録番号": "登録番号（登録番号もしくは事業者登録番号）",
+    "購入店": "購入店名",
+    "総支払額": "総支払額",
+    "消費税額": "消費税額",
+}
+
+# JSONの出力例に使う値
+FIELD_EXAMPLES = {
+    "登録番号": "番号",
+    "購入店": "店名",
+    "総支払額": "金額",
+    "消費税額": "金額",
+}
+
+# この確信度以上の項目はLLMに問い合わせない
+CONFIDENCE_THRESHOLD = 0.8
+
+# 全角の数字・記号を半角に変換するテーブル
+ZENKAKU_TABLE = str.maketrans(
+    "０１２３４５６７８９，．－Ｔ￥：",
+    "0123456789,.-T¥:",
+)
+
+REGISTRATION_PATTERN = re.compile(r"T\s*-?\s*((?:\d[\s-]?){12}\d)(?!\d)")
+REGISTRATION_LABEL_PATTERN = re.compile(r"登録番号|事業者登録")
+
+# 通貨記号付き、または「円」付きの金額
+AMOUNT_PATTERN = re.compile(
+    r"[¥\\]\s*(\d{1,3}(?:,\d{3})+|\d+)(?![\d%])"
+    r"|(\d{1,3}(?:,\d{3})+|\d+)\s*円"
+)
+
+# 「小計」を除いた合計金額のラベル（優先度の高い順）
+TOTAL_LABEL_PATTERNS = [
+    re.compile(r"合計金額|お支払(?:金額|合計)|領収金額|総額"),
+    re.compile(r"(?<!小)合\s*計"),
+]
+TAX_LABEL_PATTERN = re.compile(r"消費税|内税|税額")
+
+# 店名らしい行の手がかり
+STORE_PATTERN = re.compile(r"\S*(?:店|ストア|ショップ|株式会社|\(株\)|商店)\S*")
+
+# 店名のラベル（クレジットカードの売上票の「加盟店名」など）。値は同じ行か次の行に印字される
+STORE_LABEL_PATTERN = re.compile(r"^(?:加盟店|店舗|店)名\s*:?\s*(.*)$")
+
+# 店名の下に印字される電話番号の行
+PHONE_PATTERN = re.compile(r"TEL|電話|\d{2,4}-\d{2,4}-\d{4}")
+
+# 店名を探すレシート上部の行数と、店名の行から電話番号・登録番号の行までの行数
+STORE_HEADER_LINES = 8
+STORE_HEADER_GAP = 2
+
+
+def normalize_text(text):
+    """全角の数字・記号を半角に変換する関数"""
+    return text.translate(ZENKAKU_TABLE)
+
+
+def find_amount(line):
+    """行の中で最後に現れる金額を数字だけの文字列で返す関数"""
+    matches = AMOUNT_PATTERN.findall(line)
+    if not matches:
+        return None
+    yen_mark, yen_unit = matches[-1]
+    return (yen_mark or yen_unit).replace(",", "")
+
+
+def find_labeled_amounts(lines, label_pattern):
+    """ラベルに続く金額を (金額, 確信度) のリストで返す関数
+
+    ラベルと同じ行にある金額は確信度を高く、次の行にある金額は低くします。
+    """
+    candidates = []
+    for i, line in enumerate(lines):
+        match = label_pattern.search(line)
+        if not match:
+            continue
+        amount = find_amount(line[match.end():])
+        if amount is not None:
+            candidates.append((amount, 0.9))
+        elif i + 1 < len(lines):
+            amount = find_amount(lines[i + 1])
+            if amount is not None:
+                candidates.append((amount, 0.6))
+    return candidates
+
+
+def pick_candidate(candidates):
+    """候補の中から値を選び、候補どうしの一致具合で確信度を調整する関数"""
+    if not candidates:
+        return None, 0.0
+    values = {value for value, _ in candidates}
+    value, confidence = max(candidates, key=lambda c: c[1])
+    if len(values) > 1:
+        # 候補が食い違う場合はLLMに任せる
+        confidence = min(confidence, 0.5)
+    elif len(candidates) > 1:
+        # 複数の箇所で同じ値が見つかった場合は確信度を上げる
+        confidence = round(min(confidence + 0.05, 0.99), 2)
+    return value, confidence
+
+
+def extract_registration_number(lines):
+    """登録番号（T + 13桁）を抽出する関数"""
+    candidates = []
+    for line in lines:
+        for match in REGISTRATION_PATTERN.finditer(line):
+            number = "T" + re.sub(r"[\s-]", "", match.group(1))
+            has_label = REGISTRATION_LABEL_PATTERN.search(line) is not None
+            candidates.append((number, 0.95 if has_label else 0.85))
+    return pick_candidate(candidates)
+
+
+def find_labeled_store(lines):
+    """「加盟店名」などのラベルに続く店名を (店名, 確信度) で返す関数（ない場合は None）"""
+    for i, line in enumerate(lines):
+        match = STORE_LABEL_PATTERN.search(line)
+        if not match:
+            continue
+        value = match.group(1).strip()
+        if not value and i + 1 < len(lines):
+            value = lines[i + 1]
+        if value and not PHONE_PATTERN.search(value):
+            return value, 0.85
+    return None
+
+
+def find_header_store(lines):
+    """レシート上部の店名らしい行を (店名, 確信度) で返す関数（ない場合は None）
+
+    すぐ下の行に電話番号か登録番号が印字されている場合は、店名の行として確信度を高くします。
+    """
+    # 店名はレシート上部に印字されることが多いため、上から順に探す
+    header = lines[:STORE_HEADER_LINES]
+    for i, line in enumerate(header):
+        match = STORE_PATTERN.search(line)
+        if not match or STORE_LABEL_PATTERN.search(line) or REGISTRATION_LABEL_PATTERN.search(line) \
+                or PHONE_PATTERN.search(line):
+            continue
+        following = lines[i + 1:i + 1 + STORE_HEADER_GAP]
+        if any(PHONE_PATTERN.search(next_line) or REGISTRATION_PATTERN.search(next_line) for next_line in following):
+            return " ".join(line.split()), 0.85
+        return match.group(0), 0.5
+    return None
+
+
+def extract_store_name(lines):
+    """店名を抽出する関数
+
+    ラベル付きの店名と、電話番号・登録番号の上の行の店名は確信度を高くし、
+    両方が見つかって一致する（上部の店名がラベル付きの店名に含まれる）場合はさらに高くします。
+    """
+    labeled = find_labeled_store(lines)
+    header = find_header_store(lines)
+    if labeled and header:
+        if header[0].replace(" ", "") in labeled[0].replace(" ", ""):
+            return labeled[0], 0.95
+        # 食い違う場合はLLMに任せる
+        return max(labeled, header, key=lambda c: c[1])[0], 0.5
+    return labeled or header or (None, 0.0)
+
+
+def extract_total(lines):
+    """総支払額を抽出する関数"""
+    for label_pattern in TOTAL_LABEL_PATTERNS:
+        candidates = find_labeled_amounts(lines, label_pattern)
+        if candidates:
+            return pick_candidate(candidates)
+    return None, 0.0
+
+
+def extract_tax(lines):
+    """消費税額を抽出する関数"""
+    return pick_candidate(find_labeled_amounts(lines, TAX_LABEL_PATTERN))
+
+
+def extract_fields(text):
+    """OCRのテキストから各項目を抽出する関数
+
+    :param str text: OCRのテキスト（行ごとに改行で区切られたもの）
+    :returns: 項目名をキーとし、value と confidence を持つ辞書
+    :rtype: dict
+    """
+    lines = [line.strip() for line in normalize_text(text or "").splitlines() if line.strip()]
+
+    extractors = {
+        "登録番号": extract_registration_number,
+        "購入店": extract_store_name,
+        "総支払額": extract_total,
+        "消費税額": extract_tax,
+    }
+    fields = {}
+    for name, extractor in extractors.items():
+        value, confidence = extractor(lines)
+        fields[name] = {"value": value, "confidence": confidence}
+
+    # 消費税額が総支払額以上になることはないため、矛盾があれば両方の確信度を下げる
+    total = fields["総支払額"]["value"]
+    tax = fields["消費税額"]["value"]
+    if total is not None and tax is not None and int(tax) >= int(total):
+        fields["総支払額"]["confidence"] = min(fields["総支払額"]["confidence"], 0.5)
+        fields["消費税額"]["confidence"] = min(fields["消費税額"]["confidence"], 0.5)
+
+    return fields
+
+
+def confident_fields(fields, threshold=CONFIDENCE_THRESHOLD):
+    """確信度が閾値以上の項目だけを {項目名: 値} の辞書で返す関数"""
+    return {
+        name: field["value"]
+        for name, field in fields.items()
+        if field["value"] is not None and field["confidence"] >= threshold
+    }
+
+
+def missing_fields(fields, threshold=CONFIDENCE_THRESHOLD):
+    """ルールで確定できなかった項目名のリストを返す関数"""
+    confident = confident_fields(fields, threshold)
+    return [name for name in FIELD_DESCRIPTIONS if name not in confident]
@@ -0,0 +1,282 @@
+"""
+適格請求書発行事業者の登録番号をオフラインで検証するモジュール
+
+このモジュールは、LLMが抽出した登録番号（T + 13桁の数字）を、ネットワークに接続せずに検証します。
+
+検証の内容：
+1. 形式（T + 13桁の数字。全角・空白・ハイフンは正規化してから判定）
+2. チェックディジット（先頭の1桁。法人番号と同じ計算方法）
+3. 国税庁の公表サイトからダウンロードした登録簿（全件データのCSV）への登録の有無
+
+特徴：
+- 登録簿は、ソート済みの整数配列（.npy）としてメモリマップで開き、二分探索で検索
+  （ファイル全体を読み込まないため、数百万件の登録簿でもすぐに使える）
+- 二分探索の前にブルームフィルターで判定し、登録されていない番号の多くはディスクを読まずに除外
+- 複数の番号をまとめて検証する処理はNumPyでベクトル化
+
+使用方法：
+python -m common.registration_validator build <登録簿のCSV...>  （登録簿のインデックスを作成）
+python -m common.registration_validator check <登録番号...>
+python -m common.registration_validator --benchmark [登録簿の件数] [検証する件数]
+"""
+
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from common.receipt_rules import normalize_text
+
+# 登録簿のインデックスを保存するディレクトリ（プロジェクトのルートディレクトリの registry）
+REGISTRY_DIR = Path(__file__).resolve().parent.parent / "registry"
+REGISTRY_FILE_NAME = "invoice_registry.npy"
+BLOOM_FILE_NAME = "invoice_registry_bloom.npy"
+
+# ブルームフィルターの設定（1件あたり10ビット・ハッシュ関数7個で、誤判定率は約1%）
+BLOOM_BITS_PER_ITEM = 10
+BLOOM_HASHES = 7
+
+# 一度にハッシュを計算する件数（作業用のメモリ使用量を抑える）
+HASH_CHUNK_SIZE = 1_000_000
+
+# 検証結果
+VALID = "OK"
+INVALID_FORMAT = "形式エラー"
+INVALID_CHECK_DIGIT = "チェックディジット不一致"
+NOT_REGISTERED = "登録簿に該当なし"
+UNCHECKED = "未確認（登録簿なし）"
+
+NUMBER_PATTERN = re.compile(r"^T(\d{13})$")
+
+# 登録簿のCSVから登録番号を取り出すパターン
+REGISTRY_PATTERN = re.compile(r"T(\d{13})")
+
+# チェックディジットの計算で、2〜13桁目に掛ける重み（下の桁から 1, 2, 1, 2, ...）
+CHECK_WEIGHTS = np.array([2, 1] * 6, dtype=np.int64)
+
+
+def normalize_number(value):
+    """登録番号を「T + 13桁」の形式に正規化する関数（形式が正しくない場合は None）"""
+    if not isinstance(value, str):
+        return None
+    text = re.sub(r"[\s\-－]", "", normalize_text(value)).upper()
+    return text if NUMBER_PATTERN.match(text) else None
+
+
+def check_digit(digits):
+    """13桁の数字（2次元の配列。1列目はチェックディジット）の正しいチェックディジットを計算する関数"""
+    return 9 - (digits[:, 1:] @ CHECK_WEIGHTS) % 9
+
+
+def mix64(values):
+    """64ビット整数のハッシュ関数（splitmix64）"""
+    z = values + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def bloom_positions(values, bit_count):
+    """ブルームフィルターのビット位置（件数 × ハッシュ関数の数）を計算する関数"""
+    h1 = mix64(values)
+    h2 = mix64(h1) | np.uint64(1)
+    steps = np.arange(BLOOM_HASHES, dtype=np.uint64)
+    return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(bit_count)
+
+
+def build_bloom(numbers):
+    """登録番号（整数の配列）からブルームフィルターのビット列を作成する関数"""
+    # 検索時はバイト数 × 8 をビット数とするため、8の倍数に切り上げる
+    bit_count = -(-max(len(numbers) * BLOOM_BITS_PER_ITEM, 64) // 8) * 8
+    bits = np.zeros(bit_count, dtype=bool)
+    for start in range(0, len(numbers), HASH_CHUNK_SIZE):
+        bits[bloom_positions(numbers[start:start + HASH_CHUNK_SIZE], bit_count).ravel()] = True
+    return np.packbits(bits, bitorder="little")
+
+
+def read_registry_csv(paths, encoding="utf-8"):
+    """登録簿のCSVファイルから登録番号を取り出し、整数の配列で返す関数
+
+    国税庁の全件データのCSVを想定していますが、列の位置には依存せず、
+    「T + 13桁」の文字列をすべて取り出します。
+    """
+    chunks = []
+    for path in paths:
+        with open(path, "r", encoding=encoding, errors="replace") as file:
+            for lines in iter(lambda: file.readlines(HASH_CHUNK_SIZE * 16), []):
+                found = REGISTRY_PATTERN.findall("".join(lines))
+                if found:
+                    chunks.append(np.array(found, dtype=np.uint64))
+    if not chunks:
+        return np.zeros(0, dtype=np.uint64)
+    return np.concatenate(chunks)
+
+
+def build_registry(numbers, registry_dir=REGISTRY_DIR):
+    """登録番号の配列から、ソート済みの配列とブルームフィルターを作成して保存する関数
+
+    :param numbers: 登録番号（Tを除いた13桁の整数）の配列
+    :param registry_dir: 保存先のディレクトリ
+    :returns: 保存した登録番号の件数（重複を除く）
+    :rtype: int
+    """
+    registry_dir = Path(registry_dir)
+    registry_dir.mkdir(parents=True, exist_ok=True)
+    numbers = np.unique(np.asarray(numbers, dtype=np.uint64))
+    np.save(registry_dir / REGISTRY_FILE_NAME, numbers)
+    np.save(registry_dir / BLOOM_FILE_NAME, build_bloom(numbers))
+    return len(numbers)
+
+
+class InvoiceRegistry:
+    """メモリマップで開いた登録簿"""
+
+    def __init__(self, registry_dir=REGISTRY_DIR):
+        registry_dir = Path(registry_dir)
+        self.numbers = np.load(registry_dir / REGISTRY_FILE_NAME, mmap_mode="r")
+        self.bloom = np.load(registry_dir / BLOOM_FILE_NAME)
+        self.bit_count = len(self.bloom) * 8
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __contains__(self, number):
+        return bool(self.contains(np.array([number], dtype=np.uint64))[0])
+
+    def might_contain(self, values):
+        """ブルームフィルターで判定する（False なら確実に登録されていない）"""
+        positions = bloom_positions(values, self.bit_count)
+        bits = (self.bloom[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def contains(self, values):
+        """登録番号（整数の配列）が登録簿にあるかどうかを真偽値の配列で返す"""
+        values = np.asarray(values, dtype=np.uint64)
+        found = np.zeros(len(values), dtype=bool)
+        candidates = np.flatnonzero(self.might_contain(values))
+        if len(candidates) == 0 or len(self.numbers) == 0:
+            return found
+
+        # ブルームフィルターを通過した番号だけを二分探索で確認する
+        targets = values[candidates]
+        positions = np.searchsorted(self.numbers, targets)
+        positions = np.minimum(positions, len(self.numbers) - 1)
+        found[candidates] = self.numbers[positions] == targets
+        return found
+
+
+def load_registry(registry_dir=REGISTRY_DIR):
+    """登録簿を開く関数（インデックスが作成されていない場合は None）"""
+    registry_dir = Path(registry_dir)
+    if not (registry_dir / REGISTRY_FILE_NAME).exists() or not (registry_dir / BLOOM_FILE_NAME).exists():
+        return None
+    return InvoiceRegistry(registry_dir)
+
+
+def validate_numbers(values, registry=None):
+    """登録番号をまとめて検証し、検証結果のリストを返す関数
+
+    :param list values: 登録番号（文字列）のリスト
+    :param InvoiceRegistry registry: 登録簿（省略時は形式とチェックディジットだけを検証）
+    :returns: 検証結果（VALID, INVALID_FORMAT など）のリスト
+    :rtype: list
+    """
+    normalized = [normalize_number(value) for value in values]
+    statuses = np.full(len(values), INVALID_FORMAT, dtype=object)
+    ids = np.array([i for i, number in enumerate(normalized) if number is not None], dtype=np.int64)
+    if len(ids) == 0:
+        return statuses.tolist()
+
+    # 13桁の数字を (件数, 13) の配列にしてチェックディジットを計算する
+    text = "".join(normalized[i][1:] for i in ids).encode("ascii")
+    digits = (np.frombuffer(text, dtype=np.uint8) - ord("0")).reshape(-1, 13).astype(np.int64)
+    check_ok = digits[:, 0] == check_digit(digits)
+    statuses[ids[~check_ok]] = INVALID_CHECK_DIGIT
+
+    ids = ids[check_ok]
+    if registry is None:
+        statuses[ids] = UNCHECKED
+        return statuses.tolist()
+
+    numbers = digits[check_ok] @ (10 ** np.arange(12, -1, -1, dtype=np.int64))
+    registered = registry.contains(numbers.astype(np.uint64))
+    statuses[ids[registered]] = VALID
+    statuses[ids[~registered]] = NOT_REGISTERED
+    return statuses.tolist()
+
+
+def validate_results(results, registry=None, column="登録番号の検証"):
+    """結果（辞書のリスト）の登録番号を検証し、検証結果の項目を追加する関数
+
+    エラーの結果には項目を追加しません（登録番号がない結果は形式エラーとします）。
+    """
+    targets = [r for r in results if "error" not in r]
+    for result, status in zip(targets, validate_numbers([r.get("登録番号") for r in targets], registry)):
+        result[column] = status
+    return results
+
+
+def make_valid_numbers(count, seed=0):
+    """ベンチマーク用に、チェックディジットが正しい登録番号（整数の配列）を作成する関数"""
+    rng = np.random.default_rng(seed)
+    digits = np.zeros((count, 13), dtype=np.int64)
+    digits[:, 1:] = rng.integers(0, 10, size=(count, 12))
+    digits[:, 0] = check_digit(digits)
+    return digits @ (10 ** np.arange(12, -1, -1, dtype=np.int64))
+
+
+def benchmark(registry_count, check_count):
+    """登録簿の作成時間と、まとめて検証する処理時間を計測する関数"""
+    print(f"{registry_count:,}件の登録簿を作成しています...")
+    numbers = make_valid_numbers(registry_count)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start_time = time.perf_counter()
+        build_registry(numbers, temp_dir)
+        print(f"登録簿の作成時間: {time.perf_counter() - start_time:.2f}秒")
+
+        registry = InvoiceRegistry(temp_dir)
+        # 登録済みの番号と、チェックディジットは正しいが未登録の番号を半分ずつ検証する
+        registered = numbers[:check_count // 2]
+        unknown = make_valid_numbers(check_count - len(registered), seed=1)
+        values = [f"T{n:013d}" for n in np.concatenate([registered, unknown])]
+
+        start_time = time.perf_counter()
+        statuses = validate_numbers(values, registry)
+        elapsed = time.perf_counter() - start_time
+        print(f"{len(values):,}件の検証時間: {elapsed * 1000:.1f}ミリ秒")
+        print(f"  {VALID}: {statuses.count(VALID):,}件、{NOT_REGISTERED}: {statuses.count(NOT_REGISTERED):,}件")
+
+        passed = registry.might_contain(unknown.astype(np.uint64)).sum()
+        print(f"ブルームフィルターを通過した未登録の番号: {passed:,}件（{passed / max(len(unknown), 1):.1%}）")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("使用方法: python -m common.registration_validator build <登録簿のCSV...>")
+        print("          python -m common.registration_validator check <登録番号...>")
+        print("          python -m common.registration_validator --benchmark [登録簿の件数] [検証する件数]")
+        return
+
+    command = sys.argv[1]
+    if command == "--benchmark":
+        registry_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000_000
+        check_count = int(sys.argv[3]) if len(sys.argv) > 3 else 10_000
+        benchmark(registry_count, check_count)
+    elif command == "build":
+        count = build_registry(read_registry_csv(sys.argv[2:]))
+        print(f"{count:,}件の登録番号で登録簿のインデックスを作成しました: {REGISTRY_DIR}")
+    elif command == "check":
+        registry = load_registry()
+        if registry is None:
+            print(f"警告: 登録簿のインデックスがありません（{REGISTRY_DIR}）。形式とチェックディジットだけを検証します")
+        for value, status in zip(sys.argv[2:], validate_numbers(sys.argv[2:], registry)):
+            print(f"{value}: {status}")
+    else:
+        print(f"エラー: 不明なコマンドです: {command}")
+
+
+if __name__ == "__main__":
+    main()
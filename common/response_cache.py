@@ -0,0 +1,248 @@
+"""
+同じ入力への応答を再利用する、完全一致の応答キャッシュのモジュール（LRU + 有効期限）
+
+このモジュールは、正規化した入力・プロバイダー・モデル・プロンプトのテンプレートが同じリクエストの応答を
+保存しておき、次に同じリクエストが来たときはAPIを呼び出さずに保存した応答を返します。
+占いのように、同じ名前への問い合わせが繰り返し届く用途で、呼び出しの回数と待ち時間を減らします。
+
+特徴：
+- 保存する件数の上限（MAX_ENTRIES）を超えたら、最も長く使われていない応答から削除（LRU）
+- 有効期限（TTL_SECONDS）を過ぎた応答は使わない
+- ファイル（JSON）に保存し、次の実行でも使える（保存先を指定した場合のみ。終了時に保存）
+- 保存するときはファイルの内容と合わせる（同じキーは新しい応答を残す。ロックファイルで同時の書き込みを防ぐ）
+- LangChain のキャッシュ（set_llm_cache）としても使える（LangChainCache）
+- ヒット率と、APIを呼び出さずに済んだ時間（元の呼び出しにかかった時間の合計）を表示
+
+キーは common.singleflight.request_key で作成します（全角・半角と空白の違いをそろえる）。
+
+使用方法（保存したキャッシュの件数と有効期限の表示）：
+python -m common.response_cache
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+from common.singleflight import request_key
+
+# キャッシュの保存先
+CACHE_PATH = Path(__file__).resolve().parent.parent / "cache" / "response_cache.json"
+
+# 保存する応答の件数の上限
+MAX_ENTRIES = 5000
+
+# 応答の有効期限（秒）
+TTL_SECONDS = 24 * 60 * 60
+
+# 保存するときのロックファイルを待つ時間（秒。これより古いロックファイルは残ったものとみなして削除する）
+LOCK_TIMEOUT = 10
+
+# 応答キャッシュの集計
+response_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "saved_seconds": 0.0}
+
+
+class ResponseCache:
+    """キー → 応答の LRU キャッシュ（有効期限付き）
+
+    応答はJSONに変換できる値（文字列・辞書など）で保存します。
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS, path=None, save_at_exit=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if path is not None:
+            self.load()
+            if save_at_exit:
+                atexit.register(self.save)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """保存した応答を返す（ない場合や有効期限を過ぎた場合は None）"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["stored_at"] > self.ttl:
+                del self.entries[key]
+                response_cache_stats["expired"] += 1
+                entry = None
+            if entry is None:
+                response_cache_stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            response_cache_stats["hits"] += 1
+            response_cache_stats["saved_seconds"] += entry["elapsed"]
+            return entry["value"]
+
+    def put(self, key, value, elapsed=0.0):
+        """応答を保存する（elapsed は応答を得るのにかかった時間。ヒットしたときに節約した時間として数える）"""
+        with self.lock:
+            self.entries[key] = {"value": value, "stored_at": time.time(), "elapsed": elapsed}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                response_cache_stats["evicted"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def read_file(self):
+        """ファイルに保存した応答のうち、有効期限内のものを返す"""
+        if not self.path.exists():
+            return {}
+        now = time.time()
+        data = json.loads(self.path.read_text(encoding="utf-8"))
+        return {key: entry for key, entry in data.items() if now - entry["stored_at"] <= self.ttl}
+
+    def load(self):
+        """ファイルに保存した応答のうち、有効期限内のものを読み込む"""
+        self.entries.update(self.read_file())
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """応答をファイルに保存する（一時ファイルに書いてから置き換える）
+
+        同じファイルを使う別のプロセスが先に保存した応答を消さないように、
+        ロックファイルを作ってからファイルの内容を読み直し、この実行の応答と合わせて書き込みます
+        （同じキーは保存した時刻の新しい応答を残す）。
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lock_path = self.path.with_suffix(".lock")
+        acquire_lock(lock_path)
+        try:
+            merged = OrderedDict(self.read_file())
+            with self.lock:
+                for key, entry in self.entries.items():
+                    old = merged.pop(key, None)
+                    merged[key] = old if old is not None and old["stored_at"] > entry["stored_at"] else entry
+            while len(merged) > self.max_entries:
+                merged.popitem(last=False)
+            temp_path = self.path.with_suffix(".tmp")
+            temp_path.write_text(json.dumps(merged, ensure_ascii=False), encoding="utf-8")
+            temp_path.replace(self.path)
+        finally:
+            lock_path.unlink(missing_ok=True)
+
+
+def acquire_lock(lock_path, timeout=LOCK_TIMEOUT):
+    """ロックファイルを作成する関数（別のプロセスが作成している間は待つ）"""
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return
+        except FileExistsError:
+            try:
+                if time.time() - lock_path.stat().st_mtime > timeout:
+                    # 異常終了したプロセスが残したロックファイルは削除する
+                    lock_path.unlink(missing_ok=True)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.05)
+
+
+def cache_key(provider, model, template, user_input):
+    """プロバイダー・モデル・プロンプトのテンプレート・入力からキャッシュのキーを作る関数"""
+    return request_key(provider, model, template, user_input)
+
+
+def cached_call(cache, key, function, *args, **kwargs):
+    """保存した応答があればそれを返し、なければ関数を呼び出して応答を保存する関数
+
+    :param ResponseCache cache: 応答キャッシュ
+    :param str key: キャッシュのキー（cache_key の戻り値）
+    :param function: APIを呼び出す関数（戻り値はJSONに変換できる値）
+    :returns: 応答
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+    start_time = time.perf_counter()
+    value = function(*args, **kwargs)
+    cache.put(key, value, time.perf_counter() - start_time)
+    return value
+
+
+class LangChainCache(BaseCache):
+    """ResponseCache を LangChain のキャッシュとして使うためのクラス
+
+    set_llm_cache(LangChainCache(cache)) で設定すると、チェーンの中のモデルの呼び出しに使われます。
+    キーは LangChain が渡すプロンプト（テンプレートに入力を埋め込んだもの）と、
+    モデルの設定（プロバイダーのクラス・モデル名・temperature など）から作成します。
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        # キャッシュになかったキー → 呼び出しを始めた時刻（保存するときに、かかった時間を計算する）
+        self.started = {}
+
+    def key(self, prompt, llm_string):
+        """プロンプトとモデルの設定からキーを作る"""
+        try:
+            # チャットモデルのプロンプトはメッセージのJSON（\uXXXX の形）のため、文字列に戻してから正規化する
+            prompt = json.loads(prompt)
+        except ValueError:
+            pass
+        return request_key(llm_string, prompt)
+
+    def lookup(self, prompt, llm_string):
+        key = self.key(prompt, llm_string)
+        value = self.cache.get(key)
+        if value is None:
+            self.started[key] = time.perf_counter()
+            return None
+        with warnings.catch_warnings():
+            # loads はベータ版の関数のため、警告を表示しない
+            warnings.simplefilter("ignore")
+            return [loads(generation) for generation in value]
+
+    def update(self, prompt, llm_string, return_val):
+        key = self.key(prompt, llm_string)
+        start_time = self.started.pop(key, None)
+        elapsed = time.perf_counter() - start_time if start_time is not None else 0.0
+        self.cache.put(key, [dumps(generation) for generation in return_val], elapsed)
+
+    def clear(self, **kwargs):
+        self.cache.clear()
+
+
+def print_response_cache_stats():
+    """応答キャッシュのヒット率と、APIを呼び出さずに済んだ時間を表示する関数"""
+    stats = response_cache_stats
+    lookups = stats["hits"] + stats["misses"]
+    if not lookups:
+        return
+    print(f"\n応答キャッシュ: {lookups}件中 {stats['hits']}件ヒット（ヒット率 {stats['hits'] / lookups:.1%}）、"
+          f"節約した待ち時間 {stats['saved_seconds']:.1f}秒")
+    if stats["expired"] or stats["evicted"]:
+        print(f"有効期限切れ: {stats['expired']}件、上限を超えて削除: {stats['evicted']}件")
+
+
+def main():
+    if not CACHE_PATH.exists():
+        print(f"保存したキャッシュがありません: {CACHE_PATH}")
+        return
+    # 表示するだけのため、終了時に保存しない
+    cache = ResponseCache(path=CACHE_PATH, save_at_exit=False)
+    print(f"{CACHE_PATH}: 有効期限内の応答 {len(cache)}件（上限 {MAX_ENTRIES}件、有効期限 {TTL_SECONDS // 3600}時間）")
+    if cache.entries:
+        oldest = min(entry["stored_at"] for entry in cache.entries.values())
+        print(f"最も古い応答の保存日時: {datetime.fromtimestamp(oldest).isoformat(timespec='seconds')}")
+
+
+if __name__ == "__main__":
+    main()
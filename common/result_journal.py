@@ -0,0 +1,69 @@
+"""
+処理結果をJSON Lines形式で記録するモジュール（結果ジャーナル）
+
+このモジュールは、レシート1件の処理が終わるたびに結果を1行のJSONとして
+ファイルに追記します。大量の画像を処理する場合でも結果をメモリにため込まず、
+途中でエラーが発生してもそれまでの結果が残ります。
+
+特徴：
+- 1件ごとに追記（receipt_results.jsonl）
+- 結果の一覧でまとめて作り直すことも可能（出力ファイルをジャーナルから作成する場合）
+- 読み込みはジェネレーターで1行ずつ（メモリ使用量は件数によらず一定）
+- 指定した件数ごとにまとめて読み込むことも可能（列単位の正規化用）
+"""
+
+import json
+from pathlib import Path
+
+JOURNAL_FILE_NAME = "receipt_results.jsonl"
+
+
+def start_journal(results_dir):
+    """空のジャーナルファイルを作成し、そのパスを返す関数"""
+    journal_path = Path(results_dir) / JOURNAL_FILE_NAME
+    journal_path.write_text("", encoding="utf-8")
+    return journal_path
+
+
+def append_journal(journal_path, result):
+    """結果（辞書）を1行のJSONとしてジャーナルに追記する関数"""
+    with open(journal_path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def write_journal(results_dir, rows):
+    """ジャーナルを rows の結果で作り直し、そのパスを返す関数"""
+    journal_path = start_journal(results_dir)
+    with open(journal_path, "a", encoding="utf-8") as file:
+        for row in rows:
+            file.write(json.dumps(row, ensure_ascii=False) + "\n")
+    return journal_path
+
+
+def iter_journal(journal_path):
+    """ジャーナルの結果を1件ずつ返すジェネレーター"""
+    with open(journal_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_chunks(rows, chunk_size):
+    """結果を chunk_size 件ずつのリストにまとめて返すジェネレーター"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def collect_columns(rows):
+    """結果に現れる項目名を、現れた順に重複なく返す関数"""
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+    return list(columns)
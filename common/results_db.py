@@ -0,0 +1,240 @@
+"""
+処理結果をSQLiteデータベースに保存し、集計するモジュール
+
+このモジュールは、レシートの抽出結果をSQLiteのデータベース（receipt_results.db）に保存し、
+よく使う集計（店ごとの一覧、登録番号ごとの消費税額の合計、月ごとの合計など）を
+コマンドラインから実行できるようにします。
+
+特徴：
+- 登録番号・購入店・処理日時・ファイルハッシュにインデックスを作成（全件走査を避ける）
+- WALモードで複数のプロセスから同時に書き込める
+- ファイルハッシュをキーとした追加・更新（upsert）
+- 金額は整数（INTEGER）で保存（金額の正規化エンジンを使用）
+
+期間の指定（--quarter / --from / --to）と月ごとの集計（monthly）は、処理日時（レシートを処理した日時）で
+まとめます。レシートに印字された日付ではありません（抽出結果にレシートの日付の項目がないため）。
+
+使用方法：
+python -m common.results_db <DBファイル> store <店名> [--quarter 2025Q1 | --from 日付 --to 日付]
+python -m common.results_db <DBファイル> tax [--quarter 2025Q1 | --from 日付 --to 日付]
+python -m common.results_db <DBファイル> monthly
+python -m common.results_db <DBファイル> file <ファイルハッシュ>
+python -m common.results_db <DBファイル> import <resultsディレクトリ>
+（--explain を付けると、SQLiteの実行計画も表示します）
+"""
+
+import argparse
+import sqlite3
+from datetime import date, datetime
+
+from common.amount_normalizer import INT, normalize_results
+from common.parquet_output import TIMESTAMP_COLUMN
+from common.result_journal import iter_journal
+from common.results_store import HASH_COLUMN, PARTITION_FILE_NAME, ResultsStore
+
+DB_FILE_NAME = "receipt_results.db"
+
+# 他のプロセスが書き込み中の場合に待つ時間（ミリ秒）
+BUSY_TIMEOUT = 5000
+
+COLUMNS = [HASH_COLUMN, "登録番号", "購入店", "総支払額", "消費税額", "ファイル名", TIMESTAMP_COLUMN]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS receipts (
+    "{HASH_COLUMN}" TEXT PRIMARY KEY,
+    "登録番号" TEXT,
+    "購入店" TEXT,
+    "総支払額" INTEGER,
+    "消費税額" INTEGER,
+    "ファイル名" TEXT,
+    "{TIMESTAMP_COLUMN}" TEXT
+);
+-- ファイルハッシュは主キーのため、インデックスが自動的に作成される
+-- 登録番号ごとの集計は、消費税額まで含めたインデックスだけで計算できる
+CREATE INDEX IF NOT EXISTS idx_receipts_registration ON receipts ("登録番号", "消費税額");
+CREATE INDEX IF NOT EXISTS idx_receipts_store ON receipts ("購入店", "{TIMESTAMP_COLUMN}");
+CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts ("{TIMESTAMP_COLUMN}", "総支払額", "消費税額");
+"""
+
+UPSERT_SQL = f"""
+INSERT INTO receipts ({", ".join(f'"{c}"' for c in COLUMNS)})
+VALUES ({", ".join("?" for _ in COLUMNS)})
+ON CONFLICT ("{HASH_COLUMN}") DO UPDATE SET
+{", ".join(f'"{c}" = excluded."{c}"' for c in COLUMNS[1:])}
+"""
+
+QUERIES = {
+    "store": f"""
+        SELECT "{TIMESTAMP_COLUMN}", "ファイル名", "登録番号", "総支払額", "消費税額"
+        FROM receipts
+        WHERE "購入店" = ? AND "{TIMESTAMP_COLUMN}" >= ? AND "{TIMESTAMP_COLUMN}" < ?
+        ORDER BY "{TIMESTAMP_COLUMN}"
+    """,
+    "tax": """
+        SELECT "登録番号", COUNT(*), SUM("消費税額")
+        FROM receipts
+        WHERE "登録番号" IS NOT NULL
+        GROUP BY "登録番号"
+        ORDER BY "登録番号"
+    """,
+    "tax_range": f"""
+        SELECT "登録番号", COUNT(*), SUM("消費税額")
+        FROM receipts
+        WHERE "登録番号" IS NOT NULL AND "{TIMESTAMP_COLUMN}" >= ? AND "{TIMESTAMP_COLUMN}" < ?
+        GROUP BY "登録番号"
+        ORDER BY "登録番号"
+    """,
+    "monthly": f"""
+        SELECT substr("{TIMESTAMP_COLUMN}", 1, 7) AS month, COUNT(*), SUM("総支払額"), SUM("消費税額")
+        FROM receipts
+        GROUP BY month
+        ORDER BY month
+    """,
+    "file": f"""
+        SELECT {", ".join(f'"{c}"' for c in COLUMNS)}
+        FROM receipts
+        WHERE "{HASH_COLUMN}" = ?
+    """,
+}
+
+
+def connect(db_path):
+    """データベースに接続し、WALモードの設定とテーブル・インデックスの作成を行う関数"""
+    connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT / 1000)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def to_rows(results, timestamp=None):
+    """結果（辞書のリスト）を、データベースに書き込む行（タプル）のリストに変換する関数
+
+    ファイルハッシュのない結果とエラーの結果は書き込みません。
+    """
+    timestamp = (timestamp or datetime.now()).isoformat(sep=" ", timespec="seconds")
+    results = [r for r in results if r.get(HASH_COLUMN) and "error" not in r]
+    rows = []
+    for result in normalize_results(results, INT):
+        result.setdefault(TIMESTAMP_COLUMN, timestamp)
+        # 結果ストアの処理日時（2025-01-01T10:00:00）も同じ形式にそろえる
+        result[TIMESTAMP_COLUMN] = str(result[TIMESTAMP_COLUMN]).replace("T", " ")
+        rows.append(tuple(result.get(column) for column in COLUMNS))
+    return rows
+
+
+def upsert_results(connection, results, timestamp=None):
+    """結果をファイルハッシュをキーとして追加・更新し、書き込んだ件数を返す関数"""
+    rows = to_rows(results, timestamp)
+    with connection:
+        connection.executemany(UPSERT_SQL, rows)
+    return len(rows)
+
+
+def save_results_db(results, results_dir):
+    """結果を resultsディレクトリのデータベースに保存し、データベースのパスを返す関数"""
+    db_path = results_dir / DB_FILE_NAME
+    connection = connect(db_path)
+    try:
+        upsert_results(connection, results)
+    finally:
+        connection.close()
+    return db_path
+
+
+def import_store(connection, results_dir):
+    """結果ストア（common.results_store）のすべての結果をデータベースに取り込む関数"""
+    store = ResultsStore(results_dir)
+    count = 0
+    for partition in store.partitions():
+        path = store.partition_dir(partition) / PARTITION_FILE_NAME
+        count += upsert_results(connection, list(iter_journal(path)))
+    return count
+
+
+def quarter_range(quarter):
+    """「2025Q1」のような四半期を、開始日と終了日（翌四半期の初日）に変換する関数（処理日時の範囲として使う）"""
+    year, number = quarter.upper().split("Q")
+    year, number = int(year), int(number)
+    if not 1 <= number <= 4:
+        raise ValueError(f"四半期の指定が正しくありません: {quarter}")
+    start = date(year, 3 * number - 2, 1)
+    end = date(year + 1, 1, 1) if number == 4 else date(year, 3 * number + 1, 1)
+    return start.isoformat(), end.isoformat()
+
+
+def date_range(args):
+    """コマンドライン引数から期間（開始日, 終了日）を求める関数。指定がなければ None"""
+    if args.quarter:
+        return quarter_range(args.quarter)
+    if args.date_from or args.date_to:
+        return args.date_from or "0000-01-01", args.date_to or "9999-12-31"
+    return None
+
+
+def run_query(connection, name, params=(), explain=False):
+    """集計用のSQLを実行し、結果の行を返す関数"""
+    sql = QUERIES[name]
+    if explain:
+        for row in connection.execute("EXPLAIN QUERY PLAN " + sql, params):
+            print(f"[実行計画] {row[-1]}")
+    return connection.execute(sql, params).fetchall()
+
+
+def print_rows(headers, rows):
+    """集計結果を表示する関数"""
+    print("\t".join(headers))
+    for row in rows:
+        print("\t".join("" if value is None else str(value) for value in row))
+    print(f"（{len(rows)}件）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="レシートの結果データベースを集計します")
+    parser.add_argument("db_path", help="データベースファイル")
+    parser.add_argument("--explain", action="store_true", help="SQLiteの実行計画を表示する")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    store_parser = subparsers.add_parser("store", help="購入店のレシートの一覧")
+    store_parser.add_argument("store_name")
+    tax_parser = subparsers.add_parser("tax", help="登録番号ごとの消費税額の合計")
+    for range_parser in (store_parser, tax_parser):
+        range_parser.add_argument("--quarter", help="処理日時の四半期（例: 2025Q1）")
+        range_parser.add_argument("--from", dest="date_from", help="処理日時の開始日（例: 2025-01-01）")
+        range_parser.add_argument("--to", dest="date_to", help="処理日時の終了日（この日を含まない）")
+    subparsers.add_parser("monthly", help="処理日時の月ごとの件数と合計（レシートの日付ではありません）")
+    file_parser = subparsers.add_parser("file", help="ファイルハッシュで結果を検索")
+    file_parser.add_argument("hash_value")
+    import_parser = subparsers.add_parser("import", help="結果ストアの結果を取り込む")
+    import_parser.add_argument("results_dir")
+
+    args = parser.parse_args()
+    connection = connect(args.db_path)
+    try:
+        if args.command == "store":
+            start, end = date_range(args) or ("0000-01-01", "9999-12-31")
+            rows = run_query(connection, "store", (args.store_name, start, end), args.explain)
+            print_rows([TIMESTAMP_COLUMN, "ファイル名", "登録番号", "総支払額", "消費税額"], rows)
+        elif args.command == "tax":
+            period = date_range(args)
+            if period:
+                rows = run_query(connection, "tax_range", period, args.explain)
+            else:
+                rows = run_query(connection, "tax", explain=args.explain)
+            print_rows(["登録番号", "件数", "消費税額の合計"], rows)
+        elif args.command == "monthly":
+            rows = run_query(connection, "monthly", explain=args.explain)
+            print_rows(["月", "件数", "総支払額の合計", "消費税額の合計"], rows)
+        elif args.command == "file":
+            rows = run_query(connection, "file", (args.hash_value,), args.explain)
+            print_rows(COLUMNS, rows)
+        elif args.command == "import":
+            count = import_store(connection, args.results_dir)
+            print(f"{count}件の結果を取り込みました")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
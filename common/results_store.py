@@ -0,0 +1,224 @@
+"""
+処理結果を画像ファイルの内容のハッシュで管理する結果ストアのモジュール
+
+このモジュールは、各サンプルの save_results のように毎回すべての結果を上書きするのではなく、
+画像ファイルの内容のハッシュ（SHA-256）をキーとして結果を追加・更新（upsert）します。
+
+特徴：
+- 処理済みの画像（内容が同じファイル）はハッシュで判定し、再抽出を省略できる
+- 結果は最初に処理した月ごとのパーティション（store/月=YYYY-MM/）に保存
+- 新しい結果は追加、内容が変わった結果だけを置き換え
+- 金額は整数にそろえて保存・比較する（金額を「1234円」で出力するモジュールと整数で出力するモジュールが
+  同じストアを使っても、同じレシートを内容が変わったと判定しない）
+- CSV / Excel は変更のあったパーティションだけを作り直す
+- 処理済みのためスキップした画像を含めたフォルダー全体の結果を返せる（folder_results）
+
+使用方法（パーティションの一覧と件数の表示）：
+python -m common.results_store <resultsディレクトリ>
+"""
+
+import hashlib
+import json
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from common.amount_normalizer import INT, normalize_results
+from common.excel_export import write_excel
+from common.parquet_output import MONTH_COLUMN, TIMESTAMP_COLUMN
+from common.result_journal import collect_columns, iter_journal
+
+HASH_COLUMN = "ファイルハッシュ"
+
+STORE_DIR_NAME = "store"
+INDEX_FILE_NAME = "index.json"
+PARTITION_FILE_NAME = "results.jsonl"
+EXPORT_FILE_NAME = "receipt_results"
+
+# ハッシュを計算するときに一度に読み込むバイト数
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """ファイルの内容のSHA-256ハッシュを返す関数"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def same_result(old, new):
+    """処理日時を除いて2つの結果が同じかどうかを返す関数"""
+    ignore = {TIMESTAMP_COLUMN}
+    return {k: v for k, v in old.items() if k not in ignore} == \
+        {k: v for k, v in new.items() if k not in ignore}
+
+
+class ResultsStore:
+    """ファイルハッシュをキーとする結果ストア"""
+
+    def __init__(self, results_dir):
+        self.store_dir = Path(results_dir) / STORE_DIR_NAME
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.store_dir / INDEX_FILE_NAME
+        if self.index_path.exists():
+            self.index = json.loads(self.index_path.read_text(encoding="utf-8"))
+        else:
+            # ハッシュ → パーティション名（YYYY-MM）
+            self.index = {}
+
+    def __contains__(self, hash_value):
+        return hash_value in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def partition_dir(self, partition):
+        """パーティションのディレクトリを返す"""
+        return self.store_dir / f"{MONTH_COLUMN}={partition}"
+
+    def load_partition(self, partition):
+        """パーティションの結果をハッシュをキーとする辞書で読み込む"""
+        path = self.partition_dir(partition) / PARTITION_FILE_NAME
+        if not path.exists():
+            return {}
+        return {row[HASH_COLUMN]: row for row in iter_journal(path)}
+
+    def save_partition(self, partition, rows):
+        """パーティションの結果を書き込む（一時ファイルに書いてから置き換える）"""
+        directory = self.partition_dir(partition)
+        directory.mkdir(exist_ok=True)
+        path = directory / PARTITION_FILE_NAME
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            for row in rows.values():
+                file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        temp_path.replace(path)
+
+    def save_index(self):
+        """ハッシュとパーティションの対応を保存する"""
+        temp_path = self.index_path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(self.index, ensure_ascii=False), encoding="utf-8")
+        temp_path.replace(self.index_path)
+
+    def upsert(self, results, timestamp=None):
+        """結果を追加・更新し、変更のあったパーティションのCSV / Excelを作り直す
+
+        :param list results: ファイルハッシュ（HASH_COLUMN）を含む結果（辞書）のリスト
+        :param datetime timestamp: 処理日時（省略時は現在時刻）
+        :returns: added, replaced, unchanged, skipped（件数）と partitions（作り直したパーティション）を持つ辞書
+        :rtype: dict
+        """
+        timestamp = timestamp or datetime.now()
+        summary = {"added": 0, "replaced": 0, "unchanged": 0, "skipped": 0, "partitions": []}
+
+        # パーティションごとに新しい結果をまとめる
+        changes = {}
+        targets = []
+        for result in results:
+            if not result.get(HASH_COLUMN) or "error" in result:
+                # エラーの結果は保存しない（次回の実行で再処理する）
+                summary["skipped"] += 1
+                continue
+            targets.append(result)
+        for row in normalize_results(targets, INT):
+            hash_value = row[HASH_COLUMN]
+            row.setdefault(TIMESTAMP_COLUMN, timestamp.isoformat(timespec="seconds"))
+            partition = self.index.get(hash_value) or timestamp.strftime("%Y-%m")
+            changes.setdefault(partition, []).append(row)
+
+        for partition, rows in changes.items():
+            stored = self.load_partition(partition)
+            # 以前に「1234円」の形式で保存した結果も整数にそろえてから比較する
+            stored = {row[HASH_COLUMN]: row for row in normalize_results(list(stored.values()), INT)}
+            changed = False
+            for row in rows:
+                old = stored.get(row[HASH_COLUMN])
+                if old is None:
+                    summary["added"] += 1
+                elif same_result(old, row):
+                    summary["unchanged"] += 1
+                    continue
+                else:
+                    summary["replaced"] += 1
+                stored[row[HASH_COLUMN]] = row
+                self.index[row[HASH_COLUMN]] = partition
+                changed = True
+
+            if changed:
+                self.save_partition(partition, stored)
+                self.export_partition(partition, stored)
+                summary["partitions"].append(partition)
+
+        self.save_index()
+        return summary
+
+    def export_partition(self, partition, rows=None):
+        """パーティションのCSV / Excelを作成し、Excelファイルのパスを返す"""
+        rows = list((rows if rows is not None else self.load_partition(partition)).values())
+        columns = collect_columns(rows)
+        directory = self.partition_dir(partition)
+        pd.DataFrame(rows, columns=columns).to_csv(
+            directory / f"{EXPORT_FILE_NAME}.csv", index=False, encoding="utf-8-sig")
+        excel_path = directory / f"{EXPORT_FILE_NAME}.xlsx"
+        write_excel(rows, excel_path, columns)
+        return excel_path
+
+    def folder_results(self, hash_values, results=()):
+        """フォルダーの画像の結果を、画像の順に返す
+
+        処理済みのためスキップした画像も含めてフォルダー全体のCSV / Excelを作り直すために、
+        保存した結果（upsert の後に呼び出すこと）を返し、保存していない画像（エラーになった画像）は
+        results の中の同じハッシュの結果を返します。
+
+        :param list hash_values: フォルダーの画像のファイルハッシュのリスト
+        :param list results: この実行の結果（辞書のリスト）
+        :returns: 結果（辞書）のリスト
+        :rtype: list
+        """
+        run_results = {result.get(HASH_COLUMN): result for result in results}
+        loaded = {}
+        rows = []
+        for hash_value in hash_values:
+            partition = self.index.get(hash_value)
+            if partition is None:
+                if hash_value in run_results:
+                    rows.append(run_results[hash_value])
+                continue
+            if partition not in loaded:
+                loaded[partition] = self.load_partition(partition)
+            rows.append(loaded[partition][hash_value])
+        return rows
+
+    def partitions(self):
+        """パーティション名と件数の辞書を返す"""
+        counts = {}
+        for partition in self.index.values():
+            counts[partition] = counts.get(partition, 0) + 1
+        return dict(sorted(counts.items()))
+
+
+def print_upsert_summary(summary):
+    """upsert の結果を表示する関数"""
+    print(f"結果ストア: 追加 {summary['added']}件、更新 {summary['replaced']}件、"
+          f"変更なし {summary['unchanged']}件、保存対象外 {summary['skipped']}件")
+    if summary["partitions"]:
+        print(f"作り直したパーティション: {', '.join(summary['partitions'])}")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("使用方法: python -m common.results_store <resultsディレクトリ>")
+        return
+
+    store = ResultsStore(sys.argv[1])
+    print(f"結果ストア: {store.store_dir}（{len(store)}件）")
+    for partition, count in store.partitions().items():
+        print(f"  {MONTH_COLUMN}={partition}: {count}件")
+
+
+if __name__ == "__main__":
+    main()
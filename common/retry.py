@@ -0,0 +1,204 @@
+"""
+APIの呼び出しを一時的なエラーのときに再試行する、共通の再試行のモジュール
+
+このモジュールは、OpenAI・Claude・Gemini・Google Cloud Vision（requests）の呼び出しを
+再試行の方針にそって実行します。レート制限（429）やサーバーの一時的なエラーで
+レシートの処理をあきらめず、待ってから送り直します。
+
+再試行の方針：
+- エラーは文字列ではなく、例外の型とHTTPステータスで「再試行できる」「再試行しない」に分類する
+  - 再試行できる：408・429・500・502・503・504・529、接続エラー、タイムアウト
+  - 再試行しない：400・401・403・404・422 などのエラー、応答の解析の失敗、ファイルがない場合
+- 待ち時間は指数バックオフ（フルジッター）：0 〜 min(MAX_DELAY, BASE_DELAY × 2^回数) の一様乱数
+- 応答に Retry-After（retry-after-ms）ヘッダーがある場合は、その時間だけ待つ
+- 1回の実行で再試行できる回数の合計（再試行の予算）を超えたら、それ以上は再試行しない
+
+特徴：
+- 同期版（call_with_retry）と非同期版（call_with_retry_async）を用意
+- 再試行の回数、待った時間の合計、エラーの種類ごとの回数を表示（print_retry_stats）
+- SDKの自動再試行とは重ならないように、このモジュールを使う呼び出しではSDK側の再試行を無効にする
+"""
+
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import anthropic
+import openai
+import requests
+
+# 1回の呼び出しで送信する回数の上限（最初の送信を含む）
+MAX_ATTEMPTS = 5
+
+# 指数バックオフの基準の待ち時間と上限（秒）
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+# Retry-After で指定された待ち時間の上限（秒）
+MAX_RETRY_AFTER = 120.0
+
+# 1回の実行で再試行できる回数の合計（再試行の予算）
+RETRY_BUDGET = 50
+
+# 再試行できるHTTPステータス（529 は Claude の過負荷）
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504, 529}
+
+# ステータスのない、再試行できるエラー（接続エラー・タイムアウト）
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,
+    anthropic.APIConnectionError,
+    requests.ConnectionError,
+    requests.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+# 再試行の集計
+retry_stats = {
+    "calls": 0,
+    "retries": 0,
+    "recovered": 0,
+    "gave_up": 0,
+    "budget_exhausted": 0,
+    "fatal": 0,
+    "backoff_seconds": 0.0,
+    "reasons": {},
+}
+
+
+def error_status(error):
+    """エラーのHTTPステータスを返す関数（ない場合は None）"""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        # google.api_core の例外は code にHTTPステータスを持つ
+        code = getattr(error, "code", None)
+        status = code if isinstance(code, int) else None
+    return status
+
+
+def is_retryable(error):
+    """一時的なエラー（再試行できるエラー）かどうかを返す関数"""
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def is_rate_limit_error(error):
+    """レート制限（HTTP 429 / ResourceExhausted）のエラーかどうかを返す関数"""
+    return error_status(error) == 429
+
+
+def error_reason(error):
+    """集計に使うエラーの種類（HTTPステータスか例外の型の名前）を返す関数"""
+    status = error_status(error)
+    return f"HTTP {status}" if status is not None else type(error).__name__
+
+
+def retry_after_seconds(error):
+    """エラーの応答の Retry-After ヘッダーの秒数を返す関数（ない場合は None）"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after-ms")) / 1000
+    except (TypeError, ValueError):
+        pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # 日時で指定されている場合は、その日時までの秒数
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error):
+    """再試行するまでの待ち時間（秒）を返す関数（attempt は 0 から数えた再試行の回数）"""
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return min(retry_after, MAX_RETRY_AFTER)
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def next_delay(attempt, error):
+    """エラーを記録し、再試行する場合は待ち時間（秒）を、再試行しない場合は None を返す関数"""
+    stats = retry_stats
+    if not is_retryable(error):
+        stats["fatal"] += 1
+        return None
+    if attempt + 1 >= MAX_ATTEMPTS:
+        stats["gave_up"] += 1
+        return None
+    if stats["retries"] >= RETRY_BUDGET:
+        stats["budget_exhausted"] += 1
+        return None
+
+    delay = backoff_delay(attempt, error)
+    reason = error_reason(error)
+    stats["retries"] += 1
+    stats["backoff_seconds"] += delay
+    stats["reasons"][reason] = stats["reasons"].get(reason, 0) + 1
+    print(f"（{reason} のため {delay:.1f}秒後に再試行します: {attempt + 1}/{MAX_ATTEMPTS - 1}回目）")
+    return delay
+
+
+def call_with_retry(function, *args, **kwargs):
+    """関数を呼び出し、一時的なエラーの場合は待ってから再試行する関数
+
+    :param function: APIを呼び出す関数
+    :returns: 関数の戻り値
+    :raises Exception: 再試行しないエラーの場合や、再試行の上限・予算に達した場合は、最後のエラー
+    """
+    retry_stats["calls"] += 1
+    attempt = 0
+    while True:
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            delay = next_delay(attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+        if attempt:
+            retry_stats["recovered"] += 1
+        return result
+
+
+async def call_with_retry_async(function, *args, **kwargs):
+    """call_with_retry の非同期版（function はコルーチン関数）"""
+    retry_stats["calls"] += 1
+    attempt = 0
+    while True:
+        try:
+            result = await function(*args, **kwargs)
+        except Exception as e:
+            delay = next_delay(attempt, e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        if attempt:
+            retry_stats["recovered"] += 1
+        return result
+
+
+def print_retry_stats():
+    """再試行の回数と、待った時間の合計を表示する関数"""
+    stats = retry_stats
+    if not stats["retries"] and not stats["gave_up"] and not stats["budget_exhausted"]:
+        return
+    print(f"\n再試行: {stats['calls']}件の呼び出しで {stats['retries']}回再試行"
+          f"（予算 {RETRY_BUDGET}回）、待った時間の合計 {stats['backoff_seconds']:.1f}秒")
+    print(f"再試行で成功: {stats['recovered']}件、上限に達してあきらめた: {stats['gave_up']}件、"
+          f"予算の超過: {stats['budget_exhausted']}件、再試行しないエラー: {stats['fatal']}件")
+    for reason, count in sorted(stats["reasons"].items()):
+        print(f"  {reason}: {count}回")
@@ -0,0 +1,150 @@
+"""
+書き方が少し違うだけの入力にも応答を再利用する、ローカルの意味キャッシュのモジュール
+
+このモジュールは、「山田太郎」「山田 太郎さんを占って」「私は山田太郎です」のように、
+同じ名前を違う書き方で入力した場合にも、保存した応答を返します。
+完全一致の応答キャッシュ（common.response_cache）では、これらは別の入力として扱われます。
+
+仕組み：
+- 入力を正規化（全角・半角、大文字・小文字、空白・記号をそろえ、「さんを占って」などの定型の言い回しを除く）
+- 正規化した入力をキーとして、辞書で応答を検索する
+  （1文字だけ違う別の名前は、書き方が似ていても別の入力として扱う。
+  文字の n-gram の類似度では「Christopher」と「Christophe」のような別の名前を区別できないため使わない）
+
+特徴：
+- 外部の埋め込みモデルやAPIを使わず、オフラインで動作する
+- プロバイダー・モデル・プロンプトのテンプレートごとに別々に検索する（scope）
+- 保存する件数の上限（MAX_ENTRIES）を超えたら、最も長く使われていない応答から削除（LRU）し、
+  有効期限（TTL_SECONDS）を過ぎた応答は使わない
+- ヒット率と、書き方の違う入力でヒットした件数、節約した待ち時間を表示
+
+使用方法（2つの入力を同じ入力として扱うかどうかの表示）：
+python -m common.semantic_cache <入力1> <入力2>
+"""
+
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from common.singleflight import request_key
+
+# 保存する応答の件数の上限
+MAX_ENTRIES = 5000
+
+# 応答の有効期限（秒）
+TTL_SECONDS = 24 * 60 * 60
+
+# 名前の前後に付く定型の言い回し（意味の比較に使わない）
+FILLER_PATTERN = re.compile(
+    "|".join([
+        r"(さん|様|さま|君|くん|ちゃん)?(の(名前|運勢))?を?占って(ください|下さい|ほしい|欲しい)?",
+        r"(の(名前|運勢))(は|を)?(どう|どうですか|教えて(ください)?)?",
+        r"^(私|わたし|僕|ぼく|俺|おれ)(の名前)?は",
+        r"^(名前|氏名)は",
+        r"(です|といいます|と言います|と申します|でございます)$",
+        r"(お願いします|おねがいします|お願い)$",
+        r"(さん|様|さま|君|くん|ちゃん)$",
+    ])
+)
+
+# 意味キャッシュの集計
+semantic_cache_stats = {"lookups": 0, "hits": 0, "near_hits": 0, "saved_seconds": 0.0}
+
+
+def canonical_text(text):
+    """比較のために入力を正規化する関数"""
+    text = unicodedata.normalize("NFKC", str(text)).casefold()
+    # 空白と記号を除く
+    text = "".join(char for char in text if unicodedata.category(char)[0] not in "ZPS")
+    # 定型の言い回しは、除いた結果に別の言い回しが残ることがあるため、変わらなくなるまで繰り返す
+    previous = None
+    while previous != text:
+        previous = text
+        text = FILLER_PATTERN.sub("", text)
+    return text
+
+
+def cache_scope(provider, model, template):
+    """検索の範囲（プロバイダー・モデル・プロンプトのテンプレート）のキーを作る関数"""
+    return request_key(provider, model, template)
+
+
+class SemanticCache:
+    """正規化した入力で応答を検索するキャッシュ（LRU + 有効期限）"""
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (検索の範囲, 正規化した入力) → 応答
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, scope, text):
+        """正規化した入力が一致する入力の応答を返す（ない場合や有効期限を過ぎた場合は None）"""
+        key = (scope, canonical_text(text))
+        with self.lock:
+            semantic_cache_stats["lookups"] += 1
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["stored_at"] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            semantic_cache_stats["hits"] += 1
+            semantic_cache_stats["saved_seconds"] += entry["elapsed"]
+            if entry["text"] != text:
+                semantic_cache_stats["near_hits"] += 1
+            return entry["value"]
+
+    def put(self, scope, text, value, elapsed=0.0):
+        """応答を保存する（elapsed は応答を得るのにかかった時間）"""
+        key = (scope, canonical_text(text))
+        with self.lock:
+            self.entries[key] = {"text": text, "value": value, "stored_at": time.time(), "elapsed": elapsed}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def semantic_call(cache, scope, text, function, *args, **kwargs):
+    """正規化すると同じになる入力の応答があればそれを返し、なければ関数を呼び出して応答を保存する関数
+
+    :param SemanticCache cache: 意味キャッシュ
+    :param str scope: 検索の範囲（cache_scope の戻り値）
+    :param str text: 比較に使う入力
+    :param function: APIを呼び出す関数
+    :returns: 応答
+    """
+    value = cache.get(scope, text)
+    if value is not None:
+        return value
+    start_time = time.perf_counter()
+    value = function(*args, **kwargs)
+    cache.put(scope, text, value, time.perf_counter() - start_time)
+    return value
+
+
+def print_semantic_cache_stats():
+    """意味キャッシュのヒット率と、節約した待ち時間を表示する関数"""
+    stats = semantic_cache_stats
+    if not stats["lookups"]:
+        return
+    print(f"\n意味キャッシュ: {stats['lookups']}件中 {stats['hits']}件ヒット"
+          f"（ヒット率 {stats['hits'] / stats['lookups']:.1%}、うち書き方の違う入力 {stats['near_hits']}件）、"
+          f"節約した待ち時間 {stats['saved_seconds']:.1f}秒")
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("使用方法: python -m common.semantic_cache <入力1> <入力2>")
+        return
+    text, other = canonical_text(sys.argv[1]), canonical_text(sys.argv[2])
+    print(f"正規化した入力: {text!r} / {other!r}")
+    print("同じ入力として扱います" if text == other else "別の入力として扱います")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+同じ内容のリクエストが同時に送られた場合に、1回の呼び出しにまとめるモジュール（シングルフライト）
+
+このモジュールは、リクエストの内容から作ったキーが同じ呼び出しが実行中の場合、
+新しい呼び出しは送らずに実行中の呼び出しの完了を待ち、同じ結果を返します。
+占いのチャットを共有のサービスとして動かした場合に多くの人が同時に同じ名前を入力したときや、
+一括処理で同じレシートの画像が同時に送られたときに、APIの呼び出しを1回にまとめます。
+
+特徴：
+- キーは、全角・半角と空白の違いをそろえたリクエストの内容から作成（request_key）
+- スレッドから使う同期版（coalesce）と、asyncio から使う非同期版（coalesce_async）を用意
+- 実行中の呼び出しがエラーになった場合は、待っていた呼び出しにも同じエラーを発生させる
+- 非同期版では、待っている呼び出しがすべてキャンセルされた場合だけ、実行中の呼び出しもキャンセルする
+- 完了した呼び出しの結果は保存しない（結果を再利用するキャッシュではない）
+- 呼び出しの件数と、まとめた件数を表示（print_singleflight_stats）
+
+※ 結果は待っていたすべての呼び出しで同じオブジェクトのため、変更する場合はコピーしてください。
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+
+# 実行中の呼び出し（キー → Flight / AsyncFlight）
+flights = {}
+async_flights = {}
+flights_lock = threading.Lock()
+
+# シングルフライトの集計
+singleflight_stats = {"calls": 0, "upstream": 0, "shared": 0}
+
+
+class Flight:
+    """実行中の呼び出しと、その結果（スレッド用）"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AsyncFlight:
+    """実行中の呼び出しのタスクと、完了を待っている呼び出しの数（asyncio 用）"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+def normalize_text(text):
+    """キーを作るためにテキストを正規化する関数（全角・半角をそろえ、連続する空白を1つにする）"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(text))).strip()
+
+
+def normalize_value(value):
+    """リクエストの内容に含まれるテキストを、辞書やリストの中も含めて正規化する関数"""
+    if isinstance(value, str):
+        return normalize_text(value)
+    if isinstance(value, dict):
+        return {key: normalize_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+    return value
+
+
+def request_key(*parts):
+    """リクエストの内容（モデル名・プロンプト・入力、リクエストの引数の辞書など）からキーを作る関数"""
+    normalized = json.dumps(normalize_value(parts), ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def coalesce(key, function, *args, **kwargs):
+    """同じキーの呼び出しが実行中ならその結果を待ち、なければ関数を呼び出す関数
+
+    :param str key: リクエストのキー（request_key の戻り値）
+    :param function: APIを呼び出す関数
+    :returns: 関数の戻り値（まとめた呼び出しでは、実行中の呼び出しの戻り値）
+    :raises Exception: 関数（実行中の呼び出し）がエラーになった場合は、そのエラー
+    """
+    with flights_lock:
+        singleflight_stats["calls"] += 1
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = Flight()
+            singleflight_stats["upstream"] += 1
+        else:
+            singleflight_stats["shared"] += 1
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = function(*args, **kwargs)
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight.done.set()
+    return flight.result
+
+
+async def coalesce_async(key, function, *args, **kwargs):
+    """coalesce の非同期版（function はコルーチン関数）"""
+    singleflight_stats["calls"] += 1
+    flight = async_flights.get(key)
+    if flight is None:
+        flight = async_flights[key] = AsyncFlight(asyncio.ensure_future(function(*args, **kwargs)))
+        flight.task.add_done_callback(lambda _: async_flights.pop(key, None))
+        singleflight_stats["upstream"] += 1
+    else:
+        singleflight_stats["shared"] += 1
+
+    flight.waiters += 1
+    try:
+        # 1つの呼び出しがキャンセルされても、他に待っている呼び出しのためにタスクは続ける
+        return await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        if flight.waiters == 1 and not flight.task.done():
+            flight.task.cancel()
+        raise
+    finally:
+        flight.waiters -= 1
+
+
+def print_singleflight_stats():
+    """呼び出しの件数と、実行中の呼び出しにまとめた件数を表示する関数"""
+    stats = singleflight_stats
+    if not stats["shared"]:
+        return
+    print(f"\nシングルフライト: {stats['calls']}件の呼び出しのうち {stats['shared']}件を実行中の呼び出しにまとめました"
+          f"（APIの呼び出し {stats['upstream']}回）")
@@ -0,0 +1,189 @@
+"""
+レシートの抽出結果をストリーミングで受け取り、項目ごとに取り出すモジュール
+
+このモジュールは、各プロバイダーのストリーミング応答（差分のテキスト）を
+インクリメンタルなJSONパーサー（ijson）に渡し、「登録番号」「購入店」などの項目を
+値が確定した時点で1つずつ返します。応答の完了を待たずに、登録番号の検証や
+ルールベースの照合を始められます。
+
+特徴：
+- OpenAI（json_schema）、Claude（ツール使用の input_json）、Gemini（response_schema）に対応
+- 応答全体を待たずに、項目が確定するたびにコールバックを呼び出す
+- 最初の項目が確定するまでの時間と全体の時間を計測し、通常の（ブロッキングの）呼び出しと比較
+"""
+
+import time
+
+import ijson
+
+from common.prompt_cache import cache_tokens, record_cache
+from common.registration_validator import INVALID_CHECK_DIGIT, INVALID_FORMAT, validate_numbers
+from common.structured_output import (
+    COMPACT_KEYS,
+    ParseError,
+    anthropic_tool,
+    anthropic_tool_choice,
+    gemini_generation_config,
+    make_result,
+    openai_response_format,
+    record_parse,
+    record_usage,
+)
+
+# プロバイダーごとの処理時間の記録
+latency_stats = {}
+
+
+class FieldStream:
+    """差分のテキストを受け取り、確定した項目を返すインクリメンタルなJSONパーサー"""
+
+    def __init__(self):
+        self.events = ijson.sendable_list()
+        self.parser = ijson.parse_coro(self.events, use_float=True)
+        self.fields = {}
+
+    def feed(self, text):
+        """差分のテキストを渡し、新たに確定した (項目名, 値) のリストを返す"""
+        if text:
+            self.parser.send(text.encode("utf-8"))
+        return self._collect()
+
+    def close(self):
+        """入力の終わりを伝え、残りの確定した項目を返す"""
+        self.parser.close()
+        return self._collect()
+
+    def _collect(self):
+        completed = []
+        for prefix, event, value in self.events:
+            # 最上位のオブジェクトの値（文字列・数値・null）だけを項目として扱う
+            if prefix and "." not in prefix and event in ("string", "number", "null", "boolean"):
+                self.fields[prefix] = value
+                completed.append((prefix, value))
+        del self.events[:]
+        return completed
+
+
+def openai_deltas(client, compact=False, usage=None, **request):
+    """OpenAIのストリーミング応答から差分のテキストを返すジェネレーター
+
+    usage に辞書を渡すと、最後のチャンクの出力トークン数を output_tokens に、
+    入力トークン数とキャッシュのトークン数（prompt_cache.cache_tokens）を設定します。
+    """
+    stream = client.chat.completions.create(
+        stream=True, stream_options={"include_usage": True},
+        response_format=openai_response_format(compact), **request)
+    for chunk in stream:
+        if chunk.usage is not None and usage is not None:
+            usage["output_tokens"] = chunk.usage.completion_tokens
+            usage.update(cache_tokens(chunk.usage))
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def anthropic_deltas(client, compact=False, usage=None, **request):
+    """Claudeのストリーミング応答（ツール使用の入力JSON）から差分のテキストを返すジェネレーター"""
+    stream = client.messages.create(
+        stream=True, tools=[anthropic_tool(compact)], tool_choice=anthropic_tool_choice(), **request)
+    for event in stream:
+        if event.type == "message_start" and usage is not None:
+            # 入力トークン数とキャッシュの読み書きの数は最初のイベントに含まれる
+            usage.update(cache_tokens(event.message.usage))
+        elif event.type == "message_delta" and usage is not None:
+            usage["output_tokens"] = event.usage.output_tokens
+        elif event.type == "content_block_delta" and event.delta.type == "input_json_delta":
+            yield event.delta.partial_json
+
+
+def gemini_deltas(model, contents, compact=False, usage=None):
+    """Geminiのストリーミング応答から差分のテキストを返すジェネレーター"""
+    response = model.generate_content(
+        contents, generation_config=gemini_generation_config(compact), stream=True)
+    for chunk in response:
+        if chunk.usage_metadata and usage is not None:
+            usage["output_tokens"] = chunk.usage_metadata.candidates_token_count
+            usage.update(cache_tokens(chunk.usage_metadata))
+        # 終了理由だけのチャンクなど、テキストを含まないチャンクは読み飛ばす
+        if chunk.parts:
+            yield chunk.text
+
+
+def print_field(name, value):
+    """確定した項目をすぐに表示し、登録番号はその場で形式とチェックディジットを検証する関数"""
+    print(f"  {name}: {value}")
+    if name == "登録番号" and value is not None:
+        status = validate_numbers([value])[0]
+        if status in (INVALID_FORMAT, INVALID_CHECK_DIGIT):
+            print(f"  警告: 登録番号が正しくありません（{status}）")
+
+
+def record_latency(provider, mode, total, first_field=None):
+    """処理時間を記録する関数（mode は "streaming" または "blocking"）"""
+    stats = latency_stats.setdefault(provider, {"streaming": [], "first_field": [], "blocking": []})
+    stats[mode].append(total)
+    if first_field is not None:
+        stats["first_field"].append(first_field)
+
+
+def extract_streaming(provider, deltas, on_field=None, compact=False, usage=None):
+    """ストリーミング応答から項目を取り出し、結果の形式にまとめる関数
+
+    :param str provider: プロバイダー名（集計用）
+    :param deltas: 差分のテキストを返すイテレーター（openai_deltas など）
+    :param on_field: 項目が確定するたびに (項目名, 値) で呼び出す関数
+    :param bool compact: コンパクトモードの応答かどうか（項目名は日本語に戻して on_field に渡す）
+    :param dict usage: deltas に渡したトークン数の記録用の辞書
+    :returns: structured_output.make_result と同じ形式の辞書
+    :rtype: dict
+    :raises structured_output.ParseError: 応答が結果の形式にならない場合
+    """
+    start_time = time.perf_counter()
+    first_field = None
+    stream = FieldStream()
+    names = {key: name for name, key in COMPACT_KEYS.items()} if compact else {}
+
+    def emit(completed):
+        nonlocal first_field
+        for name, value in completed:
+            if first_field is None:
+                first_field = time.perf_counter() - start_time
+            if on_field:
+                on_field(names.get(name, name), value)
+
+    try:
+        for delta in deltas:
+            emit(stream.feed(delta))
+        emit(stream.close())
+        result = make_result(stream.fields, compact)
+    except (ValueError, ijson.JSONError) as e:
+        record_parse(provider, False)
+        raise ParseError(f"{provider}の応答の解析に失敗しました: {e}") from e
+    record_parse(provider, True)
+
+    elapsed = time.perf_counter() - start_time
+    record_latency(provider, "streaming", elapsed, first_field)
+    record_usage(provider, compact, (usage or {}).get("output_tokens"), elapsed)
+    record_cache(provider, usage)
+    return result
+
+
+def average(values):
+    """平均値を返す関数（値がない場合は None）"""
+    return sum(values) / len(values) if values else None
+
+
+def print_latency_stats():
+    """ストリーミングとブロッキングの処理時間の平均を表示する関数"""
+    for provider, stats in latency_stats.items():
+        print(f"\n[{provider}]")
+        first_field = average(stats["first_field"])
+        streaming = average(stats["streaming"])
+        blocking = average(stats["blocking"])
+        if first_field is not None:
+            print(f"最初の項目までの時間（ストリーミング）: {first_field:.2f}秒")
+        if streaming is not None:
+            print(f"全体の時間（ストリーミング）: {streaming:.2f}秒（{len(stats['streaming'])}件）")
+        if blocking is not None:
+            print(f"全体の時間（ブロッキング）: {blocking:.2f}秒（{len(stats['blocking'])}件）")
+        if first_field is not None and blocking is not None:
+            print(f"最初の項目を受け取るまでに短縮できた時間: {blocking - first_field:.2f}秒")
@@ -0,0 +1,264 @@
+"""
+各プロバイダーの構造化出力（スキーマ指定）でレシートの情報を抽出するためのモジュール
+
+このモジュールは、レシートの抽出結果のスキーマを1か所で定義し、
+各プロバイダーのネイティブな構造化出力の形式に変換します：
+- OpenAI: response_format の json_schema（strict モード）
+- Anthropic: ツール使用（tool use）の input_schema と tool_choice
+- Gemini: generation_config の response_schema
+
+特徴：
+- 応答はすべて同じ結果の形式（RECEIPT_FIELDS の4項目を持つ辞書）に変換
+- 金額は整数（見つからない項目は None）
+- プロバイダーごとに応答の解析に失敗した割合を集計
+- コンパクトモード：短い英字のキー（reg, store など）を空白なしで出力させ、
+  出力トークン数を削減（結果は日本語の項目名に戻してから返す）
+"""
+
+import json
+
+from common.receipt_rules import FIELD_EXAMPLES
+from common.token_counter import count_tokens
+
+# 抽出する項目（項目名, JSONスキーマの型, 説明）
+RECEIPT_FIELDS = [
+    ("登録番号", "string", "登録番号もしくは事業者登録番号（T + 13桁の数字）"),
+    ("購入店", "string", "購入店名"),
+    ("総支払額", "integer", "総支払額（円。数字のみ）"),
+    ("消費税額", "integer", "消費税額（円。数字のみ）"),
+]
+
+# コンパクトモードで出力させるキー
+COMPACT_KEYS = {
+    "登録番号": "reg",
+    "購入店": "store",
+    "総支払額": "total",
+    "消費税額": "tax",
+}
+
+# 出力トークン数の上限（通常モード / コンパクトモード）
+MAX_TOKENS = 1000
+COMPACT_MAX_TOKENS = 120
+
+TOOL_NAME = "record_receipt"
+
+# プロバイダーごとの解析の集計
+parse_stats = {}
+
+# (プロバイダー, モード) ごとの出力トークン数と処理時間の集計
+usage_stats = {}
+
+
+class ParseError(ValueError):
+    """構造化出力の応答を結果の形式に変換できない場合の例外"""
+
+
+def field_key(name, compact=False):
+    """応答で使うキーを返す関数（コンパクトモードでは短い英字のキー）"""
+    return COMPACT_KEYS[name] if compact else name
+
+
+def max_output_tokens(compact=False):
+    """出力トークン数の上限を返す関数"""
+    return COMPACT_MAX_TOKENS if compact else MAX_TOKENS
+
+
+def json_schema(compact=False):
+    """JSONスキーマ（OpenAI・Anthropic用）を返す関数。見つからない項目は null とする"""
+    return {
+        "type": "object",
+        "properties": {
+            field_key(name, compact): {"type": [field_type, "null"], "description": description}
+            for name, field_type, description in RECEIPT_FIELDS
+        },
+        "required": [field_key(name, compact) for name, _, _ in RECEIPT_FIELDS],
+        "additionalProperties": False,
+    }
+
+
+def format_instructions(compact=False):
+    """プロンプトに含める出力形式の指示を返す関数"""
+    if compact:
+        keys = ", ".join(f"{COMPACT_KEYS[name]}={description}" for name, _, description in RECEIPT_FIELDS)
+        return (
+            "次のキーを持つJSONを、空白や改行を入れずに1行で返してください（見つからない項目は null）：\n"
+            f"{keys}\n"
+            '例：{"reg":"T9234567890123","store":"店名","total":820,"tax":74}'
+        )
+    example = ",\n".join(f'    "{name}": "{FIELD_EXAMPLES[name]}"' for name, _, _ in RECEIPT_FIELDS)
+    return f"以下の形式でJSON形式で返してください：\n{{\n{example}\n}}"
+
+
+def openai_response_format(compact=False):
+    """OpenAIの response_format（json_schema の strict モード）を返す関数"""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "receipt", "strict": True, "schema": json_schema(compact)},
+    }
+
+
+def anthropic_tool(compact=False):
+    """Anthropicのツール定義を返す関数（input_schema に結果のスキーマを指定）"""
+    return {
+        "name": TOOL_NAME,
+        "description": "レシートから抽出した情報を記録します。",
+        "input_schema": json_schema(compact),
+    }
+
+
+def anthropic_tool_choice():
+    """Anthropicで必ずツールを使わせるための tool_choice を返す関数"""
+    return {"type": "tool", "name": TOOL_NAME}
+
+
+def gemini_generation_config(compact=False):
+    """Geminiの generation_config（response_schema 付き）を返す関数"""
+    config = {
+        "response_mime_type": "application/json",
+        "response_schema": {
+            "type": "object",
+            "properties": {
+                field_key(name, compact): {"type": field_type, "description": description, "nullable": True}
+                for name, field_type, description in RECEIPT_FIELDS
+            },
+            "required": [field_key(name, compact) for name, _, _ in RECEIPT_FIELDS],
+        },
+    }
+    if compact:
+        config["max_output_tokens"] = COMPACT_MAX_TOKENS
+    return config
+
+
+def to_amount(value):
+    """金額を整数に変換する関数（変換できない場合は None）"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    digits = "".join(c for c in str(value) if c.isdigit())
+    return int(digits) if digits else None
+
+
+def make_result(data, compact=False):
+    """応答の辞書を結果の形式に変換する関数
+
+    :param dict data: 応答から取り出した辞書
+    :param bool compact: コンパクトモードの応答かどうか（キーを日本語の項目名に戻す）
+    :returns: RECEIPT_FIELDS の項目を持つ辞書
+    :rtype: dict
+    :raises ParseError: 辞書でない場合、または項目が足りない場合
+    """
+    if not isinstance(data, dict):
+        raise ParseError(f"応答がJSONオブジェクトではありません: {type(data).__name__}")
+    missing = [field_key(name, compact) for name, _, _ in RECEIPT_FIELDS if field_key(name, compact) not in data]
+    if missing:
+        raise ParseError(f"応答に項目がありません: {', '.join(missing)}")
+
+    result = {}
+    for name, field_type, _ in RECEIPT_FIELDS:
+        value = data[field_key(name, compact)]
+        if field_type == "integer":
+            result[name] = to_amount(value)
+        else:
+            result[name] = None if value is None else str(value)
+    return result
+
+
+def record_parse(provider, success):
+    """解析の成否をプロバイダーごとに記録する関数"""
+    stats = parse_stats.setdefault(provider, {"requests": 0, "failures": 0})
+    stats["requests"] += 1
+    if not success:
+        stats["failures"] += 1
+
+
+def parse_with_stats(provider, parse, compact=False):
+    """解析処理を実行し、成否を記録する関数"""
+    try:
+        result = make_result(parse(), compact)
+    except (ValueError, TypeError, AttributeError, IndexError) as e:
+        # json.JSONDecodeError や、Geminiでブロックされた応答の response.text も ValueError
+        record_parse(provider, False)
+        raise ParseError(f"{provider}の応答の解析に失敗しました: {e}") from e
+    record_parse(provider, True)
+    return result
+
+
+def parse_openai_response(response, compact=False):
+    """OpenAIの応答（json_schema の strict モード）を結果の形式に変換する関数"""
+    def parse():
+        message = response.choices[0].message
+        if getattr(message, "refusal", None):
+            raise ParseError(f"応答が拒否されました: {message.refusal}")
+        return json.loads(message.content)
+    return parse_with_stats("openai", parse, compact)
+
+
+def parse_anthropic_response(message, compact=False):
+    """Anthropicの応答（ツール使用）を結果の形式に変換する関数"""
+    def parse():
+        for block in message.content:
+            if block.type == "tool_use" and block.name == TOOL_NAME:
+                return block.input
+        raise ParseError("ツール使用のブロックがありません")
+    return parse_with_stats("anthropic", parse, compact)
+
+
+def parse_gemini_response(response, compact=False):
+    """Geminiの応答（response_schema 付き）を結果の形式に変換する関数"""
+    return parse_with_stats("gemini", lambda: json.loads(response.text), compact)
+
+
+def response_output_tokens(response):
+    """応答の出力トークン数を返す関数（OpenAI・Anthropic・Gemini の usage に対応）"""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        return getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", None)
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is not None:
+        return getattr(metadata, "candidates_token_count", None)
+    return None
+
+
+def record_usage(provider, compact, output_tokens, elapsed):
+    """出力トークン数と処理時間をプロバイダー・モードごとに記録する関数"""
+    mode = "compact" if compact else "standard"
+    stats = usage_stats.setdefault((provider, mode), {"requests": 0, "output_tokens": [], "elapsed": []})
+    stats["requests"] += 1
+    if output_tokens is not None:
+        stats["output_tokens"].append(output_tokens)
+    stats["elapsed"].append(elapsed)
+
+
+def estimate_output_tokens(result, compact=False):
+    """結果を各モードで出力した場合のトークン数を概算する関数"""
+    if compact:
+        data = {COMPACT_KEYS[name]: value for name, value in result.items() if name in COMPACT_KEYS}
+        return count_tokens(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    return count_tokens(json.dumps(result, ensure_ascii=False, indent=4))
+
+
+def print_usage_stats():
+    """出力トークン数と処理時間の平均を、通常モードとコンパクトモードで比較して表示する関数"""
+    averages = {}
+    for (provider, mode), stats in usage_stats.items():
+        tokens = sum(stats["output_tokens"]) / len(stats["output_tokens"]) if stats["output_tokens"] else None
+        elapsed = sum(stats["elapsed"]) / len(stats["elapsed"])
+        averages[(provider, mode)] = (tokens, elapsed)
+        token_text = f"{tokens:.1f}" if tokens is not None else "不明"
+        print(f"{provider}（{mode}）: {stats['requests']}件、出力トークン数 平均 {token_text}、処理時間 平均 {elapsed:.2f}秒")
+
+    for (provider, mode), (tokens, elapsed) in averages.items():
+        if mode != "compact" or (provider, "standard") not in averages:
+            continue
+        standard_tokens, standard_elapsed = averages[(provider, "standard")]
+        if tokens is not None and standard_tokens is not None:
+            print(f"{provider}: コンパクトモードで削減できた出力トークン数 {standard_tokens - tokens:.1f}、"
+                  f"処理時間 {standard_elapsed - elapsed:.2f}秒（1件あたり）")
+
+
+def print_parse_stats():
+    """プロバイダーごとの解析の失敗率を表示する関数"""
+    for provider, stats in parse_stats.items():
+        rate = stats["failures"] / stats["requests"] if stats["requests"] else 0.0
+        print(f"{provider}: 解析 {stats['requests']}件、失敗 {stats['failures']}件（失敗率 {rate:.1%}）")
@@ -0,0 +1,29 @@
+"""
+ローカルで動作する簡易トークン数カウンター
+
+このモジュールは、APIを呼び出さずにテキストのおおよそのトークン数を見積もります。
+
+特徴：
+- 外部ライブラリ不要（tiktoken などを使わない）
+- 英数字はおよそ4文字で1トークン、日本語などの非ASCII文字は1文字1トークンとして計算
+- プロンプトサイズの比較や履歴の予算管理に使える程度の精度
+"""
+
+import re
+
+# ASCIIの連続部分と、それ以外の文字を分けて数えるための正規表現
+ASCII_RUN_PATTERN = re.compile(r"[\x00-\x7f]+")
+
+
+def count_tokens(text):
+    """テキストのおおよそのトークン数を返す関数"""
+    if not text:
+        return 0
+
+    ascii_chars = 0
+    for run in ASCII_RUN_PATTERN.findall(text):
+        ascii_chars += len(run)
+    non_ascii_chars = len(text) - ascii_chars
+
+    # 英数字は4文字で約1トークン、非ASCII文字は1文字で約1トークン
+    return (ascii_chars + 3) // 4 + non_ascii_chars
@@ -1,7 +1,15 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample01_openai.openai_13_interactive で実行してください。
 import os
+import time
 
 from dotenv import load_dotenv
 from openai import OpenAI
+from openai.types.chat import ChatCompletion
+
+from common.response_cache import CACHE_PATH, ResponseCache, cache_key, print_response_cache_stats
+from common.semantic_cache import SemanticCache, cache_scope, print_semantic_cache_stats
+from common.singleflight import coalesce, print_singleflight_stats, request_key
 
 # 環境変数を読み込む
 load_dotenv()
@@ -9,6 +17,21 @@ load_dotenv()
 # APIキーを取得
 api_key = os.getenv("OPENAI_API_KEY")
 
+# 同じ入力への応答を保存して再利用するかどうか（応答キャッシュ）
+RESPONSE_CACHE = True
+
+# 応答キャッシュをファイルに保存し、次の実行でも使うかどうか
+SAVE_RESPONSE_CACHE = True
+
+# 応答キャッシュ（応答はJSONに変換して保存する）
+response_cache = ResponseCache(path=CACHE_PATH if SAVE_RESPONSE_CACHE else None)
+
+# 書き方の違う同じ名前（「山田 太郎さんを占って」など）にも、保存した応答を返すかどうか（意味キャッシュ）
+SEMANTIC_CACHE = True
+
+# 意味キャッシュ（実行中のみ保存する）
+semantic_cache = SemanticCache()
+
 
 def get_llm_response(system_prpmpt, user_prompt):
     # クライアントインスタンスを作成
@@ -20,12 +43,35 @@ def get_llm_response(system_prpmpt, user_prompt):
         {"role": "user", "content": user_prompt},
     ]
 
+    request = dict(
+        model="gpt-4o",
+        messages=messages,
+        temperature=0.7,
+    )
+
+    # 同じ氏名への応答を保存している場合は、APIを呼び出さずに返す
+    key = cache_key("openai", request["model"], system_prpmpt, user_prompt)
+    if RESPONSE_CACHE:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return ChatCompletion.model_validate(cached)
+
+    # 書き方の違う同じ氏名への応答を保存している場合も、APIを呼び出さずに返す
+    scope = cache_scope("openai", request["model"], system_prpmpt)
+    if SEMANTIC_CACHE:
+        cached = semantic_cache.get(scope, user_prompt)
+        if cached is not None:
+            return cached
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.7,
-        )
+        start_time = time.perf_counter()
+        # 同じリクエストが実行中の場合は、その応答を待って同じ応答を返す
+        response = coalesce(request_key(request), client.chat.completions.create, **request)
+        elapsed = time.perf_counter() - start_time
+        if RESPONSE_CACHE:
+            response_cache.put(key, response.model_dump(mode="json"), elapsed)
+        if SEMANTIC_CACHE:
+            semantic_cache.put(scope, user_prompt, response, elapsed)
         return response
     except Exception as e:
         error_message = str(e)
@@ -46,6 +92,9 @@ if __name__ == "__main__":
         # exitコマンドの処理
         if user_prompt.lower() == "exit":
             print("プログラムを終了します")
+            print_singleflight_stats()
+            print_response_cache_stats()
+            print_semantic_cache_stats()
             break
 
         if not user_prompt or user_prompt.strip() == "":
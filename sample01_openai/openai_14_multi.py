@@ -1,9 +1,13 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample01_openai.openai_14_multi で実行してください。
 import os
 from datetime import datetime
 
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from common.history_window import history_messages, print_history_window_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
@@ -49,26 +53,19 @@ def clear_history():
     return "履歴をクリアしました。"
 
 
-def format_history_for_api():
-    """APIリクエスト用に会話履歴をフォーマットする関数"""
-    messages = []
-    for entry in conversation_history:
-        if entry["role"] in ["user", "assistant"]:
-            messages.append({
-                "role": entry["role"],
-                "content": entry["content"]
-            })
-    return messages
+def format_history_for_api(instructions, input_text):
+    """APIリクエスト用に会話履歴をフォーマットする関数
+
+    システム指示の分を差し引いたトークン数の予算に収まる、直近の履歴と新しい入力を返します。
+    """
+    return history_messages(conversation_history, input_text, instructions)
 
 
 def get_llm_response(instructions, input_text):
     """OpenAI APIを使用してレスポンスを取得する関数"""
     try:
-        # 会話履歴をフォーマット
-        messages = format_history_for_api()
-
-        # 新しい入力を追加
-        messages.append({"role": "user", "content": input_text})
+        # 会話履歴と新しい入力をフォーマット
+        messages = format_history_for_api(instructions, input_text)
 
         # APIリクエスト
         response = client.chat.completions.create(
@@ -101,6 +98,7 @@ if __name__ == "__main__":
         # 特別コマンドの処理
         if user_prompt.lower() == "exit":
             print("プログラムを終了します")
+            print_history_window_stats()
             break
         elif user_prompt.lower() == "history":
             print(display_history())
@@ -113,12 +111,12 @@ if __name__ == "__main__":
             print("空の入力は処理できません。何か入力してください。")
             continue
 
-        # ユーザー入力を履歴に追加
-        add_to_history("user", user_prompt)
-
         print("\n回答を生成中...\n")
         response = get_llm_response(system_prompt, user_prompt)
 
+        # ユーザー入力を履歴に追加（送信するメッセージには新しい入力として加えるため、送信の後に追加する）
+        add_to_history("user", user_prompt)
+
         # レスポンスがオブジェクトの場合とテキストの場合で処理を分ける
         if hasattr(response, 'choices'):
             output_text = response.choices[0].message.content
@@ -11,13 +11,19 @@
 特徴：
 - ディレクトリ内のJPG画像を一括処理
 - 結果をCSVとExcelファイルに保存
-- エラーハンドリング機能付き
+- 画像はまず低い詳細度で送り、結果の検証に失敗した場合だけ高い詳細度で送り直す
+- 共通の指示と入力例をプロンプトの先頭にまとめ、プロンプトキャッシュを効かせる
+- エラーハンドリング機能付き（レート制限などの一時的なエラーは、待ってから再試行）
+- プロバイダーの障害中は呼び出しを遮断し、別のプロバイダーに振り替え（サーキットブレーカー）
 - 進捗状況の表示
 
 使用方法：
 1. プログラムを実行
 2. レシート画像が含まれるディレクトリ名を入力
 3. 処理完了後、resultsディレクトリに結果ファイルが作成される
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample01_openai.openai_24_receipt_iterate で実行してください。
 """
 
 import base64
@@ -29,13 +35,26 @@ from pathlib import Path
 import openai
 from dotenv import load_dotenv
 
+from common.circuit_breaker import CircuitOpenError, call_provider, print_breaker_stats
+from common.image_detail import extract_with_escalation, print_detail_stats
+from common.prompt_cache import check_prefix, openai_messages, print_cache_stats, record_cache, response_cache_tokens
+from common.receipt_extractors import divert_receipt
+from common.retry import print_retry_stats
+from common.structured_output import ParseError, openai_response_format, parse_openai_response, print_parse_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 画像をまず低い詳細度（detail: low）で送り、検証に失敗した場合だけ高い詳細度で送り直すかどうか
+ADAPTIVE_DETAIL = True
+
 # APIキーを設定
 api_key = os.getenv("OPENAI_API_KEY")
 openai.api_key = api_key
 
+# 再試行は common.retry の方針で行うため、SDKの自動再試行は無効にする
+openai.max_retries = 0
+
 def encode_image(image_path):
     """画像をbase64エンコードする関数"""
     with open(image_path, "rb") as image_file:
@@ -47,50 +66,33 @@ def analyze_receipt(image_path):
         # 画像を読み込む
         base64_image = encode_image(image_path)
 
-        prompt = """
-        このレシートから以下の情報を抽出してください：
-        1. 登録番号（登録番号もしくは事業者登録番号）
-        2. 購入店名
-        3. 総支払額
-        4. 消費税額
-
-        以下の形式でJSON形式で返してください：
-        {
-            "登録番号": "番号",
-            "購入店": "店名",
-            "総支払額": "金額",
-            "消費税額": "金額"
-        }
-        """
-
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1000,
-            response_format={"type": "json_object"}
-        )
-        
-        # JSONレスポンスを解析
-        result = json.loads(response.choices[0].message.content)
+        def extract(detail):
+            # 静的なプレフィックス（ルール・出力形式・入力例）を先頭に置き、変わる部分の画像は後ろに置く
+            response = call_provider("openai", openai.chat.completions.create,
+                model="gpt-4o",
+                messages=openai_messages(f"data:image/jpeg;base64,{base64_image}", detail=detail),
+                max_tokens=1000,
+                response_format=openai_response_format()
+            )
+            record_cache("openai", response_cache_tokens(response))
+            
+            # 構造化出力（json_schema の strict モード）の応答を解析
+            return parse_openai_response(response), response.usage.prompt_tokens
+
+        # 低い詳細度で抽出し、検証に失敗した場合だけ高い詳細度で抽出し直す
+        result = extract_with_escalation(extract, image_path, ADAPTIVE_DETAIL)
         return json.dumps(result, ensure_ascii=False, indent=2)
 
     except FileNotFoundError:
         return json.dumps({"error": f"ファイル '{image_path}' が見つかりません"}, ensure_ascii=False, indent=2)
-    except json.JSONDecodeError:
+    except ParseError:
         return json.dumps({"error": "JSONの解析に失敗しました"}, ensure_ascii=False, indent=2)
+    except CircuitOpenError:
+        # 障害中のプロバイダーには送らずに、別のプロバイダーで抽出する
+        result = divert_receipt("openai", image_path)
+        if result is None:
+            return json.dumps({"error": "プロバイダーの障害のため処理できませんでした"}, ensure_ascii=False, indent=2)
+        return json.dumps(result, ensure_ascii=False, indent=2)
     except Exception as e:
         return json.dumps({"error": f"エラーが発生しました: {str(e)}"}, ensure_ascii=False, indent=2)
 
@@ -134,6 +136,7 @@ def process_files_in_directory(dir_name):
         return
     
     print(f"処理を開始します。{len(image_files)}個のファイルが見つかりました。")
+    check_prefix()
     
     # 各画像を処理
     for image_path in image_files:
@@ -165,6 +168,11 @@ def main():
         return
         
     process_files_in_directory(dir_name)
+    print_parse_stats()
+    print_cache_stats()
+    print_detail_stats()
+    print_retry_stats()
+    print_breaker_stats()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
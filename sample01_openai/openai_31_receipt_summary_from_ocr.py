@@ -9,6 +9,10 @@
 
 特徴：
 - OCR結果のJSONを処理
+- text_blocks の座標から読み順のテキストを再構成し、プロンプトを小さくする
+- 再構成前後のプロンプトサイズとAPIの応答時間を表示
+- 正規表現と単語ボックスの位置関係で確実に抽出できた項目はAPIに問い合わせない
+- 回避できたAPI呼び出しの数を終了時に表示
 - OpenAI APIを使用して分析
 - 結果をJSON形式で出力
 - エラーハンドリング機能付き
@@ -18,14 +22,28 @@
 2. OCR結果のJSONファイルのパスを入力
 3. 分析結果を確認
 4. 'exit'と入力して終了
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample01_openai.openai_31_receipt_summary_from_ocr で実行してください。
 """
 
 import json
 import os
+import time
 
 import openai
 from dotenv import load_dotenv
 
+from common.ocr_layout import reconstruct_text
+from common.ocr_spatial import extract_ocr_fields
+from common.receipt_rules import (
+    FIELD_DESCRIPTIONS,
+    FIELD_EXAMPLES,
+    confident_fields,
+    missing_fields,
+)
+from common.token_counter import count_tokens
+
 # 環境変数を読み込む
 load_dotenv()
 
@@ -33,6 +51,69 @@ load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 openai.api_key = api_key
 
+# 比較のため、再構成前のJSONをそのまま送った場合の応答時間も計測するかどうか
+COMPARE_WITH_RAW_JSON = False
+
+# 実行中の統計
+run_stats = {
+    "receipts": 0,
+    "rule_fields": 0,
+    "llm_calls": 0,
+    "llm_calls_avoided": 0,
+}
+
+
+def build_text_content(ocr_data, use_layout=True):
+    """OCR結果からプロンプトに埋め込むテキストを作成する関数"""
+    if use_layout:
+        return reconstruct_text(ocr_data)
+    # 再構成しない場合（変更前の動作）
+    if "text" in ocr_data:
+        return ocr_data["text"]
+    return json.dumps(ocr_data)
+
+
+def build_prompt(field_names):
+    """抽出する項目だけを並べたプロンプトを作成する関数"""
+    items = "\n".join(
+        f"        {i}. {FIELD_DESCRIPTIONS[name]}" for i, name in enumerate(field_names, 1)
+    )
+    example = ",\n".join(
+        f'            "{name}": "{FIELD_EXAMPLES[name]}"' for name in field_names
+    )
+    return f"""
+        このレシートから以下の情報を抽出してください：
+{items}
+
+        以下の形式でJSON形式で返してください：
+        {{
+{example}
+        }}
+        """
+
+
+def request_analysis(text_content, field_names=None):
+    """OCRテキストをOpenAI APIに送り、応答と応答時間を返す関数"""
+    prompt = build_prompt(field_names or list(FIELD_DESCRIPTIONS))
+
+    # OpenAI APIを使用して分析
+    start_time = time.perf_counter()
+    response = openai.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt + "\n\nOCRのテキスト結果:\n" + text_content}
+                ]
+            }
+        ],
+        max_tokens=1000,
+        response_format={"type": "json_object"}
+    )
+    elapsed = time.perf_counter() - start_time
+    return response.choices[0].message.content, elapsed
+
 
 def analyze_receipt_json(json_path):
     """OCR結果のJSONからレシートの情報を抽出する関数"""
@@ -41,48 +122,56 @@ def analyze_receipt_json(json_path):
         with open(json_path, "r", encoding="utf-8") as file:
             ocr_data = json.load(file)
 
-        # OCR結果からテキストを取得
-        if "text" in ocr_data:
-            text_content = ocr_data["text"]
-        else:
-            text_content = json.dumps(ocr_data)
-
-        prompt = """
-        このレシートから以下の情報を抽出してください：
-        1. 登録番号（登録番号もしくは事業者登録番号）
-        2. 購入店名
-        3. 総支払額
-        4. 消費税額
-
-        以下の形式でJSON形式で返してください：
-        {
-            "登録番号": "番号",
-            "購入店": "店名",
-            "総支払額": "金額",
-            "消費税額": "金額"
-        }
-        """
-
-        # OpenAI APIを使用して分析
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt + "\n\nOCRのテキスト結果:\n" + text_content}
-                    ]
-                }
-            ],
-            max_tokens=1000
-        )
-        return response.choices[0].message.content
+        # OCR結果からテキストを取得（レイアウトを再構成した場合としない場合）
+        raw_content = build_text_content(ocr_data, use_layout=False)
+        text_content = build_text_content(ocr_data)
+
+        print("\nプロンプトサイズ:")
+        print(f"  変換前: {len(raw_content)}文字（約{count_tokens(raw_content)}トークン）")
+        print(f"  変換後: {len(text_content)}文字（約{count_tokens(text_content)}トークン）")
+
+        # まずはルールと位置関係で抽出し、確信度の低い項目だけをLLMに問い合わせる
+        fields = extract_ocr_fields(ocr_data)
+        result = confident_fields(fields)
+        missing = missing_fields(fields)
+        run_stats["receipts"] += 1
+        run_stats["rule_fields"] += len(result)
+        print(f"ルールで確定した項目: {', '.join(result) or 'なし'}")
+
+        if not missing:
+            run_stats["llm_calls_avoided"] += 1
+            print("すべての項目をルールで抽出できたため、APIは呼び出しません")
+            return json.dumps(result, ensure_ascii=False, indent=2)
+
+        if COMPARE_WITH_RAW_JSON:
+            _, raw_elapsed = request_analysis(raw_content)
+            print(f"応答時間（変換前）: {raw_elapsed:.2f}秒")
+
+        llm_content, elapsed = request_analysis(text_content, missing)
+        run_stats["llm_calls"] += 1
+        print(f"応答時間（変換後）: {elapsed:.2f}秒")
+
+        llm_result = json.loads(llm_content)
+        for name in missing:
+            result[name] = llm_result.get(name)
+        return json.dumps(result, ensure_ascii=False, indent=2)
     except FileNotFoundError:
         return f"エラー: ファイル '{json_path}' が見つかりません"
+    except json.JSONDecodeError:
+        return "エラー: JSONの解析に失敗しました"
     except Exception as e:
         return f"エラーが発生しました: {str(e)}"
 
 
+def print_run_stats():
+    """実行中の統計（ルールで回避できたAPI呼び出しの数など）を表示する関数"""
+    print("\n=== 実行統計 ===")
+    print(f"処理したレシート: {run_stats['receipts']}件")
+    print(f"ルールで確定した項目: {run_stats['rule_fields']}個")
+    print(f"API呼び出し: {run_stats['llm_calls']}回")
+    print(f"回避できたAPI呼び出し: {run_stats['llm_calls_avoided']}回")
+
+
 def main():
     print("レシート分析プログラム (OCR結果JSON版)")
     print("終了するには 'exit' と入力してください")
@@ -91,6 +180,7 @@ def main():
         json_path = input("\nOCR結果のJSONファイルのパスを入力してください (例: ocr_result.json): ")
 
         if json_path.lower() == 'exit':
+            print_run_stats()
             print("プログラムを終了します")
             break
 
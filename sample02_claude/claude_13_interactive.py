@@ -1,8 +1,13 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample02_claude.claude_13_interactive で実行してください。
 import os
+import time
 
 from anthropic import Anthropic
 from dotenv import load_dotenv
 
+from common.semantic_cache import SemanticCache, cache_scope, print_semantic_cache_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
@@ -12,18 +17,37 @@ api_key = os.getenv("ANTHROPIC_API_KEY")
 # クライアントインスタンスを作成
 client = Anthropic(api_key=api_key)
 
+# 書き方の違う同じ名前（「山田 太郎さんを占って」など）にも、保存した応答を返すかどうか（意味キャッシュ）
+SEMANTIC_CACHE = True
+
+# 意味キャッシュ（実行中のみ保存する）
+semantic_cache = SemanticCache()
+
+MODEL = "claude-3-5-sonnet-20241022"
+SYSTEM_PROMPT = "あなたは姓名占いをする占い師です。大吉,中吉,吉,凶のうちのひとつを回答します。"
+
 
 def get_claude_response(user_prompt):
+    # 書き方の違う同じ名前への応答を保存している場合は、APIを呼び出さずに返す
+    scope = cache_scope("anthropic", MODEL, SYSTEM_PROMPT)
+    if SEMANTIC_CACHE:
+        cached = semantic_cache.get(scope, user_prompt)
+        if cached is not None:
+            return cached
+
     try:
+        start_time = time.perf_counter()
         response = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
+            model=MODEL,
             max_tokens=1000,
-            system="あなたは姓名占いをする占い師です。大吉,中吉,吉,凶のうちのひとつを回答します。",
+            system=SYSTEM_PROMPT,
             messages=[
                 {"role": "user", "content": user_prompt}
             ],
             temperature=0.7,
         )
+        if SEMANTIC_CACHE:
+            semantic_cache.put(scope, user_prompt, response, time.perf_counter() - start_time)
         return response
     except Exception as e:
         return f"エラーが発生しました: {str(e)}"
@@ -33,6 +57,7 @@ if __name__ == "__main__":
     while True:
         user_prompt = input("あなたの名前を入力してください (終了するには 'exit' と入力): ")
         if user_prompt.lower() == "exit":
+            print_semantic_cache_stats()
             break
         response = get_claude_response(user_prompt)
         response_text = response.content[0].text
@@ -1,9 +1,13 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample02_claude.claude_14_multi で実行してください。
 import os
 from datetime import datetime
 
 from anthropic import Anthropic
 from dotenv import load_dotenv
 
+from common.history_window import history_messages, print_history_window_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
@@ -13,6 +17,8 @@ api_key = os.getenv("ANTHROPIC_API_KEY")
 # クライアントインスタンスを作成
 client = Anthropic(api_key=api_key)
 
+SYSTEM_PROMPT = "あなたは姓名占いをする占い師です。大吉,中吉,吉,凶のうちのひとつを回答します。"
+
 # 会話履歴を保存するリスト
 conversation_history = []
 
@@ -49,31 +55,22 @@ def clear_history():
     return "履歴をクリアしました。"
 
 
-def format_messages_for_api():
+def format_messages_for_api(input_text):
     """APIリクエスト用に履歴をフォーマットする関数"""
-    # APIに送信するメッセージのみを抽出（最大10件程度に制限）
-    messages = []
-    for entry in conversation_history[-20:]:  # 直近20件までの履歴を使用
-        if entry["role"] in ["user", "assistant"]:
-            messages.append({
-                "role": entry["role"],
-                "content": entry["content"]
-            })
-    return messages
+    # システムプロンプトの分を差し引いたトークン数の予算に収まる、直近の履歴と新しい入力を使用
+    return history_messages(conversation_history, input_text, SYSTEM_PROMPT)
 
 
 def get_claude_response(input_text):
     """Claude APIを使用して応答を取得する関数"""
     try:
-        # 会話履歴をフォーマット
-        messages = format_messages_for_api()
-
-        messages.append({"role": "user", "content": input_text})
+        # 会話履歴と新しい入力をフォーマット
+        messages = format_messages_for_api(input_text)
 
         response = client.messages.create(
             model="claude-3-5-sonnet-20241022",
             max_tokens=1000,
-            system="あなたは姓名占いをする占い師です。大吉,中吉,吉,凶のうちのひとつを回答します。",
+            system=SYSTEM_PROMPT,
             messages=messages,
             temperature=0.7,
         )
@@ -96,6 +93,7 @@ if __name__ == "__main__":
         # 特別コマンドの処理
         if user_prompt.lower() == "exit":
             print("プログラムを終了します")
+            print_history_window_stats()
             break
         elif user_prompt.lower() == "history":
             print(display_history())
@@ -108,12 +106,12 @@ if __name__ == "__main__":
             print("空の入力は処理できません。何か入力してください。")
             continue
 
-        # ユーザー入力を履歴に追加
-        add_to_history("user", user_prompt)
-
         print("\n回答を生成中...\n")
         response = get_claude_response(user_prompt)
 
+        # ユーザー入力を履歴に追加（送信するメッセージには新しい入力として加えるため、送信の後に追加する）
+        add_to_history("user", user_prompt)
+
         # レスポンスがオブジェクトの場合と文字列の場合で処理を分ける
         if isinstance(response, str):
             # エラーメッセージの場合
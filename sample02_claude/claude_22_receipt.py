@@ -12,12 +12,16 @@
 - 対話形式でファイルを指定
 - 結果をJSON形式で出力
 - エラーハンドリング機能付き
+- 応答が遅い場合は別のプロバイダーにも送信し、先に返ってきた応答を使用（ヘッジ）
 
 使用方法：
 1. プログラムを実行
 2. レシート画像のパスを入力
 3. 分析結果を確認
 4. 'exit'と入力して終了
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample02_claude.claude_22_receipt で実行してください。
 """
 
 import base64
@@ -25,9 +29,14 @@ import os
 import anthropic
 from dotenv import load_dotenv
 
+from common.hedging import ask_image, print_hedge_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 応答が遅い場合（これまでの応答時間の p95 を過ぎた場合）に、別のプロバイダーにも同じリクエストを送るかどうか
+HEDGING = True
+
 # APIキーを設定
 api_key = os.getenv("ANTHROPIC_API_KEY")
 client = anthropic.Anthropic(api_key=api_key)
@@ -61,6 +70,10 @@ def analyze_receipt(image_path):
         }
         """
 
+        if HEDGING:
+            # 応答が遅い場合は別のプロバイダーにも送り、先に返ってきた応答を使う
+            return ask_image("anthropic", image_path, prompt, "claude-3-opus-20240229")
+
         message = client.messages.create(
             model="claude-3-opus-20240229",
             max_tokens=1000,
@@ -99,6 +112,7 @@ def main():
         image_path = input("\n画像ファイルのパスを入力してください (例: receipt.jpg): ")
         
         if image_path.lower() == 'exit':
+            print_hedge_stats()
             print("プログラムを終了します")
             break
             
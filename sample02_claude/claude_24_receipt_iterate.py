@@ -11,13 +11,18 @@
 特徴：
 - ディレクトリ内のJPG画像を一括処理
 - 結果をCSVとExcelファイルに保存
-- エラーハンドリング機能付き
+- 共通の指示と入力例をプロンプトの先頭にまとめ、プロンプトキャッシュを効かせる
+- エラーハンドリング機能付き（レート制限などの一時的なエラーは、待ってから再試行）
+- プロバイダーの障害中は呼び出しを遮断し、別のプロバイダーに振り替え（サーキットブレーカー）
 - 進捗状況の表示
 
 使用方法：
 1. プログラムを実行
 2. レシート画像が含まれるディレクトリ名を入力
 3. 処理完了後、resultsディレクトリに結果ファイルが作成される
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample02_claude.claude_24_receipt_iterate で実行してください。
 """
 
 import base64
@@ -29,12 +34,26 @@ from pathlib import Path
 import anthropic
 from dotenv import load_dotenv
 
+from common.circuit_breaker import CircuitOpenError, call_provider, print_breaker_stats
+from common.prompt_cache import (
+    anthropic_messages,
+    anthropic_system,
+    check_prefix,
+    print_cache_stats,
+    record_cache,
+    response_cache_tokens,
+)
+from common.receipt_extractors import divert_receipt
+from common.retry import print_retry_stats
+from common.structured_output import ParseError, anthropic_tool, anthropic_tool_choice, parse_anthropic_response, print_parse_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
 # APIキーを設定
 api_key = os.getenv("ANTHROPIC_API_KEY")
-client = anthropic.Anthropic(api_key=api_key)
+# 再試行は common.retry の方針で行うため、SDKの自動再試行は無効にする
+client = anthropic.Anthropic(api_key=api_key, max_retries=0)
 
 def encode_image(image_path):
     """画像をbase64エンコードする関数"""
@@ -47,54 +66,31 @@ def analyze_receipt(image_path):
         # 画像を読み込む
         base64_image = encode_image(image_path)
 
-        prompt = """
-        このレシートから以下の情報を抽出してください：
-        1. 登録番号（登録番号もしくは事業者登録番号）
-        2. 購入店名
-        3. 総支払額
-        4. 消費税額
-
-        以下の形式でJSON形式で返してください：
-        {
-            "登録番号": "番号",
-            "購入店": "店名",
-            "総支払額": "金額",
-            "消費税額": "金額"
-        }
-        """
-
-        message = client.messages.create(
+        # 静的なプレフィックス（ルール・出力形式・入力例）を先頭に置き、cache_control でキャッシュする
+        message = call_provider("anthropic", client.messages.create,
             model="claude-3-opus-20240229",
             max_tokens=1000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": base64_image
-                            }
-                        }
-                    ]
-                }
-            ]
+            tools=[anthropic_tool()],
+            tool_choice=anthropic_tool_choice(),
+            system=anthropic_system(),
+            messages=anthropic_messages(base64_image)
         )
+        record_cache("anthropic", response_cache_tokens(message))
         
-        # JSONレスポンスを解析
-        result = json.loads(message.content[0].text)
+        # ツール使用（input_schema）の応答を解析
+        result = parse_anthropic_response(message)
         return json.dumps(result, ensure_ascii=False, indent=2)
 
     except FileNotFoundError:
         return json.dumps({"error": f"ファイル '{image_path}' が見つかりません"}, ensure_ascii=False, indent=2)
-    except json.JSONDecodeError:
+    except ParseError:
         return json.dumps({"error": "JSONの解析に失敗しました"}, ensure_ascii=False, indent=2)
+    except CircuitOpenError:
+        # 障害中のプロバイダーには送らずに、別のプロバイダーで抽出する
+        result = divert_receipt("anthropic", image_path)
+        if result is None:
+            return json.dumps({"error": "プロバイダーの障害のため処理できませんでした"}, ensure_ascii=False, indent=2)
+        return json.dumps(result, ensure_ascii=False, indent=2)
     except Exception as e:
         return json.dumps({"error": f"エラーが発生しました: {str(e)}"}, ensure_ascii=False, indent=2)
 
@@ -138,6 +134,7 @@ def process_files_in_directory(dir_name):
         return
     
     print(f"処理を開始します。{len(image_files)}個のファイルが見つかりました。")
+    check_prefix()
     
     # 各画像を処理
     for image_path in image_files:
@@ -169,6 +166,10 @@ def main():
         return
         
     process_files_in_directory(dir_name)
+    print_parse_stats()
+    print_cache_stats()
+    print_retry_stats()
+    print_breaker_stats()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -11,32 +11,90 @@
 特徴：
 - ディレクトリ内のJPG画像を一括処理
 - 金額を数値形式で保存（単位や記号なし）
-- 結果をCSVとExcelファイルに保存
-- エラーハンドリング機能付き
+- 結果をCSVとExcelファイルに保存（型付きのParquetファイルにも保存可能）
+- エラーハンドリング機能付き（レート制限などの一時的なエラーは、待ってから再試行）
+- プロバイダーの障害中は呼び出しを遮断し、別のプロバイダーに振り替え（サーキットブレーカー）
 - 進捗状況の表示
 - システムプロンプトによる厳密な指示
+- 共通の指示と入力例をプロンプトの先頭にまとめ、プロンプトキャッシュを効かせる
 
 使用方法：
 1. プログラムを実行
 2. レシート画像が含まれるディレクトリ名を入力
 3. 処理完了後、resultsディレクトリに結果ファイルが作成される
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample02_claude.claude_26_receipt_iterate_detailed_self で実行してください。
 """
 
 import base64
 import os
 import json
+import time
 import csv
-import pandas as pd
 from pathlib import Path
 import anthropic
 from dotenv import load_dotenv
 
+from common.amount_normalizer import INT, normalize_results
+from common.circuit_breaker import CircuitOpenError, call_provider, print_breaker_stats
+from common.excel_export import export_journal, iter_normalized, print_export_stats
+from common.parquet_output import save_parquet
+from common.prompt_cache import (
+    anthropic_messages,
+    anthropic_system,
+    check_prefix,
+    print_cache_stats,
+    record_cache,
+    response_cache_tokens,
+)
+from common.receipt_extractors import divert_receipt
+from common.registration_validator import load_registry, validate_results
+from common.result_journal import append_journal, collect_columns, iter_journal, start_journal, write_journal
+from common.results_db import save_results_db
+from common.results_store import HASH_COLUMN, ResultsStore, file_hash, print_upsert_summary
+from common.retry import print_retry_stats
+from common.streaming_extraction import (
+    anthropic_deltas,
+    extract_streaming,
+    print_field,
+    print_latency_stats,
+    record_latency,
+)
+from common.structured_output import (
+    ParseError,
+    anthropic_tool,
+    anthropic_tool_choice,
+    max_output_tokens,
+    parse_anthropic_response,
+    print_parse_stats,
+    print_usage_stats,
+    record_usage,
+    response_output_tokens,
+)
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 型付きのParquetファイル（金額は int64）も保存するかどうか
+SAVE_PARQUET = True
+
+# 処理済みの画像（内容が同じファイル）をスキップするかどうか
+SKIP_PROCESSED_FILES = True
+
+# SQLiteデータベース（receipt_results.db）にも保存するかどうか
+SAVE_DATABASE = True
+
+# 応答をストリーミングで受け取り、項目が確定するたびに表示するかどうか
+STREAMING = True
+
+# 短い英字のキーで出力させ、出力トークン数を減らすかどうか（結果は日本語の項目名に戻す）
+COMPACT_OUTPUT = True
+
 # APIキーを設定
 api_key = os.getenv("ANTHROPIC_API_KEY")
-client = anthropic.Anthropic(api_key=api_key)
+# 再試行は common.retry の方針で行うため、SDKの自動再試行は無効にする
+client = anthropic.Anthropic(api_key=api_key, max_retries=0)
 
 def encode_image(image_path):
     """画像をbase64エンコードする関数"""
@@ -49,133 +107,104 @@ def analyze_receipt(image_path):
         # 画像を読み込む
         base64_image = encode_image(image_path)
 
-        system_prompt = """あなたはレシートの情報を正確に抽出するAIアシスタントです。
-金額は数字のみで表記してください（単位や記号なし）。
-例：820、495、460、950
-
-禁止事項：
-- 通貨記号（¥や￥）の使用
-- カンマ区切りの使用
-- 小数点以下の使用
-- 「円」などの単位の使用"""
-
-        user_prompt = """
-        このレシートから以下の情報を抽出してください：
-        1. 登録番号（登録番号もしくは事業者登録番号）
-        2. 購入店名
-        3. 総支払額
-        4. 消費税額
-
-        以下の形式でJSON形式で返してください：
-        {
-            "登録番号": "番号",
-            "購入店": "店名",
-            "総支払額": "金額",
-            "消費税額": "金額"
-        }
-
-        金額は数字のみで表記してください。
-        例：820、495、460、950"""
-
-        message = client.messages.create(
+        # 静的なプレフィックス（ルール・出力形式・入力例）を先頭に置き、cache_control でキャッシュする
+        request = dict(
             model="claude-3-opus-20240229",
-            max_tokens=1000,
-            system=system_prompt,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": user_prompt
-                        },
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": base64_image
-                            }
-                        }
-                    ]
-                }
-            ]
+            max_tokens=max_output_tokens(COMPACT_OUTPUT),
+            system=anthropic_system(COMPACT_OUTPUT),
+            messages=anthropic_messages(base64_image)
         )
         
-        # JSONレスポンスを解析
-        result = json.loads(message.content[0].text)
+        if STREAMING:
+            # 項目が確定するたびに表示する（ツール入力のJSONをインクリメンタルに解析）
+            usage = {}
+            # 再試行する場合は、ストリームを最初から受け取り直す
+            result = call_provider("anthropic", lambda: extract_streaming(
+                "anthropic", anthropic_deltas(client, COMPACT_OUTPUT, usage, **request), print_field, COMPACT_OUTPUT, usage))
+        else:
+            start_time = time.perf_counter()
+            message = call_provider("anthropic", client.messages.create,
+                tools=[anthropic_tool(COMPACT_OUTPUT)], tool_choice=anthropic_tool_choice(), **request)
+            elapsed = time.perf_counter() - start_time
+            record_latency("anthropic", "blocking", elapsed)
+            record_usage("anthropic", COMPACT_OUTPUT, response_output_tokens(message), elapsed)
+            record_cache("anthropic", response_cache_tokens(message))
+            # ツール使用（input_schema）の応答を解析
+            result = parse_anthropic_response(message, COMPACT_OUTPUT)
         return json.dumps(result, ensure_ascii=False, indent=2)
 
     except FileNotFoundError:
         return json.dumps({"error": f"ファイル '{image_path}' が見つかりません"}, ensure_ascii=False, indent=2)
-    except json.JSONDecodeError:
+    except ParseError:
         return json.dumps({"error": "JSONの解析に失敗しました"}, ensure_ascii=False, indent=2)
+    except CircuitOpenError:
+        # 障害中のプロバイダーには送らずに、別のプロバイダーで抽出する
+        result = divert_receipt("anthropic", image_path)
+        if result is None:
+            return json.dumps({"error": "プロバイダーの障害のため処理できませんでした"}, ensure_ascii=False, indent=2)
+        return json.dumps(result, ensure_ascii=False, indent=2)
     except Exception as e:
         return json.dumps({"error": f"エラーが発生しました: {str(e)}"}, ensure_ascii=False, indent=2)
 
-def normalize_amount(amount_str):
-    """金額表記を正規化する関数（数値に変換）"""
-    if not amount_str or not isinstance(amount_str, str):
-        return amount_str
-    
-    # 通貨記号、カンマ、単位を削除
-    amount_str = amount_str.replace('¥', '').replace('￥', '').replace(',', '').replace('円', '')
-    
-    # 数字以外の文字を削除
-    amount = ''.join(filter(str.isdigit, amount_str))
-    
-    if not amount:
-        return amount_str
-    
-    # 数値に変換
-    return int(amount)
-
-def normalize_results(results):
-    """結果の金額表記を正規化する関数"""
-    normalized_results = []
-    for result in results:
-        normalized_result = result.copy()
-        if '総支払額' in normalized_result:
-            normalized_result['総支払額'] = normalize_amount(normalized_result['総支払額'])
-        if '消費税額' in normalized_result:
-            normalized_result['消費税額'] = normalize_amount(normalized_result['消費税額'])
-        normalized_results.append(normalized_result)
-    return normalized_results
-
-def save_results(results):
-    """処理結果をCSVとExcelファイルに保存する関数"""
-    if not results:
-        print("警告: 保存する結果がありません")
-        return
-    
+def save_results(results, hash_values):
+    """処理結果をCSVとExcelファイルに保存する関数
+
+    hash_values はフォルダーの画像のファイルハッシュ（処理済みのためスキップした画像を含む）
+    """
     # 金額表記を正規化
-    normalized_results = normalize_results(results)
+    normalized_results = normalize_results(results, INT)
+    
+    # 登録番号を検証（形式・チェックディジット・ダウンロード済みの登録簿）
+    validate_results(normalized_results, load_registry())
     
     # 結果ディレクトリの作成（現在のモジュールのディレクトリに作成）
     current_dir = Path(__file__).parent
     results_dir = current_dir / "results"
     results_dir.mkdir(exist_ok=True)
     
+    # 結果ストアに追加・更新（変更のあった月のCSV / Excelだけを作り直す）
+    store = ResultsStore(results_dir)
+    print_upsert_summary(store.upsert(normalized_results))
+    
+    # SQLiteデータベースに追加・更新（python -m common.results_db で集計できる）
+    if SAVE_DATABASE:
+        db_path = save_results_db(normalized_results, results_dir)
+        print(f"データベース: {db_path}")
+    
+    # フォルダー全体の結果（スキップした画像は結果ストアに保存した結果）で結果ジャーナルを作り直し、
+    # 出力ファイルはジャーナルから1行ずつ読んで作成する
+    journal_path = write_journal(results_dir, store.folder_results(hash_values, normalized_results))
+    columns = collect_columns(iter_journal(journal_path))
+    if not columns:
+        print("警告: 保存する結果がありません")
+        return
+    
     # CSVファイルの作成
     csv_path = results_dir / "receipt_results.csv"
     with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
-        writer = csv.DictWriter(f, fieldnames=normalized_results[0].keys())
+        writer = csv.DictWriter(f, fieldnames=columns)
         writer.writeheader()
-        writer.writerows(normalized_results)
+        writer.writerows(iter_normalized(iter_journal(journal_path), INT))
     
-    # Excelファイルの作成
-    df = pd.DataFrame(normalized_results)
+    # Excelファイルの作成（ジャーナルから1行ずつ書き出し、ブック全体をメモリに保持しない）
     excel_path = results_dir / "receipt_results.xlsx"
-    df.to_excel(excel_path, index=False)
+    stats = export_journal(journal_path, excel_path, INT)
     
     print(f"\n処理が完了しました。")
     print(f"CSVファイル: {csv_path}")
     print(f"Excelファイル: {excel_path}")
+    print_export_stats(stats)
+    
+    # Parquetファイルの作成
+    if SAVE_PARQUET:
+        parquet_path = save_parquet(list(iter_normalized(iter_journal(journal_path), INT)), results_dir)
+        print(f"Parquetファイル: {parquet_path}")
 
 def process_files_in_directory(dir_name):
     """指定されたディレクトリ内のJPG画像を処理し、結果をCSVとExcelファイルに保存する"""
     # 結果を格納するリスト
     results = []
+    hash_values = []
     
     # ディレクトリ内のJPGファイルを取得
     image_files = list(Path(dir_name).glob("*.jpg"))
@@ -185,9 +214,22 @@ def process_files_in_directory(dir_name):
         return
     
     print(f"処理を開始します。{len(image_files)}個のファイルが見つかりました。")
+    check_prefix(COMPACT_OUTPUT)
+    
+    # 結果ジャーナルの作成（1件ごとに追記し、途中でエラーが発生しても結果を残す。保存時にフォルダー全体の結果で作り直す）
+    results_dir = Path(__file__).parent / "results"
+    results_dir.mkdir(exist_ok=True)
+    journal_path = start_journal(results_dir)
+    store = ResultsStore(results_dir)
     
     # 各画像を処理
     for image_path in image_files:
+        hash_value = file_hash(image_path)
+        hash_values.append(hash_value)
+        if SKIP_PROCESSED_FILES and hash_value in store:
+            print(f"\n処理済みのためスキップします: {image_path.name}")
+            continue
+        
         print(f"\n処理中: {image_path.name}")
         try:
             result_json = analyze_receipt(str(image_path))
@@ -195,17 +237,18 @@ def process_files_in_directory(dir_name):
             
             # ファイル名を追加
             result_dict['ファイル名'] = image_path.name
+            result_dict[HASH_COLUMN] = hash_value
             results.append(result_dict)
+            append_journal(journal_path, result_dict)
             
         except Exception as e:
             print(f"エラー: {image_path.name} の処理中にエラーが発生しました: {str(e)}")
     
     if not results:
-        print("警告: 処理可能なファイルがありませんでした")
-        return
+        print("\n新しく処理したファイルはありません（処理済みの結果で出力ファイルを作り直します）")
     
     # 結果を保存
-    save_results(results)
+    save_results(results, hash_values)
 
 def main():
     print("レシート画像一括処理プログラム")
@@ -216,6 +259,12 @@ def main():
         return
         
     process_files_in_directory(dir_name)
+    print_parse_stats()
+    print_latency_stats()
+    print_usage_stats()
+    print_cache_stats()
+    print_retry_stats()
+    print_breaker_stats()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
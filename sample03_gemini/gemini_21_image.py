@@ -1,12 +1,19 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample03_gemini.gemini_21_image で実行してください。
 import os
 
 import PIL.Image
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from common.hedging import ask_image, print_hedge_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 応答が遅い場合（これまでの応答時間の p95 を過ぎた場合）に、別のプロバイダーにも同じリクエストを送るかどうか
+HEDGING = True
+
 # APIキーを設定
 api_key = os.getenv("GEMINI_API_KEY")
 genai.configure(api_key=api_key)
@@ -38,6 +45,14 @@ def analyze_image(image_path, prompt):
         return f"エラーが発生しました: {error_message}"
 
 
+def analyze_image_hedged(image_path, prompt):
+    """画像を分析し、応答のテキストを返す関数（応答が遅い場合は別のプロバイダーの応答を使う）"""
+    try:
+        return ask_image("gemini", image_path, prompt, "gemini-1.5-flash")
+    except Exception as e:
+        return f"エラーが発生しました: {str(e)}"
+
+
 def main():
     print("Gemini APIを使用した画像分析プログラム")
     print("終了するには 'exit' と入力してください")
@@ -46,6 +61,7 @@ def main():
         image_path = input("\n画像ファイルのパスを入力してください (例: image.jpg): ")
 
         if image_path.lower() == "exit":
+            print_hedge_stats()
             print("プログラムを終了します")
             break
 
@@ -60,6 +76,10 @@ def main():
             continue
 
         print("\n分析中...\n")
+        if HEDGING:
+            # 応答が遅い場合は別のプロバイダーにも送り、先に返ってきた応答を使う
+            print(analyze_image_hedged(image_path, prompt))
+            continue
         response = analyze_image(image_path, prompt)
         print(response.text)
 
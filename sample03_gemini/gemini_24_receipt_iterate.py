@@ -11,8 +11,13 @@
 特徴：
 - ディレクトリ内のJPG画像を一括処理
 - 結果をCSVとExcelファイルに保存
-- エラーハンドリング機能付き
+- 共通の指示と入力例をシステム指示として先頭に置き、プロンプトキャッシュを効かせる
+- エラーハンドリング機能付き（レート制限などの一時的なエラーは、待ってから再試行）
+- プロバイダーの障害中は呼び出しを遮断し、別のプロバイダーに振り替え（サーキットブレーカー）
 - 処理状況の表示
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample03_gemini.gemini_24_receipt_iterate で実行してください。
 """
 
 import os
@@ -24,6 +29,19 @@ import PIL.Image
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from common.circuit_breaker import CircuitOpenError, call_provider, print_breaker_stats
+from common.prompt_cache import (
+    check_prefix,
+    gemini_contents,
+    print_cache_stats,
+    record_cache,
+    response_cache_tokens,
+    static_prefix,
+)
+from common.receipt_extractors import divert_receipt
+from common.retry import is_rate_limit_error, print_retry_stats
+from common.structured_output import ParseError, gemini_generation_config, parse_gemini_response, print_parse_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
@@ -31,8 +49,8 @@ load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
 genai.configure(api_key=api_key)
 
-# モデルの設定
-model = genai.GenerativeModel("gemini-1.5-flash")
+# モデルの設定（静的なプレフィックスをシステム指示として先頭に置き、暗黙的なキャッシュを効かせる）
+model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=static_prefix())
 
 def analyze_receipt(image_path):
     """レシートの画像を分析し、必要な情報を抽出する関数"""
@@ -40,53 +58,21 @@ def analyze_receipt(image_path):
         # 画像を読み込む
         image = PIL.Image.open(image_path)
 
-        prompt = """
-        このレシートから以下の情報を抽出してください：
-        1. 登録番号（登録番号もしくは事業者登録番号）
-        2. 購入店名
-        3. 総支払額
-        4. 消費税額
-
-        必ず次のJSON形式でのみ返答してください。余計な説明は含めないでください：
-        {
-            "登録番号": "番号",
-            "購入店": "店名",
-            "総支払額": "金額",
-            "消費税額": "金額"
-        }
+        # JSONレスポンスのスキーマを指定
+        generation_config = gemini_generation_config()
         
-        情報が見つからない場合は、該当項目を「不明」としてください。
-        """
-
-        # JSONレスポンスフォーマットを指定
-        generation_config = {
-            "response_mime_type": "application/json",
-        }
-        
-        response = model.generate_content(
-            [prompt, image],
+        response = call_provider("gemini", model.generate_content,
+            gemini_contents(image),
             generation_config=generation_config
         )
+        record_cache("gemini", response_cache_tokens(response))
         
         try:
-            # JSON形式で直接返ってきた場合
-            result = json.loads(response.text)
-        except json.JSONDecodeError:
-            # テキストからJSONを抽出してみる
-            text = response.text.strip()
-            # 最初の { と最後の } の間のテキストを抽出
-            start = text.find('{')
-            end = text.rfind('}') + 1
-            if start >= 0 and end > start:
-                json_str = text[start:end]
-                try:
-                    result = json.loads(json_str)
-                except json.JSONDecodeError:
-                    print(f"エラー: '{image_path}' のJSON解析に失敗しました")
-                    return None
-            else:
-                print(f"エラー: '{image_path}' の応答がJSON形式ではありません")
-                return None
+            # 構造化出力（response_schema）の応答を解析
+            result = parse_gemini_response(response)
+        except ParseError as e:
+            print(f"エラー: '{image_path}' の{e}")
+            return None
                 
         return result
 
@@ -96,10 +82,13 @@ def analyze_receipt(image_path):
     except PIL.UnidentifiedImageError:
         print(f"エラー: '{image_path}' は有効な画像ファイルではありません")
         return None
+    except CircuitOpenError:
+        # 障害中のプロバイダーには送らずに、別のプロバイダーで抽出する
+        return divert_receipt("gemini", image_path)
     except Exception as e:
         error_message = str(e)
-        if "429" in error_message and "Resource has been exhausted" in error_message:
-            print("エラー: APIの使用量制限に達しました。しばらく待ってから再試行してください。")
+        if is_rate_limit_error(e):
+            print("エラー: APIの使用量制限に達しました（再試行の上限に達しました）。しばらく待ってから再試行してください。")
         else:
             print(f"エラー: '{image_path}' の処理中にエラーが発生しました: {error_message}")
         return None
@@ -131,6 +120,7 @@ def process_files_in_directory(directory):
     total_files = len(image_files)
     
     print(f"\n{total_files}個のJPGファイルを処理します...")
+    check_prefix()
     
     for i, image_path in enumerate(image_files, 1):
         print(f"\n処理中: {image_path.name} ({i}/{total_files})")
@@ -156,6 +146,11 @@ def main():
         print(f"\n処理完了: {len(results)}個のファイルを処理しました")
     else:
         print("\n処理可能なファイルが見つかりませんでした")
+    
+    print_parse_stats()
+    print_cache_stats()
+    print_retry_stats()
+    print_breaker_stats()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
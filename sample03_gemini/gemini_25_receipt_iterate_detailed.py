@@ -11,14 +11,19 @@
 特徴：
 - ディレクトリ内のJPG画像を一括処理
 - 金額を「数字 + 円」形式に正規化
-- 結果をCSVとExcelファイルに保存
-- エラーハンドリング機能付き
+- 結果をCSVとExcelファイルに保存（型付きのParquetファイルにも保存可能）
+- 共通の指示と入力例をシステム指示として先頭に置き、プロンプトキャッシュを効かせる
+- エラーハンドリング機能付き（レート制限などの一時的なエラーは、待ってから再試行）
+- プロバイダーの障害中は呼び出しを遮断し、別のプロバイダーに振り替え（サーキットブレーカー）
 - 処理状況の表示
 
 使用方法：
 1. プログラムを実行
 2. レシート画像が含まれるディレクトリ名を入力
 3. 処理完了後、resultsディレクトリに結果ファイルが作成される
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample03_gemini.gemini_25_receipt_iterate_detailed で実行してください。
 """
 
 import os
@@ -29,15 +34,44 @@ import PIL.Image
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from common.amount_normalizer import YEN, normalize_results
+from common.circuit_breaker import CircuitOpenError, call_provider, print_breaker_stats
+from common.excel_export import export_journal, iter_normalized, print_export_stats
+from common.parquet_output import save_parquet
+from common.prompt_cache import (
+    check_prefix,
+    gemini_contents,
+    print_cache_stats,
+    record_cache,
+    response_cache_tokens,
+    static_prefix,
+)
+from common.receipt_extractors import divert_receipt
+from common.registration_validator import load_registry, validate_results
+from common.result_journal import append_journal, collect_columns, iter_journal, start_journal, write_journal
+from common.results_db import save_results_db
+from common.results_store import HASH_COLUMN, ResultsStore, file_hash, print_upsert_summary
+from common.retry import is_rate_limit_error, print_retry_stats
+from common.structured_output import ParseError, gemini_generation_config, parse_gemini_response, print_parse_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 型付きのParquetファイル（金額は int64）も保存するかどうか
+SAVE_PARQUET = True
+
+# 処理済みの画像（内容が同じファイル）をスキップするかどうか
+SKIP_PROCESSED_FILES = True
+
+# SQLiteデータベース（receipt_results.db）にも保存するかどうか
+SAVE_DATABASE = True
+
 # APIキーを設定
 api_key = os.getenv("GEMINI_API_KEY")
 genai.configure(api_key=api_key)
 
-# モデルの設定
-model = genai.GenerativeModel("gemini-1.5-flash")
+# モデルの設定（静的なプレフィックスをシステム指示として先頭に置き、暗黙的なキャッシュを効かせる）
+model = genai.GenerativeModel("gemini-1.5-flash", system_instruction=static_prefix())
 
 def analyze_receipt(image_path):
     """レシートの画像を分析し、必要な情報を抽出する関数"""
@@ -45,53 +79,21 @@ def analyze_receipt(image_path):
         # 画像を読み込む
         image = PIL.Image.open(image_path)
 
-        prompt = """
-        このレシートから以下の情報を抽出してください：
-        1. 登録番号（登録番号もしくは事業者登録番号）
-        2. 購入店名
-        3. 総支払額
-        4. 消費税額
-
-        必ず次のJSON形式でのみ返答してください。余計な説明は含めないでください：
-        {
-            "登録番号": "番号",
-            "購入店": "店名",
-            "総支払額": "金額",
-            "消費税額": "金額"
-        }
+        # JSONレスポンスのスキーマを指定
+        generation_config = gemini_generation_config()
         
-        情報が見つからない場合は、該当項目を「不明」としてください。
-        """
-
-        # JSONレスポンスフォーマットを指定
-        generation_config = {
-            "response_mime_type": "application/json",
-        }
-        
-        response = model.generate_content(
-            [prompt, image],
+        response = call_provider("gemini", model.generate_content,
+            gemini_contents(image),
             generation_config=generation_config
         )
+        record_cache("gemini", response_cache_tokens(response))
         
         try:
-            # JSON形式で直接返ってきた場合
-            result = json.loads(response.text)
-        except json.JSONDecodeError:
-            # テキストからJSONを抽出してみる
-            text = response.text.strip()
-            # 最初の { と最後の } の間のテキストを抽出
-            start = text.find('{')
-            end = text.rfind('}') + 1
-            if start >= 0 and end > start:
-                json_str = text[start:end]
-                try:
-                    result = json.loads(json_str)
-                except json.JSONDecodeError:
-                    print(f"エラー: '{image_path}' のJSON解析に失敗しました")
-                    return None
-            else:
-                print(f"エラー: '{image_path}' の応答がJSON形式ではありません")
-                return None
+            # 構造化出力（response_schema）の応答を解析
+            result = parse_gemini_response(response)
+        except ParseError as e:
+            print(f"エラー: '{image_path}' の{e}")
+            return None
                 
         return result
 
@@ -101,50 +103,49 @@ def analyze_receipt(image_path):
     except PIL.UnidentifiedImageError:
         print(f"エラー: '{image_path}' は有効な画像ファイルではありません")
         return None
+    except CircuitOpenError:
+        # 障害中のプロバイダーには送らずに、別のプロバイダーで抽出する
+        return divert_receipt("gemini", image_path)
     except Exception as e:
         error_message = str(e)
-        if "429" in error_message and "Resource has been exhausted" in error_message:
-            print("エラー: APIの使用量制限に達しました。しばらく待ってから再試行してください。")
+        if is_rate_limit_error(e):
+            print("エラー: APIの使用量制限に達しました（再試行の上限に達しました）。しばらく待ってから再試行してください。")
         else:
             print(f"エラー: '{image_path}' の処理中にエラーが発生しました: {error_message}")
         return None
 
-def normalize_amount(amount_str):
-    """金額の表記を正規化する関数（「数字 + 円」形式）"""
-    try:
-        # 通貨記号やカンマを削除
-        amount_str = amount_str.replace('¥', '').replace(',', '')
-        
-        # 数字以外の文字を削除
-        amount_str = ''.join(filter(str.isdigit, amount_str))
-        
-        # 数字に変換
-        amount = int(amount_str)
-        
-        # 「数字 + 円」形式に変換
-        return f"{amount}円"
-    except:
-        return amount_str
-
-def normalize_results(results):
-    """結果の金額を正規化する関数"""
-    normalized_results = []
-    for result in results:
-        normalized_result = result.copy()
-        normalized_result['総支払額'] = normalize_amount(result['総支払額'])
-        normalized_result['消費税額'] = normalize_amount(result['消費税額'])
-        normalized_results.append(normalized_result)
-    return normalized_results
-
-def save_results(results, output_dir_name):
-    """結果をCSVとExcelファイルに保存する関数"""
+def save_results(results, hash_values, output_dir_name):
+    """結果をCSVとExcelファイルに保存する関数
+
+    hash_values はフォルダーの画像のファイルハッシュ（処理済みのためスキップした画像を含む）
+    """
     # 結果ディレクトリの作成（現在のモジュールのディレクトリに作成）
     current_dir = Path(__file__).parent
     results_dir = current_dir / output_dir_name
     results_dir.mkdir(exist_ok=True)
     
+    # 登録番号を検証（形式・チェックディジット・ダウンロード済みの登録簿）
+    validate_results(results, load_registry())
+    
+    # 結果ストアに追加・更新（変更のあった月のCSV / Excelだけを作り直す）
+    store = ResultsStore(results_dir)
+    print_upsert_summary(store.upsert(results))
+
+    # SQLiteデータベースに追加・更新（python -m common.results_db で集計できる）
+    if SAVE_DATABASE:
+        db_path = save_results_db(results, results_dir)
+        print(f"データベースに保存しました: {db_path}")
+
+    # フォルダー全体の結果（スキップした画像は結果ストアに保存した結果）で結果ジャーナルを作り直し、
+    # 出力ファイルはジャーナルから1行ずつ読んで作成する
+    journal_path = write_journal(results_dir, store.folder_results(hash_values, results))
+    columns = collect_columns(iter_journal(journal_path))
+    if not columns:
+        print("警告: 保存する結果がありません")
+        return
+    
     # DataFrameを作成
-    df = pd.DataFrame(results)
+    df = pd.DataFrame(iter_normalized(iter_journal(journal_path), YEN), columns=columns)
     
     # CSVファイルに保存
     csv_path = results_dir / "receipt_results.csv"
@@ -153,25 +154,47 @@ def save_results(results, output_dir_name):
     
     # Excelファイルに保存
     excel_path = results_dir / "receipt_results.xlsx"
-    df.to_excel(excel_path, index=False)
+    stats = export_journal(journal_path, excel_path, YEN)
     print(f"Excelファイルを保存しました: {excel_path}")
+    print_export_stats(stats)
+
+    # Parquetファイルに保存
+    if SAVE_PARQUET:
+        parquet_path = save_parquet(list(iter_normalized(iter_journal(journal_path), YEN)), results_dir)
+        print(f"Parquetファイルを保存しました: {parquet_path}")
 
 def process_files_in_directory(directory):
-    """ディレクトリ内のJPG画像を処理する関数"""
+    """ディレクトリ内のJPG画像を処理し、(結果のリスト, 画像のファイルハッシュのリスト) を返す関数"""
     results = []
+    hash_values = []
     image_files = list(Path(directory).glob("*.jpg"))
     total_files = len(image_files)
     
     print(f"\n{total_files}個のJPGファイルを処理します...")
+    check_prefix()
+    
+    # 結果ジャーナルの作成（1件ごとに追記し、途中でエラーが発生しても結果を残す。保存時にフォルダー全体の結果で作り直す）
+    results_dir = Path(__file__).parent / "results"
+    results_dir.mkdir(exist_ok=True)
+    journal_path = start_journal(results_dir)
+    store = ResultsStore(results_dir)
     
     for i, image_path in enumerate(image_files, 1):
+        hash_value = file_hash(image_path)
+        hash_values.append(hash_value)
+        if SKIP_PROCESSED_FILES and hash_value in store:
+            print(f"\n処理済みのためスキップします: {image_path.name} ({i}/{total_files})")
+            continue
+        
         print(f"\n処理中: {image_path.name} ({i}/{total_files})")
         result = analyze_receipt(str(image_path))
         if result:
             result["ファイル名"] = image_path.name
+            result[HASH_COLUMN] = hash_value
             results.append(result)
+            append_journal(journal_path, result)
     
-    return results
+    return results, hash_values
 
 def main():
     print("レシート一括分析プログラム（金額正規化機能付き）")
@@ -181,15 +204,20 @@ def main():
         print(f"エラー: ディレクトリ '{directory}' が見つかりません")
         return
     
-    results = process_files_in_directory(directory)
+    results, hash_values = process_files_in_directory(directory)
     
-    if results:
+    if hash_values:
         # 金額を正規化
-        normalized_results = normalize_results(results)
-        save_results(normalized_results, "results")
-        print(f"\n処理完了: {len(results)}個のファイルを処理しました")
+        normalized_results = normalize_results(results, YEN)
+        save_results(normalized_results, hash_values, "results")
+        print(f"\n処理完了: {len(results)}個のファイルを処理しました（処理済みのためスキップ: {len(hash_values) - len(results)}個）")
     else:
         print("\n処理可能なファイルが見つかりませんでした")
+    
+    print_parse_stats()
+    print_cache_stats()
+    print_retry_stats()
+    print_breaker_stats()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
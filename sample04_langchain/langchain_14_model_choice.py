@@ -1,16 +1,31 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample04_langchain.langchain_14_model_choice で実行してください。
 import os
 
 from dotenv import load_dotenv
 from langchain_anthropic import ChatAnthropic
+from langchain_core.globals import set_llm_cache
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 # 各LLMプロバイダーのインポート
 from langchain_openai import ChatOpenAI
 
+from common.response_cache import CACHE_PATH, LangChainCache, ResponseCache, print_response_cache_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 同じ入力への応答を保存して再利用するかどうか（応答キャッシュ）
+RESPONSE_CACHE = True
+
+# 応答キャッシュをファイルに保存し、次の実行でも使うかどうか
+SAVE_RESPONSE_CACHE = True
+
+if RESPONSE_CACHE:
+    # チェーンの中のモデルの呼び出しに、応答キャッシュを使う
+    set_llm_cache(LangChainCache(ResponseCache(path=CACHE_PATH if SAVE_RESPONSE_CACHE else None)))
+
 
 def get_response(llm_provider, query_topic):
     """ 指定されたLLMプロバイダーを使用して応答を生成する関数
@@ -86,3 +101,4 @@ if __name__ == "__main__":
         print(result)
     except ValueError as e:
         print(f"エラー: {e}")
+    print_response_cache_stats()
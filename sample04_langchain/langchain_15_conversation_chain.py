@@ -1,10 +1,13 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample04_langchain.langchain_15_conversation_chain で実行してください。
 import os
 from dotenv import load_dotenv
-from langchain.memory import ConversationBufferMemory
 from langchain.chains import ConversationChain
 from langchain_openai import OpenAI
 from langchain_core.prompts import PromptTemplate
 
+from common.history_window import TokenWindowMemory, print_history_window_stats
+
 # 環境変数を読み込む
 load_dotenv()
 
@@ -31,8 +34,8 @@ template = """あなたは姓名占いをする占い師です。
 人間: {input}
 AI占い師: """
 
-# メモリと会話チェーンの設定
-memory = ConversationBufferMemory()
+# メモリと会話チェーンの設定（トークン数の予算に収まる直近の会話だけをプロンプトに渡す）
+memory = TokenWindowMemory(pinned_prompt=template)
 conversation = ConversationChain(
     llm=llm,
     memory=memory,
@@ -54,6 +57,7 @@ if __name__ == "__main__":
 
         if user_input.lower() == "exit":
             print("プログラムを終了します")
+            print_history_window_stats()
             break
 
         if not user_input.strip():
@@ -1,13 +1,36 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample04_langchain.langchain_24_simple_select_interactive で実行してください。
 import os
 
 from dotenv import load_dotenv
+from langchain_core.globals import set_llm_cache
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 
+from common.response_cache import CACHE_PATH, LangChainCache, ResponseCache, print_response_cache_stats
+from common.semantic_cache import SemanticCache, cache_scope, print_semantic_cache_stats, semantic_call
+from common.singleflight import coalesce, print_singleflight_stats, request_key
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 同じ入力への応答を保存して再利用するかどうか（応答キャッシュ）
+RESPONSE_CACHE = True
+
+# 応答キャッシュをファイルに保存し、次の実行でも使うかどうか
+SAVE_RESPONSE_CACHE = True
+
+# 書き方の違う同じ名前（「山田 太郎さんを占って」など）にも、保存した応答を返すかどうか（意味キャッシュ）
+SEMANTIC_CACHE = True
+
+# 意味キャッシュ（実行中のみ保存する）
+semantic_cache = SemanticCache()
+
+if RESPONSE_CACHE:
+    # チェーンの中のモデルの呼び出しに、応答キャッシュを使う
+    set_llm_cache(LangChainCache(ResponseCache(path=CACHE_PATH if SAVE_RESPONSE_CACHE else None)))
+
 
 def get_response(query_topic):
     """ OpenAIのLLMを使用して姓名占いの応答を生成する関数
@@ -45,8 +68,14 @@ def get_response(query_topic):
     # チェーンを作成
     chain = prompt_template | llm | StrOutputParser()
 
-    # チェーンを実行
-    response = chain.invoke({"user_input": query_topic})
+    # チェーンを実行（同じ入力の呼び出しが実行中の場合は、その応答を待って同じ応答を返す）
+    key = request_key("gpt-4o", prompt_template.template, query_topic)
+    if SEMANTIC_CACHE:
+        # 書き方の違う同じ名前の応答を保存している場合は、チェーンを実行せずに返す
+        scope = cache_scope("openai", "gpt-4o", prompt_template.template)
+        response = semantic_call(semantic_cache, scope, query_topic, coalesce, key, chain.invoke, {"user_input": query_topic})
+    else:
+        response = coalesce(key, chain.invoke, {"user_input": query_topic})
 
     return response
 
@@ -61,6 +90,9 @@ if __name__ == "__main__":
 
         if user_input.lower() == "exit":
             print("プログラムを終了します")
+            print_singleflight_stats()
+            print_semantic_cache_stats()
+            print_response_cache_stats()
             break
 
         if not user_input.strip():
@@ -1,3 +1,5 @@
+# common パッケージを使用するため、プロジェクトのルートディレクトリから
+# python -m sample04_langchain.langchain_25_simple_select_multiple で実行してください。
 import os
 from datetime import datetime
 from langchain_core.prompts import PromptTemplate
@@ -8,9 +10,18 @@ from dotenv import load_dotenv
 # OpenAIのインポート
 from langchain_openai import ChatOpenAI
 
+from common.semantic_cache import SemanticCache, cache_scope, print_semantic_cache_stats, semantic_call
+from common.singleflight import coalesce, print_singleflight_stats, request_key
+
 # 環境変数を読み込む
 load_dotenv()
 
+# 書き方の違う同じ名前（「山田 太郎さんを占って」など）にも、保存した応答を返すかどうか（意味キャッシュ）
+SEMANTIC_CACHE = True
+
+# 意味キャッシュ（実行中のみ保存する）
+semantic_cache = SemanticCache()
+
 # 会話履歴を保存するリスト
 conversation_history = []
 
@@ -94,8 +105,14 @@ def get_response(name_input):
     # チェーンを作成
     chain = prompt_template | llm | StrOutputParser()
 
-    # チェーンを実行
-    response = chain.invoke({"user_input": name_input})
+    # チェーンを実行（同じ入力の呼び出しが実行中の場合は、その応答を待って同じ応答を返す）
+    key = request_key("gpt-4o", prompt_template.template, name_input)
+    if SEMANTIC_CACHE:
+        # 書き方の違う同じ名前の応答を保存している場合は、チェーンを実行せずに返す
+        scope = cache_scope("openai", "gpt-4o", prompt_template.template)
+        response = semantic_call(semantic_cache, scope, name_input, coalesce, key, chain.invoke, {"user_input": name_input})
+    else:
+        response = coalesce(key, chain.invoke, {"user_input": name_input})
 
     return response
 
@@ -114,6 +131,8 @@ if __name__ == "__main__":
         # 特別コマンドの処理
         if user_input.lower() == "exit":
             print("プログラムを終了します")
+            print_singleflight_stats()
+            print_semantic_cache_stats()
             break
         elif user_input.lower() == "history":
             print(display_history())
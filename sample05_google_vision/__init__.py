@@ -0,0 +1 @@
+# Google Cloud Vision APIを使用するためのモジュール
@@ -0,0 +1,95 @@
+"""
+DOCUMENT_TEXT_DETECTION の応答を逐次的に解析するモジュール
+
+このモジュールは、Google Cloud Vision API の DOCUMENT_TEXT_DETECTION の応答を
+ijson でストリームとして読み込み、ページ/ブロック/段落/単語の階層をたどって
+単語ごとの text_blocks と読み順に並んだ行を作成します。
+
+特徴：
+- 応答全体をメモリに読み込まず、ブロック単位で組み立てては破棄する
+- 文字（symbol）単位の情報は単語に集約してから捨てる
+- 出力は vision_receipt_sample.py の TEXT_DETECTION と同じ形式（full_text, text_blocks）
+- 読み順の行（lines）を含むため、そのままOCR結果→LLMの処理に渡せる
+"""
+
+import ijson
+
+from common.ocr_layout import reconstruct_lines
+
+# 解析の対象とするJSONのパス
+FULL_TEXT_PREFIX = "responses.item.fullTextAnnotation.text"
+PAGE_PREFIX = "responses.item.fullTextAnnotation.pages.item"
+BLOCK_PREFIX = PAGE_PREFIX + ".blocks.item"
+ERROR_PREFIX = "responses.item.error.message"
+
+
+def convert_word(word):
+    """単語の辞書を text_blocks の1要素の形式に変換する関数"""
+    text = "".join(symbol.get("text", "") for symbol in word.get("symbols", []))
+    return {
+        "text": text,
+        "confidence": word.get("confidence", 0),
+        "bounding_box": {
+            "vertices": word.get("boundingBox", {}).get("vertices", [])
+        }
+    }
+
+
+def convert_block(block, page_index, text_blocks):
+    """ブロックの単語を text_blocks に追加し、階層情報だけを返す関数"""
+    paragraphs = []
+    for paragraph in block.get("paragraphs", []):
+        word_ids = []
+        for word in paragraph.get("words", []):
+            word_ids.append(len(text_blocks))
+            text_blocks.append(convert_word(word))
+        paragraphs.append(word_ids)
+
+    return {
+        "page": page_index,
+        "block_type": block.get("blockType", "TEXT"),
+        "confidence": block.get("confidence", 0),
+        "paragraphs": paragraphs,
+    }
+
+
+def parse_document_stream(stream):
+    """DOCUMENT_TEXT_DETECTION の応答をストリームから解析する関数
+
+    :param stream: 応答本文を読み出せるファイルライクオブジェクト（response.raw など）
+    :returns: full_text, text_blocks, blocks, lines を持つ辞書
+    :rtype: dict
+    :raises RuntimeError: APIがエラーを返した場合
+    """
+    full_text = ""
+    text_blocks = []
+    blocks = []
+    page_index = -1
+    builder = None
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            # ブロックの組み立て中は、そのブロックの終わりまでイベントを渡す
+            if prefix == BLOCK_PREFIX and event == "end_map":
+                blocks.append(convert_block(builder.value, page_index, text_blocks))
+                builder = None
+            else:
+                builder.event(event, value)
+            continue
+
+        if prefix == BLOCK_PREFIX and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == PAGE_PREFIX and event == "start_map":
+            page_index += 1
+        elif prefix == FULL_TEXT_PREFIX and event == "string":
+            full_text = value
+        elif prefix == ERROR_PREFIX and event == "string":
+            raise RuntimeError(f"Vision APIがエラーを返しました: {value}")
+
+    return {
+        "full_text": full_text,
+        "text_blocks": text_blocks,
+        "blocks": blocks,
+        "lines": reconstruct_lines(text_blocks),
+    }
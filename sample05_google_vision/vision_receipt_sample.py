@@ -4,7 +4,14 @@ Google Cloud Vision APIを使用したレシート画像分析サンプル
 このスクリプトは以下の機能を提供します：
 - 指定されたレシート画像の読み込み
 - Google Cloud Vision APIを使用したテキスト抽出
+- DOCUMENT_TEXT_DETECTION モードでは応答をストリームで解析し、読み順の行を出力
+- 正規表現による登録番号・合計・消費税額の抽出（LLMを使わない高速パス）
+- 単語ボックスの空間インデックスによるラベルと金額の対応付け
 - 結果のJSONファイル保存
+- 一時的なエラー（429・5xx・接続エラー）は、待ってから再試行（common.retry）
+
+※ common パッケージを使用するため、プロジェクトのルートディレクトリから
+   python -m sample05_google_vision.vision_receipt_sample で実行してください。
 """
 
 import os
@@ -14,11 +21,53 @@ import base64
 import requests
 from dotenv import load_dotenv
 
+from common.ocr_spatial import extract_ocr_fields
+from common.receipt_rules import missing_fields
+from common.retry import call_with_retry, print_retry_stats
+from sample05_google_vision.vision_document_parser import parse_document_stream
+
 # 環境変数を読み込む
 load_dotenv()
 api_key = os.getenv('GOOGLE_VISION_API_KEY')
 
-def analyze_receipt(image_path):
+# 使用できる検出モード
+TEXT_DETECTION = 'TEXT_DETECTION'
+DOCUMENT_TEXT_DETECTION = 'DOCUMENT_TEXT_DETECTION'
+
+# 応答を待つ時間の上限（秒）。超えた場合は再試行する
+REQUEST_TIMEOUT = 60
+
+def build_feature(feature_type):
+    """検出モードに応じた features の要素を作成する関数"""
+    if feature_type == DOCUMENT_TEXT_DETECTION:
+        return {"type": DOCUMENT_TEXT_DETECTION}
+    return {"type": TEXT_DETECTION, "maxResults": 10000}
+
+def post_annotate(url, headers, data):
+    """Vision APIにリクエストを送り、応答のJSONを返す関数（エラーのステータスは例外にする）"""
+    response = requests.post(url, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+def post_document(url, headers, data):
+    """DOCUMENT_TEXT_DETECTION のリクエストを送り、応答をストリームで受け取って解析する関数"""
+    with requests.post(url, headers=headers, data=data, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        # gzip などで圧縮されている場合も展開しながら読み込む
+        response.raw.decode_content = True
+        return parse_document_stream(response.raw)
+
+def analyze_document(url, headers, data):
+    """DOCUMENT_TEXT_DETECTION の応答をストリームで受け取り、解析する関数"""
+    # 再試行する場合は、応答を最初から受け取り直す
+    formatted_result = call_with_retry(post_document, url, headers, data)
+
+    if not formatted_result["text_blocks"]:
+        print("テキストが見つかりませんでした")
+        return None
+    return formatted_result
+
+def analyze_receipt(image_path, feature_type=TEXT_DETECTION):
     """レシート画像を分析し、テキストを抽出する関数"""
     try:
         url = f"https://vision.googleapis.com/v1/images:annotate?key={api_key}"
@@ -35,10 +84,7 @@ def analyze_receipt(image_path):
                         "content": img_data
                     },
                     "features": [
-                        {
-                            "type": 'TEXT_DETECTION',
-                            "maxResults": 10000
-                        }
+                        build_feature(feature_type)
                     ],
                     "imageContext": {}
                 }
@@ -47,9 +93,14 @@ def analyze_receipt(image_path):
         }
 
         data = json.dumps(request_body)
-        response = requests.post(url, headers=headers, data=data)
-        response.raise_for_status()
-        result = response.json()
+
+        if feature_type == DOCUMENT_TEXT_DETECTION:
+            formatted_result = analyze_document(url, headers, data)
+            if formatted_result:
+                formatted_result["rule_fields"] = extract_ocr_fields(formatted_result)
+            return formatted_result
+
+        result = call_with_retry(post_annotate, url, headers, data)
 
         # 結果の整形
         if 'responses' not in result or not result['responses']:
@@ -77,6 +128,9 @@ def analyze_receipt(image_path):
             }
             formatted_result["text_blocks"].append(block)
 
+        # ルールで抽出できる項目は、この時点で確定させておく
+        formatted_result["rule_fields"] = extract_ocr_fields(formatted_result)
+
         return formatted_result
 
     except Exception as e:
@@ -109,16 +163,30 @@ def main():
         print(f"エラー: ファイル '{image_path}' が見つかりません")
         return
 
+    use_document = input("DOCUMENT_TEXT_DETECTION モードを使用しますか？ (y/n): ")
+    feature_type = DOCUMENT_TEXT_DETECTION if use_document.lower() == 'y' else TEXT_DETECTION
+
     # レシートの分析
     print(f"\n'{image_path}' を分析中...")
-    result = analyze_receipt(image_path)
+    result = analyze_receipt(image_path, feature_type)
     
     if result:
+        print("\nルールによる抽出結果:")
+        for name, field in result["rule_fields"].items():
+            print(f"  {name}: {field['value']}（確信度 {field['confidence']:.2f}）")
+        missing = missing_fields(result["rule_fields"])
+        if missing:
+            print(f"LLMでの抽出が必要な項目: {', '.join(missing)}")
+        else:
+            print("すべての項目をルールで抽出できました（LLMの呼び出しは不要です）")
+
         # 結果の保存
         save_results(result, "results", image_path)
         print("\n処理が完了しました")
     else:
         print("\n処理に失敗しました")
 
+    print_retry_stats()
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file